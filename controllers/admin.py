@@ -9,6 +9,8 @@ from paver.easy import sh
 import json
 from runestone import cmap
 from rs_grading import send_lti_grades, _get_assignment
+from code_store import move_latest_code
+from user_counts import count_users
 import pandas as pd
 
 import logging
@@ -683,6 +685,9 @@ def admin():
         downloads_enabled=downloads_enabled,
         allow_pairs=allow_pairs,
         instructor_course_list=instructor_course_list,
+        num_readers=count_users(
+            db, course.course_name, since=course.term_start_date, cache=(cache.ram, 600)
+        ),
     )
 
 
@@ -857,11 +862,14 @@ def removeStudents():
             "{} has requested the removal of {}".format(auth.user.username, studentID)
         )
         if studentID.isdigit() and int(studentID) != auth.user.id:
-            sid = (
+            student = (
                 db(db.auth_user.id == int(studentID))
                 .select(db.auth_user.username)
                 .first()
             )
+            if not student:
+                continue
+            sid = student.username
             db(
                 (db.user_courses.user_id == int(studentID))
                 & (db.user_courses.course_id == auth.user.course_id)
@@ -894,6 +902,7 @@ def removeStudents():
             db(
                 (db.code.sid == sid) & (db.code.course_id == auth.user.course_id)
             ).update(course_id=baseCourseID)
+            move_latest_code(db, sid, auth.user.course_id, baseCourseID)
             db(
                 (db.acerror_log.sid == sid)
                 & (db.acerror_log.course_id == auth.user.course_name)
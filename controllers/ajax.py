@@ -1,14 +1,20 @@
 import json
 import datetime
+import difflib
 import logging
-import subprocess
 import uuid
 from bleach import clean
-from collections import Counter
-import os
-from io import open
-from lxml import html
-from feedback import is_server_feedback, fitb_feedback, lp_feedback
+from feedback import is_server_feedback, fitb_feedback, lp_feedback, server_feedback
+from answer_stats import record_answer_rows, top_fitb_answers, user_answer_counts
+from code_store import latest_code, note_latest_code, resolve_code, store_code
+from db_bulk import multirow_insert, savepoint
+from last_page import save_last_page
+from presence import count_online
+from preview_pool import get_pool as get_preview_pool
+from reader_progress import completion_dict, last_pages, start_progress
+from sid_alias import record_sid_alias, sid_and_aliases
+from source_cache import content_hash, get_sources
+from user_counts import count_users
 
 logger = logging.getLogger(settings.logger)
 logger.setLevel(settings.log_level)
@@ -30,6 +36,27 @@ EVENT_TABLE = {
     "parsonsprob": "parsons_answers",
 }
 
+# The most events ``hsblog_batch`` accepts in one request.
+HSBLOG_BATCH_MAX = 200
+# The most questions ``getPageAssessResults`` accepts in one request.
+PAGE_ASSESS_MAX = 200
+# For each type of question whose answers can be restored, the answer table and the fields read from it.
+ASSESS_FIELDS = {
+    "fillb": ("fitb_answers", ["answer", "timestamp"]),
+    "mChoice": ("mchoice_answers", ["answer", "timestamp", "correct"]),
+    "dragNdrop": ("dragndrop_answers", ["answer", "timestamp", "correct", "minHeight"]),
+    "clickableArea": ("clickablearea_answers", ["answer", "timestamp", "correct"]),
+    "timedExam": (
+        "timed_exam",
+        ["correct", "incorrect", "skipped", "time_taken", "timestamp", "reset"],
+    ),
+    "parsons": ("parsons_answers", ["answer", "source", "timestamp"]),
+    "shortanswer": ("shortanswer_answers", ["answer", "timestamp"]),
+    "lp_build": ("lp_answers", ["answer", "timestamp", "correct"]),
+}
+# The default number of students per page of an instructor's list of student answers.
+STUDENT_RESULTS_PAGE_SIZE = 50
+
 
 def compareAndUpdateCookieData(sid: str):
     if (
@@ -37,9 +64,8 @@ def compareAndUpdateCookieData(sid: str):
         and request.cookies["ipuser"].value != sid
         and request.cookies["ipuser"].value.endswith("@" + request.client)
     ):
-        db.useinfo.update_or_insert(
-            db.useinfo.sid == request.cookies["ipuser"].value, sid=sid
-        )
+        # The anonymous history is merged later; see ``modules/sid_alias.py``.
+        record_sid_alias(db, request.cookies["ipuser"].value, sid)
 
 
 def hsblog():
@@ -59,34 +85,190 @@ def hsblog():
         else:
             sid = str(uuid.uuid1().int) + "@" + request.client
             setCookie = True
-    act = request.vars.get("act", "")
-    div_id = request.vars.div_id
-    event = request.vars.event
-    course = request.vars.course
     # Get the current time, rounded to the nearest second -- this is how time time will be stored in the database.
     ts = datetime.datetime.utcnow()
     ts -= datetime.timedelta(microseconds=ts.microsecond)
-    tt = request.vars.time
-    if not tt:
-        tt = 0
 
+    res, inserts = _hsblog_event(request.vars, sid, ts)
+    for tablename, fields in inserts:
+        if tablename == "useinfo":
+            _log_event_useinfo([fields])
+        else:
+            _insert_answers(tablename, [fields])
+
+    response.headers["content-type"] = "application/json"
+    if setCookie:
+        response.cookies["ipuser"] = sid
+        response.cookies["ipuser"]["expires"] = 24 * 3600 * 90
+        response.cookies["ipuser"]["path"] = "/"
+    return json.dumps(res)
+
+
+# Accept a list of ``hsblog`` events in one request, so a client can flush a queue of interactions at once. The ``events`` parameter is a JSON array, oldest event first; each element is a dict holding the parameters ``hsblog`` takes. The rows for each table are written with one ``INSERT``. Returns a list with the ``hsblog`` result for each event, in order.
+def hsblog_batch():
+    response.headers["content-type"] = "application/json"
     try:
-        db.useinfo.insert(
-            sid=sid,
-            act=act[0:512],
-            div_id=div_id,
-            event=event,
-            timestamp=ts,
-            course_id=course,
+        events = json.loads(request.vars.events or "[]")
+    except ValueError:
+        events = None
+    if not isinstance(events, list) or not all(isinstance(ev, dict) for ev in events):
+        return json.dumps(dict(log=False, errors=["events must be a JSON list"]))
+    if len(events) > HSBLOG_BATCH_MAX:
+        return json.dumps(
+            dict(
+                log=False,
+                errors=["at most {} events per request".format(HSBLOG_BATCH_MAX)],
+            )
         )
+
+    if auth.user:
+        sid = auth.user.username
+        compareAndUpdateCookieData(sid)
+    elif "ipuser" in request.cookies:
+        sid = request.cookies["ipuser"].value
+    else:
+        sid = str(uuid.uuid1().int) + "@" + request.client
+    ts = datetime.datetime.utcnow()
+    ts -= datetime.timedelta(microseconds=ts.microsecond)
+    # An event which can't be processed gets an error in its place in the results; the others are still saved.
+    results = []
+    for ev in events:
+        errors = _batch_event_errors(ev)
+        results.append(dict(log=False, errors=errors) if errors else None)
+
+    # Answers are graded in order of their timestamps, which are stored to the second. So, events for the same question get increasing timestamps, a second apart and ending now.
+    remaining = {}
+    for i, ev in enumerate(events):
+        if results[i] is None:
+            remaining[ev["div_id"]] = remaining.get(ev["div_id"], 0) + 1
+
+    grouped = {}
+    for i, ev in enumerate(events):
+        if results[i] is not None:
+            continue
+        remaining[ev["div_id"]] -= 1
+        ev_ts = ts - datetime.timedelta(seconds=remaining[ev["div_id"]])
+        try:
+            with savepoint(db):
+                res, inserts = _hsblog_event(Storage(ev), sid, ev_ts)
+        except Exception as e:
+            logger.error(
+                "failed to process {} event for {} in {} : {}".format(
+                    ev["event"], sid, ev["div_id"], e
+                )
+            )
+            results[i] = dict(log=False, errors=["the event could not be saved"])
+            continue
+        results[i] = res
+        for tablename, fields in inserts:
+            grouped.setdefault(tablename, []).append((i, fields))
+
+    # Write the answers first, so a failure doesn't leave log entries for answers which weren't saved.
+    useinfo_rows = grouped.pop("useinfo", [])
+    failed = set()
+    for tablename, rows in grouped.items():
+        failed |= _insert_batch_answers(tablename, rows)
+    for i in failed:
+        results[i] = dict(log=False, errors=["the answer could not be saved"])
+    _log_event_useinfo([fields for i, fields in useinfo_rows if i not in failed])
+
+    response.cookies["ipuser"] = sid
+    response.cookies["ipuser"]["expires"] = 24 * 3600 * 90
+    response.cookies["ipuser"]["path"] = "/"
+    return json.dumps(results)
+
+
+# Save ``rows``, a list of dicts, in the answer table ``tablename``, then update the stats kept for that table.
+def _insert_answers(tablename, rows):
+    if len(rows) == 1:
+        db[tablename].insert(**rows[0])
+    else:
+        multirow_insert(db, db[tablename], rows)
+    record_answer_rows(db, tablename, rows)
+
+
+# Check ``ev``, one event of a batch, converting its numbers to the strings ``hsblog`` would receive and dropping its nulls. Returns a list of errors, which is empty if the event can be processed.
+def _batch_event_errors(ev):
+    errors = []
+    for key, value in list(ev.items()):
+        if value is None:
+            del ev[key]
+        elif isinstance(value, (bool, int, float)):
+            ev[key] = json.dumps(value)
+        elif not isinstance(value, str):
+            errors.append("{} must be a string".format(key))
+    for key in ("event", "div_id"):
+        if ev.get(key) in (None, ""):
+            errors.append("{} is required".format(key))
+    return errors
+
+
+# Save the answers in ``rows``, a list of ``(index, fields)`` pairs, in the answer table ``tablename``. If they can't be saved together, each is tried on its own. Returns the set of indexes of the answers which couldn't be saved.
+def _insert_batch_answers(tablename, rows):
+    try:
+        with savepoint(db):
+            _insert_answers(tablename, [fields for i, fields in rows])
+        return set()
     except Exception as e:
-        logger.error(
-            "failed to insert log record for {} in {} : {} {} {}".format(
-                sid, course, div_id, event, act
+        logger.error("failed to insert {} rows: {}".format(tablename, e))
+
+    failed = set()
+    for i, fields in rows:
+        try:
+            with savepoint(db):
+                _insert_answers(tablename, [fields])
+        except Exception as e:
+            logger.error(
+                "failed to insert {} row for {} in {} : {}".format(
+                    tablename, fields["sid"], fields["div_id"], e
+                )
+            )
+            failed.add(i)
+    return failed
+
+
+def _log_event_useinfo(rows):
+    try:
+        with savepoint(db):
+            log_useinfo_rows(rows)
+    except Exception as e:
+        for row in rows:
+            logger.error(
+                "failed to insert log record for {} in {} : {} {} {}".format(
+                    row["sid"],
+                    row["course_id"],
+                    row["div_id"],
+                    row["event"],
+                    row["act"],
+                )
             )
-        )
         logger.error("Details: {}".format(e))
 
+
+# Process one ``hsblog`` event, given its parameters in ``vars``. Returns the result to send to the client and a list of ``(tablename, fields)`` rows for the caller to insert. Answers which need their own query (short answers are updated in place; literate programming builds are validated and graded) are written here.
+def _hsblog_event(vars, sid, ts):
+    act = vars.get("act", "")
+    div_id = vars.div_id
+    event = vars.event
+    course = vars.course
+    tt = vars.time
+    if not tt:
+        tt = 0
+
+    inserts = [
+        (
+            "useinfo",
+            dict(
+                sid=sid,
+                act=act[0:512],
+                div_id=div_id,
+                event=event,
+                timestamp=ts,
+                course_id=course,
+            ),
+        )
+    ]
+
     if event == "timedExam" and (act == "finish" or act == "reset"):
         logger.debug(act)
         if act == "reset":
@@ -95,16 +277,21 @@ def hsblog():
             r = None
 
         try:
-            db.timed_exam.insert(
-                sid=sid,
-                course_name=course,
-                correct=int(request.vars.correct),
-                incorrect=int(request.vars.incorrect),
-                skipped=int(request.vars.skipped),
-                time_taken=int(tt),
-                timestamp=ts,
-                div_id=div_id,
-                reset=r,
+            inserts.append(
+                (
+                    "timed_exam",
+                    dict(
+                        sid=sid,
+                        course_name=course,
+                        correct=int(vars.correct),
+                        incorrect=int(vars.incorrect),
+                        skipped=int(vars.skipped),
+                        time_taken=int(tt),
+                        timestamp=ts,
+                        div_id=div_id,
+                        reset=r,
+                    ),
+                )
             )
         except Exception as e:
             logger.debug(
@@ -114,13 +301,10 @@ def hsblog():
             )
             logger.debug(
                 "correct {} incorrect {} skipped {} time {}".format(
-                    request.vars.correct,
-                    request.vars.incorrect,
-                    request.vars.skipped,
-                    request.vars.time,
+                    vars.correct, vars.incorrect, vars.skipped, vars.time
                 )
             )
-            logger.debug("Error: {}".format(e.message))
+            logger.debug("Error: {}".format(e))
 
     # Produce a default result.
     res = dict(log=True, timestamp=str(ts))
@@ -132,19 +316,24 @@ def hsblog():
         #       (db.mchoice_answers.div_id == div_id) &
         #       (db.mchoice_answers.course_name == auth.user.course_name) &
         #       (db.mchoice_answers.correct == 'T')).count() == 0:
-        answer = request.vars.answer
-        correct = request.vars.correct
-        db.mchoice_answers.insert(
-            sid=sid,
-            timestamp=ts,
-            div_id=div_id,
-            answer=answer,
-            correct=correct,
-            course_name=course,
+        answer = vars.answer
+        correct = vars.correct
+        inserts.append(
+            (
+                "mchoice_answers",
+                dict(
+                    sid=sid,
+                    timestamp=ts,
+                    div_id=div_id,
+                    answer=answer,
+                    correct=correct,
+                    course_name=course,
+                ),
+            )
         )
     elif event == "fillb" and auth.user:
-        answer_json = request.vars.answer
-        correct = request.vars.correct
+        answer_json = vars.answer
+        correct = vars.correct
         # Grade on the server if needed.
         do_server_feedback, feedback = is_server_feedback(div_id, course)
         if do_server_feedback:
@@ -152,13 +341,18 @@ def hsblog():
             res.update(res_update)
 
         # Save this data.
-        db.fitb_answers.insert(
-            sid=sid,
-            timestamp=ts,
-            div_id=div_id,
-            answer=answer_json,
-            correct=correct,
-            course_name=course,
+        inserts.append(
+            (
+                "fitb_answers",
+                dict(
+                    sid=sid,
+                    timestamp=ts,
+                    div_id=div_id,
+                    answer=answer_json,
+                    correct=correct,
+                    course_name=course,
+                ),
+            )
         )
 
     elif event == "dragNdrop" and auth.user:
@@ -166,32 +360,42 @@ def hsblog():
         #       (db.dragndrop_answers.div_id == div_id) &
         #       (db.dragndrop_answers.course_name == auth.user.course_name) &
         #       (db.dragndrop_answers.correct == 'T')).count() == 0:
-        answers = request.vars.answer
-        minHeight = request.vars.minHeight
-        correct = request.vars.correct
-
-        db.dragndrop_answers.insert(
-            sid=sid,
-            timestamp=ts,
-            div_id=div_id,
-            answer=answers,
-            correct=correct,
-            course_name=course,
-            minHeight=minHeight,
+        answers = vars.answer
+        minHeight = vars.minHeight
+        correct = vars.correct
+
+        inserts.append(
+            (
+                "dragndrop_answers",
+                dict(
+                    sid=sid,
+                    timestamp=ts,
+                    div_id=div_id,
+                    answer=answers,
+                    correct=correct,
+                    course_name=course,
+                    minHeight=minHeight,
+                ),
+            )
         )
     elif event == "clickableArea" and auth.user:
         # if db((db.clickablearea_answers.sid == sid) &
         #       (db.clickablearea_answers.div_id == div_id) &
         #       (db.clickablearea_answers.course_name == auth.user.course_name) &
         #       (db.clickablearea_answers.correct == 'T')).count() == 0:
-        correct = request.vars.correct
-        db.clickablearea_answers.insert(
-            sid=sid,
-            timestamp=ts,
-            div_id=div_id,
-            answer=act,
-            correct=correct,
-            course_name=course,
+        correct = vars.correct
+        inserts.append(
+            (
+                "clickablearea_answers",
+                dict(
+                    sid=sid,
+                    timestamp=ts,
+                    div_id=div_id,
+                    answer=act,
+                    correct=correct,
+                    course_name=course,
+                ),
+            )
         )
 
     elif event == "parsons" and auth.user:
@@ -199,17 +403,22 @@ def hsblog():
         #       (db.parsons_answers.div_id == div_id) &
         #       (db.parsons_answers.course_name == auth.user.course_name) &
         #       (db.parsons_answers.correct == 'T')).count() == 0:
-        correct = request.vars.correct
-        answer = request.vars.answer
-        source = request.vars.source
-        db.parsons_answers.insert(
-            sid=sid,
-            timestamp=ts,
-            div_id=div_id,
-            answer=answer,
-            source=source,
-            correct=correct,
-            course_name=course,
+        correct = vars.correct
+        answer = vars.answer
+        source = vars.source
+        inserts.append(
+            (
+                "parsons_answers",
+                dict(
+                    sid=sid,
+                    timestamp=ts,
+                    div_id=div_id,
+                    answer=answer,
+                    source=source,
+                    correct=correct,
+                    course_name=course,
+                ),
+            )
         )
 
     elif event == "codelensq" and auth.user:
@@ -217,17 +426,22 @@ def hsblog():
         #       (db.codelens_answers.div_id == div_id) &
         #       (db.codelens_answers.course_name == auth.user.course_name) &
         #       (db.codelens_answers.correct == 'T')).count() == 0:
-        correct = request.vars.correct
-        answer = request.vars.answer
-        source = request.vars.source
-        db.codelens_answers.insert(
-            sid=sid,
-            timestamp=ts,
-            div_id=div_id,
-            answer=answer,
-            source=source,
-            correct=correct,
-            course_name=course,
+        correct = vars.correct
+        answer = vars.answer
+        source = vars.source
+        inserts.append(
+            (
+                "codelens_answers",
+                dict(
+                    sid=sid,
+                    timestamp=ts,
+                    div_id=div_id,
+                    answer=answer,
+                    source=source,
+                    correct=correct,
+                    course_name=course,
+                ),
+            )
         )
 
     elif event == "shortanswer" and auth.user:
@@ -251,7 +465,7 @@ def hsblog():
             do_server_feedback, feedback = is_server_feedback(div_id, course)
             if do_server_feedback:
                 try:
-                    code_snippets = json.loads(request.vars.answer)["code_snippets"]
+                    code_snippets = json.loads(vars.answer)["code_snippets"]
                 except Exception:
                     code_snippets = []
                 result = lp_feedback(code_snippets, feedback)
@@ -277,12 +491,7 @@ def hsblog():
         else:
             res.setdefault("errors", []).append(ret.errors.as_dict())
 
-    response.headers["content-type"] = "application/json"
-    if setCookie:
-        response.cookies["ipuser"] = sid
-        response.cookies["ipuser"]["expires"] = 24 * 3600 * 90
-        response.cookies["ipuser"]["path"] = "/"
-    return json.dumps(res)
+    return res, inserts
 
 
 def runlog():  # Log errors and runs with code
@@ -318,7 +527,7 @@ def runlog():  # Log errors and runs with code
     done = False
     while num_tries > 0 and not done:
         try:
-            db.useinfo.insert(
+            log_useinfo(
                 sid=sid,
                 act=act,
                 div_id=div_id,
@@ -366,7 +575,7 @@ def runlog():  # Log errors and runs with code
             dbcourse = db(db.courses.course_name == course).select().first()
             while num_tries > 0 and not done:
                 try:
-                    db.code.insert(
+                    save_code(
                         sid=sid,
                         acid=div_id,
                         code=code,
@@ -390,7 +599,7 @@ def runlog():  # Log errors and runs with code
                                 "{} This code was shared by {}\n\n".format(comchar, sid)
                                 + code
                             )
-                            db.code.insert(
+                            save_code(
                                 sid=request.vars.partner,
                                 acid=div_id,
                                 code=newcode,
@@ -429,13 +638,82 @@ def gethist():
     :Parameters:
         - `acid`: id of the active code block
         - `user`: optional identifier for the owner of the code
+        - `index`: if ``true``, return only the id and timestamp of each version; fetch a version with ``gethistversion``
     :Return:
         - json object containing a list/array of source texts
     """
     codetbl = db.code
     acid = request.vars.acid
+    sid, course_id = _histOwner()
+
+    res = {}
+    if sid:
+        query = _histQuery(sid, acid, course_id)
+        res["acid"] = acid
+        res["sid"] = sid
+        # get the code they saved in chronological order; id order gets that for us
+        if request.vars.index == "true":
+            r = db(query).select(codetbl.id, codetbl.timestamp, orderby=codetbl.id)
+            res["versions"] = [row.id for row in r]
+        else:
+            r = resolve_code(db, db(query).select(orderby=codetbl.id))
+            res["history"] = [row.code for row in r]
+        res["timestamps"] = [row.timestamp.isoformat() for row in r]
+
+    response.headers["content-type"] = "application/json"
+    return json.dumps(res)
+
+
+def gethistversion():
+    """
+    return one saved version of a program, as listed by ``gethist`` with ``index=true``
+    :Parameters:
+        - `acid`: id of the active code block
+        - `sid`: optional identifier for the owner of the code
+        - `version`: the id of the version
+        - `diff`: if ``true``, return a unified diff from the previous version instead of the source
+    :Return:
+        - json object containing the source text or diff
+    """
+    codetbl = db.code
+    acid = request.vars.acid
+    version = request.vars.version
+    sid, course_id = _histOwner()
+
+    res = {}
+    if sid and version and version.isdigit():
+        query = _histQuery(sid, acid, course_id)
+        row = db(query & (codetbl.id == int(version))).select().first()
+        if row:
+            resolve_code(db, [row])
+            res["acid"] = acid
+            res["sid"] = sid
+            res["version"] = row.id
+            res["timestamp"] = row.timestamp.isoformat()
+            if request.vars.diff == "true":
+                previous = (
+                    db(query & (codetbl.id < row.id))
+                    .select(orderby=~codetbl.id, limitby=(0, 1))
+                    .first()
+                )
+                if previous:
+                    resolve_code(db, [previous])
+                res["previous"] = previous.id if previous else None
+                res["diff"] = "".join(
+                    difflib.unified_diff(
+                        (previous.code or "").splitlines(True) if previous else [],
+                        (row.code or "").splitlines(True),
+                    )
+                )
+            else:
+                res["source"] = row.code
+
+    response.headers["content-type"] = "application/json"
+    return json.dumps(res)
 
-    # if vars.sid then we know this is being called from the grading interface
+
+# Return ``(sid, course_id)``, whose history ``gethist`` and ``gethistversion`` may return. If ``request.vars.sid`` is given, this is being called from the grading interface.
+def _histOwner():
     if request.vars.sid:
         sid = request.vars.sid
         if auth.user and verifyInstructorStatus(
@@ -450,24 +728,17 @@ def gethist():
     else:
         sid = None
         course_id = None
+    return sid, course_id
 
-    res = {}
-    if sid:
-        query = (
-            (codetbl.sid == sid)
-            & (codetbl.acid == acid)
-            & (codetbl.course_id == course_id)
-            & (codetbl.timestamp != None)  # noqa: E711
-        )
-        res["acid"] = acid
-        res["sid"] = sid
-        # get the code they saved in chronological order; id order gets that for us
-        r = db(query).select(orderby=codetbl.id)
-        res["history"] = [row.code for row in r]
-        res["timestamps"] = [row.timestamp.isoformat() for row in r]
 
-    response.headers["content-type"] = "application/json"
-    return json.dumps(res)
+def _histQuery(sid, acid, course_id):
+    codetbl = db.code
+    return (
+        (codetbl.sid == sid)
+        & (codetbl.acid == acid)
+        & (codetbl.course_id == course_id)
+        & (codetbl.timestamp != None)  # noqa: E711
+    )
 
 
 def getprog():
@@ -479,33 +750,19 @@ def getprog():
     :Return:
         - json object containing the source text
     """
-    codetbl = db.code
     acid = request.vars.acid
     sid = request.vars.sid
-
-    if sid:
-        query = (
-            (codetbl.sid == sid)
-            & (codetbl.acid == acid)
-            & (codetbl.timestamp != None)  # noqa: E711
-        )
+    if not sid and auth.user:
+        owner = auth.user.username
     else:
-        if auth.user:
-            query = (
-                (codetbl.sid == auth.user.username)
-                & (codetbl.acid == acid)
-                & (codetbl.timestamp != None)  # noqa: E711
-            )
-        else:
-            query = None
+        owner = sid
 
     res = {}
-    if query:
-        result = db(query)
+    if owner:
         res["acid"] = acid
-        if not result.isempty():
-            # get the last code they saved; id order gets that for us
-            r = result.select(orderby=codetbl.id).last().code
+        # get the last code they saved; see ``modules/code_store.py``
+        r = latest_code(db, owner, acid)
+        if r is not None:
             res["source"] = r
             if sid:
                 res["sid"] = sid
@@ -566,26 +823,38 @@ def getnumonline():
     response.headers["content-type"] = "application/json"
 
     try:
-        query = """select count(distinct sid) from useinfo where timestamp > current_timestamp - interval '5 minutes'  """
-        rows = db.executesql(query)
+        online = count_online(db, cache=(cache.ram, 15))
     except Exception:
-        rows = [[21]]
+        online = 21
 
-    res = {"online": rows[0][0]}
+    res = {"online": online}
     return json.dumps([res])
 
 
-def getnumusers():
+# Like ``getnumonline``, but only counting readers active in ``course``.
+def getnumonlinecourse():
     response.headers["content-type"] = "application/json"
+    course = request.vars.course or (auth.user and auth.user.course_name)
+    if not course:
+        return json.dumps([{"online": 0}])
 
-    # query = """select count(*) from (select distinct(sid) from useinfo) as X """
-    numusers = "more than 850,000"
+    try:
+        online = count_online(db, course, cache=(cache.ram, 15))
+    except Exception:
+        online = 0
+
+    res = {"online": online, "course": course}
+    return json.dumps([res])
 
-    # try:
-    #     numusers = cache.disk('numusers', lambda: db.executesql(query)[0][0], time_expire=21600)
-    # except:
-    #     # sometimes the DB query takes too long and is timed out - return something anyway
-    #     numusers = 'more than 250,000'
+
+def getnumusers():
+    response.headers["content-type"] = "application/json"
+
+    # The count comes from ``user_first_seen``, which ``rsmanage rollupusers`` keeps up to date, or from ``useinfo`` until it has run.
+    try:
+        numusers = count_users(db, cache=(cache.ram, 3600))
+    except Exception:
+        numusers = "more than 850,000"
 
     res = {"numusers": numusers}
     return json.dumps([res])
@@ -621,49 +890,47 @@ def updatelastpage():
     lastPageChapter = lastPageUrl.split("/")[-2]
     lastPageSubchapter = ".".join(lastPageUrl.split("/")[-1].split(".")[:-1])
     if auth.user:
-        done = False
-        num_tries = 3
-        while not done and num_tries > 0:
-            try:
-                db(
-                    (db.user_state.user_id == auth.user.id)
-                    & (db.user_state.course_id == course)
-                ).update(
-                    last_page_url=lastPageUrl,
-                    last_page_chapter=lastPageChapter,
-                    last_page_subchapter=lastPageSubchapter,
-                    last_page_scroll_location=lastPageScrollLocation,
-                    last_page_accessed_on=datetime.datetime.utcnow(),
-                )
-                done = True
-            except Exception:
-                num_tries -= 1
-        if num_tries == 0:
-            raise Exception("Failed to save the user state in update_last_page")
-
-        done = False
-        num_tries = 3
-        while not done and num_tries > 0:
-            try:
-                db(
-                    (db.user_sub_chapter_progress.user_id == auth.user.id)
-                    & (db.user_sub_chapter_progress.chapter_id == lastPageChapter)
-                    & (
-                        db.user_sub_chapter_progress.sub_chapter_id
-                        == lastPageSubchapter
-                    )
-                ).update(status=completionFlag, end_date=datetime.datetime.utcnow())
-                done = True
-            except Exception:
-                num_tries -= 1
-        if num_tries == 0:
-            raise Exception("Failed to save sub chapter progress in update_last_page")
-
-        practice_settings = db(db.course_practice.course_name == auth.user.course_name)
-        if (
-            practice_settings.count() != 0
-            and practice_settings.select().first().flashcard_creation_method == 0
-        ):
+        save_last_page(
+            db,
+            auth.user.id,
+            course,
+            dict(
+                last_page_url=lastPageUrl,
+                last_page_chapter=lastPageChapter,
+                last_page_subchapter=lastPageSubchapter,
+                last_page_scroll_location=lastPageScrollLocation,
+                last_page_accessed_on=datetime.datetime.utcnow(),
+            ),
+            settings.last_page_write_interval,
+            settings.database_uri,
+        )
+
+        # Only a change in the completion status needs to be saved, or can change the flashcards.
+        progress = db.user_sub_chapter_progress
+        if completionFlag is None:
+            status_changed = progress.status != None  # noqa: E711
+        else:
+            status_changed = (progress.status != completionFlag) | (
+                progress.status == None  # noqa: E711
+            )
+        if not db(
+            (progress.user_id == auth.user.id)
+            & (progress.chapter_id == lastPageChapter)
+            & (progress.sub_chapter_id == lastPageSubchapter)
+            & status_changed
+        ).update(status=completionFlag, end_date=datetime.datetime.utcnow()):
+            return
+
+        practice_settings = (
+            db(db.course_practice.course_name == auth.user.course_name)
+            .select(
+                db.course_practice.flashcard_creation_method,
+                cache=(cache.ram, 300),
+                cacheable=True,
+            )
+            .first()
+        )
+        if practice_settings and practice_settings.flashcard_creation_method == 0:
             # Since each authenticated user has only one active course, we retrieve the course this way.
             course = db(db.courses.id == auth.user.course_id).select().first()
 
@@ -730,24 +997,18 @@ def getCompletionStatus():
         else:
             # haven't seen this Chapter/Subchapter before
             # make the insertions into the DB as necessary
-
-            # we know the subchapter doesn't exist
-            db.user_sub_chapter_progress.insert(
-                user_id=auth.user.id,
-                chapter_id=lastPageChapter,
-                sub_chapter_id=lastPageSubchapter,
-                status=-1,
-                start_date=datetime.datetime.utcnow(),
+            course = (
+                db(db.courses.id == auth.user.course_id)
+                .select(db.courses.base_course)
+                .first()
+            )
+            start_progress(
+                db,
+                auth.user.id,
+                course.base_course,
+                lastPageChapter,
+                lastPageSubchapter,
             )
-            # the chapter might exist without the subchapter
-            result = db(
-                (db.user_chapter_progress.user_id == auth.user.id)
-                & (db.user_chapter_progress.chapter_id == lastPageChapter)
-            ).select()
-            if not result:
-                db.user_chapter_progress.insert(
-                    user_id=auth.user.id, chapter_id=lastPageChapter, status=-1
-                )
             return json.dumps([{"completionStatus": -1}])
 
 
@@ -757,24 +1018,10 @@ def getAllCompletionStatus():
             db.user_sub_chapter_progress.chapter_id,
             db.user_sub_chapter_progress.sub_chapter_id,
             db.user_sub_chapter_progress.status,
-            db.user_sub_chapter_progress.status,
             db.user_sub_chapter_progress.end_date,
         )
-        rowarray_list = []
         if result:
-            for row in result:
-                if row.end_date is None:
-                    endDate = 0
-                else:
-                    endDate = row.end_date.strftime("%d %b, %Y")
-                res = {
-                    "chapterName": row.chapter_id,
-                    "subChapterName": row.sub_chapter_id,
-                    "completionStatus": row.status,
-                    "endDate": endDate,
-                }
-                rowarray_list.append(res)
-            return json.dumps(rowarray_list)
+            return json.dumps([completion_dict(row) for row in result])
 
 
 @auth.requires_login()
@@ -782,95 +1029,44 @@ def getlastpage():
     course = request.vars.course
     course = db(db.courses.course_name == course).select().first()
 
-    result = db(
-        (db.user_state.user_id == auth.user.id)
-        & (db.user_state.course_id == course.course_name)
-        & (db.chapters.course_id == course.base_course)
-        & (db.user_state.last_page_chapter == db.chapters.chapter_label)
-        & (db.sub_chapters.chapter_id == db.chapters.id)
-        & (db.user_state.last_page_subchapter == db.sub_chapters.sub_chapter_label)
-    ).select(
-        db.user_state.last_page_url,
-        db.user_state.last_page_hash,
-        db.chapters.chapter_name,
-        db.user_state.last_page_scroll_location,
-        db.sub_chapters.sub_chapter_name,
-    )
-    rowarray_list = []
-    if result:
-        for row in result:
-            res = {
-                "lastPageUrl": row.user_state.last_page_url,
-                "lastPageHash": row.user_state.last_page_hash,
-                "lastPageChapter": row.chapters.chapter_name,
-                "lastPageSubchapter": row.sub_chapters.sub_chapter_name,
-                "lastPageScrollLocation": row.user_state.last_page_scroll_location,
-            }
-            rowarray_list.append(res)
+    rowarray_list = last_pages(db, auth.user.id, course)
+    if rowarray_list:
         return json.dumps(rowarray_list)
     else:
         db.user_state.insert(user_id=auth.user.id, course_id=course.course_name)
 
 
 def _getCorrectStats(miscdata, event):
-    # TODO: update this to use the xxx_answer table
-    # select and count grouping by the correct column
-    # this version can suffer from division by zero error
     sid = None
-    dbtable = EVENT_TABLE[event]  # translate event to correct table
-
     if auth.user:
         sid = auth.user.username
     else:
         if "ipuser" in request.cookies:
             sid = request.cookies["ipuser"].value
 
+    pctcorr = "unavailable"
     if sid:
-        course = db(db.courses.course_name == miscdata["course"]).select().first()
-        tbl = db[dbtable]
-
-        count_expr = tbl.correct.count()
-        rows = db((tbl.sid == sid) & (tbl.timestamp > course.term_start_date)).select(
-            tbl.correct, count_expr, groupby=tbl.correct
-        )
-        total = 0
-        correct = 0
-        for row in rows:
-            count = row[count_expr]
-            total += count
-            if row[dbtable].correct:
-                correct = count
+        total, correct = user_answer_counts(db, miscdata["course"], sid, event)
         if total > 0:
             pctcorr = round(float(correct) / total * 100)
-        else:
-            pctcorr = "unavailable"
-    else:
-        pctcorr = "unavailable"
 
     miscdata["yourpct"] = pctcorr
 
 
-def _getStudentResults(question: str):
+def _getStudentResults(tbl, query, page=None, page_size=None):
     """
-    Internal function to collect student answers
+    Internal function to collect student answers, given the answer table and query from ``_studentResultsQuery``. If ``page`` is given, return only the ``page_size`` students on that page, counting from 0.
     """
-    cc = db(db.courses.id == auth.user.course_id).select().first()
-    qst = (
-        db(
-            (db.questions.name == question)
-            & (db.questions.base_course == cc.base_course)
+    if page is not None:
+        sids = db(query).select(
+            tbl.sid,
+            distinct=True,
+            orderby=tbl.sid,
+            limitby=(page * page_size, (page + 1) * page_size),
         )
-        .select()
-        .first()
-    )
-    tbl_name = EVENT_TABLE[qst.question_type]
-    tbl = db[tbl_name]
+        query &= tbl.sid.belongs([row.sid for row in sids])
 
-    res = db(
-        (tbl.div_id == question)
-        & (tbl.course_name == cc.course_name)
-        & (tbl.timestamp >= cc.term_start_date)
-    ).select(tbl.sid, tbl.answer, orderby=tbl.sid)
+    res = db(query).select(tbl.sid, tbl.answer, orderby=tbl.sid)
 
     resultList = []
     if len(res) > 0:
@@ -898,10 +1094,50 @@ def _getStudentResults(question: str):
     return resultList
 
 
+# Return the answer table for ``question`` and a query for this course's answers to it this term.
+def _studentResultsQuery(question):
+    cc = db(db.courses.id == auth.user.course_id).select().first()
+    qst = (
+        db(
+            (db.questions.name == question)
+            & (db.questions.base_course == cc.base_course)
+        )
+        .select()
+        .first()
+    )
+    tbl_name = EVENT_TABLE[qst.question_type]
+    tbl = db[tbl_name]
+
+    query = (
+        (tbl.div_id == question)
+        & (tbl.course_name == cc.course_name)
+        & (tbl.timestamp >= cc.term_start_date)
+    )
+    return tbl, query
+
+
+# Add the list of student answers to ``question`` to ``res``, an instructor's results. Given a ``page`` parameter (counting from 0), list only ``page_size`` students, and give the total number of students in ``reslist_students``. Invalid paging parameters give an ``emess`` instead of the list.
+def _addStudentResults(res, question):
+    tbl, query = _studentResultsQuery(question)
+    if request.vars.page is None:
+        res["reslist"] = _getStudentResults(tbl, query)
+        return
+
+    try:
+        page = int(request.vars.page)
+        page_size = int(request.vars.page_size or STUDENT_RESULTS_PAGE_SIZE)
+    except (TypeError, ValueError):
+        page = page_size = None
+    if page is None or page < 0 or page_size < 1:
+        res["emess"] = "page must be a whole number and page_size a positive one"
+        return
+    res["reslist"] = _getStudentResults(tbl, query, page, page_size)
+    res["reslist_students"] = db(query).count(distinct=tbl.sid)
+
+
 def getaggregateresults():
     course = request.vars.course
     question = request.vars.div_id
-    # select act, count(*) from useinfo where div_id = 'question4_2_1' group by act;
     response.headers["content-type"] = "application/json"
 
     if not auth.user:
@@ -910,7 +1146,7 @@ def getaggregateresults():
     is_instructor = verifyInstructorStatus(course, auth.user.id)  # noqa: F405
     # Yes, these two things could be done as a join.  but this **may** be better for performance
     if course == "thinkcspy" or course == "pythonds":
-        start_date = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+        start_date = (datetime.datetime.utcnow() - datetime.timedelta(days=90)).date()
     else:
         start_date = (
             db(db.courses.course_name == course)
@@ -918,13 +1154,17 @@ def getaggregateresults():
             .first()
             .term_start_date
         )
-    count = db.useinfo.id.count()
+    # The answer counts are kept up to date as answers are logged; see ``modules/answer_stats.py``.
+    stats = db.question_answer_stats
+    count = stats.answer_count.sum()
     try:
         result = db(
-            (db.useinfo.div_id == question)
-            & (db.useinfo.course_id == course)
-            & (db.useinfo.timestamp >= start_date)
-        ).select(db.useinfo.act, count, groupby=db.useinfo.act)
+            (stats.course_name == course)
+            & (stats.div_id == question)
+            & (stats.day >= start_date)
+        ).select(
+            stats.answer, stats.correct, count, groupby=stats.answer | stats.correct
+        )
     except Exception:
         return json.dumps(
             [dict(answerDict={}, misc={}, emess="Sorry, the request timed out")]
@@ -932,30 +1172,19 @@ def getaggregateresults():
 
     tdata = {}
     tot = 0
+    correct = ""
     for row in result:
-        tdata[clean(row.useinfo.act)] = row[count]
+        answer = clean(row.question_answer_stats.answer)
+        if row.question_answer_stats.correct:
+            correct = answer
+        tdata[answer] = tdata.get(answer, 0) + row[count]
         tot += row[count]
 
-    tot = float(tot)
     rdata = {}
     miscdata = {}
-    correct = ""
-    if tot > 0:
-        for key in tdata:
-            all_a = key.split(":")
-            try:
-                answer = all_a[1]
-                if "correct" in key:
-                    correct = answer
-                count = int(tdata[key])
-                if answer in rdata:
-                    count += rdata[answer] / 100.0 * tot
-                pct = round(count / tot * 100.0)
-
-                if answer != "undefined" and answer != "":
-                    rdata[answer] = pct
-            except Exception as e:
-                logger.error("Bad data for %s data is %s -- %s" % (question, key, e))
+    for answer, answer_count in tdata.items():
+        if answer != "undefined" and answer != "":
+            rdata[answer] = round(answer_count / tot * 100.0)
 
     miscdata["correct"] = correct
     miscdata["course"] = course
@@ -965,8 +1194,7 @@ def getaggregateresults():
     returnDict = dict(answerDict=rdata, misc=miscdata)
 
     if auth.user and is_instructor:
-        resultList = _getStudentResults(question)
-        returnDict["reslist"] = resultList
+        _addStudentResults(returnDict, question)
 
     return json.dumps([returnDict])
 
@@ -977,25 +1205,20 @@ def getpollresults():
 
     response.headers["content-type"] = "application/json"
 
-    query = """select act from useinfo
-    join (select sid,  max(id) mid
-        from useinfo where event='poll' and div_id = '{}' and course_id = '{}' group by sid) as T
-        on id = T.mid""".format(
-        div_id, course
+    # The tallies are kept up to date as votes are logged; see ``modules/answer_stats.py``.
+    counts = db.poll_option_counts
+    vote_count = counts.vote_count.sum()
+    rows = db((counts.course_name == course) & (counts.div_id == div_id)).select(
+        counts.vote, vote_count, groupby=counts.vote
     )
 
-    rows = db.executesql(query)
-
-    result_list = []
-    for row in rows:
-        val = row[0].split(":")[0]
-        result_list.append(int(val))
-
     # maps option : count
-    opt_counts = Counter(result_list)
+    opt_counts = {row.poll_option_counts.vote: row[vote_count] for row in rows}
+    opt_counts = {vote: count for vote, count in opt_counts.items() if count > 0}
+    num_votes = sum(opt_counts.values())
 
-    if result_list:
-        for i in range(max(result_list)):
+    if opt_counts:
+        for i in range(max(opt_counts)):
             if i not in opt_counts:
                 opt_counts[i] = 0
     # opt_list holds the option numbers from smallest to largest
@@ -1009,11 +1232,11 @@ def getpollresults():
     if auth.user:
         user_res = (
             db(
-                (db.useinfo.sid == auth.user.username)
-                & (db.useinfo.course_id == course)
-                & (db.useinfo.div_id == div_id)
+                (db.poll_votes.sid.belongs(sid_and_aliases(db, auth.user.username)))
+                & (db.poll_votes.course_name == course)
+                & (db.poll_votes.div_id == div_id)
             )
-            .select(db.useinfo.act, orderby=~db.useinfo.id)
+            .select(db.poll_votes.act, orderby=~db.poll_votes.timestamp)
             .first()
         )
 
@@ -1022,45 +1245,32 @@ def getpollresults():
     else:
         my_vote = -1
 
-    return json.dumps([len(result_list), opt_list, count_list, div_id, my_vote])
+    return json.dumps([num_votes, opt_list, count_list, div_id, my_vote])
 
 
 def gettop10Answers():
     course = request.vars.course
     question = request.vars.div_id
     response.headers["content-type"] = "application/json"
-    rows = []
 
     try:
         dbcourse = db(db.courses.course_name == course).select().first()
-        count_expr = db.fitb_answers.answer.count()
-        rows = db(
-            (db.fitb_answers.div_id == question)
-            & (db.fitb_answers.course_name == course)
-            & (db.fitb_answers.timestamp > dbcourse.term_start_date)
-        ).select(
-            db.fitb_answers.answer,
-            count_expr,
-            groupby=db.fitb_answers.answer,
-            orderby=~count_expr,
-            limitby=(0, 10),
-        )
+        # The counts are kept up to date as answers are saved; see ``modules/answer_stats.py``.
         res = [
-            {"answer": clean(row.fitb_answers.answer), "count": row[count_expr]}
-            for row in rows
+            {"answer": clean(answer), "count": count}
+            for answer, count in top_fitb_answers(
+                db, course, question, dbcourse.term_start_date
+            )
         ]
     except Exception as e:
         logger.debug(e)
         res = "error in query"
 
     miscdata = {"course": course}
-    _getCorrectStats(
-        miscdata, "fillb"
-    )  # TODO: rewrite _getCorrectStats to use xxx_answers
+    _getCorrectStats(miscdata, "fillb")
 
     if auth.user and verifyInstructorStatus(course, auth.user.id):  # noqa: F405
-        resultList = _getStudentResults(question)
-        miscdata["reslist"] = resultList
+        _addStudentResults(miscdata, question)
 
     return json.dumps([res, miscdata])
 
@@ -1136,190 +1346,94 @@ def getAssessResults():
 
     response.headers["content-type"] = "application/json"
 
-    # Identify the correct event and query the database so we can load it from the server
-    if event == "fillb":
-        rows = (
-            db(
-                (db.fitb_answers.div_id == div_id)
-                & (db.fitb_answers.course_name == course)
-                & (db.fitb_answers.sid == sid)
-            )
-            .select(
-                db.fitb_answers.answer,
-                db.fitb_answers.timestamp,
-                orderby=~db.fitb_answers.id,
-            )
-            .first()
-        )
-        if not rows:
-            return ""  # server doesn't have it so we load from local storage instead
-        #
-        res = {"answer": rows.answer, "timestamp": str(rows.timestamp)}
-        do_server_feedback, feedback = is_server_feedback(div_id, course)
-        if do_server_feedback:
-            correct, res_update = fitb_feedback(rows.answer, feedback)
-            res.update(res_update)
-        return json.dumps(res)
-    elif event == "mChoice":
-        rows = (
-            db(
-                (db.mchoice_answers.div_id == div_id)
-                & (db.mchoice_answers.course_name == course)
-                & (db.mchoice_answers.sid == sid)
-            )
-            .select(
-                db.mchoice_answers.answer,
-                db.mchoice_answers.timestamp,
-                db.mchoice_answers.correct,
-                orderby=~db.mchoice_answers.id,
-            )
-            .first()
-        )
-        if not rows:
-            return ""
-        res = {
-            "answer": rows.answer,
-            "timestamp": str(rows.timestamp),
-            "correct": rows.correct,
-        }
-        return json.dumps(res)
-    elif event == "dragNdrop":
-        rows = (
-            db(
-                (db.dragndrop_answers.div_id == div_id)
-                & (db.dragndrop_answers.course_name == course)
-                & (db.dragndrop_answers.sid == sid)
-            )
-            .select(
-                db.dragndrop_answers.answer,
-                db.dragndrop_answers.timestamp,
-                db.dragndrop_answers.correct,
-                db.dragndrop_answers.minHeight,
-                orderby=~db.dragndrop_answers.id,
-            )
-            .first()
+    res = _getAssessResults(course, sid, [(div_id, event)]).get(div_id)
+    if not res:
+        return ""  # server doesn't have it so we load from local storage instead
+    return json.dumps(res)
+
+
+# Restore every question on a page with one request, instead of one ``getAssessResults`` call per question. The ``components`` parameter is a JSON array of ``[div_id, event]`` pairs. Returns a JSON object mapping each div_id with a saved answer to what ``getAssessResults`` would return for it; the client loads the rest from local storage.
+def getPageAssessResults():
+    response.headers["content-type"] = "application/json"
+    if not auth.user:
+        return json.dumps({})
+
+    try:
+        components = json.loads(request.vars.components or "[]")
+    except ValueError:
+        components = None
+    if not isinstance(components, list) or not all(
+        isinstance(c, list) and len(c) == 2 for c in components
+    ):
+        return json.dumps(dict(errors=["components must be a JSON list of pairs"]))
+    if len(components) > PAGE_ASSESS_MAX:
+        return json.dumps(
+            dict(errors=["at most {} components per request".format(PAGE_ASSESS_MAX)])
         )
-        if not rows:
-            return ""
-        res = {
-            "answer": rows.answer,
-            "timestamp": str(rows.timestamp),
-            "correct": rows.correct,
-            "minHeight": str(rows.minHeight),
-        }
-        return json.dumps(res)
-    elif event == "clickableArea":
-        rows = (
-            db(
-                (db.clickablearea_answers.div_id == div_id)
-                & (db.clickablearea_answers.course_name == course)
-                & (db.clickablearea_answers.sid == sid)
-            )
-            .select(
-                db.clickablearea_answers.answer,
-                db.clickablearea_answers.timestamp,
-                db.clickablearea_answers.correct,
-                orderby=~db.clickablearea_answers.id,
+
+    sid = auth.user.username
+    if request.vars.sid and request.vars.sid != sid:  # retrieving results for grader
+        if not verifyInstructorStatus(request.vars.course, auth.user.id):  # noqa: F405
+            return json.dumps(
+                dict(errors=["only an instructor may load another student's answers"])
             )
-            .first()
+        sid = request.vars.sid
+    return json.dumps(_getAssessResults(request.vars.course, sid, components))
+
+
+# Return a dict mapping each div_id in ``components``, a list of ``(div_id, event)``, to the result which restores the latest answer ``sid`` saved for it in ``course``. Questions without a saved answer are left out. Each answer table is read with one query.
+def _getAssessResults(course, sid, components):
+    by_event = {}
+    for div_id, event in components:
+        if event in ASSESS_FIELDS:
+            by_event.setdefault(event, []).append(div_id)
+
+    results = {}
+    for event, div_ids in by_event.items():
+        tablename, fieldnames = ASSESS_FIELDS[event]
+        tbl = db[tablename]
+        query = (
+            (tbl.div_id.belongs(div_ids))
+            & (tbl.course_name == course)
+            & (tbl.sid == sid)
         )
-        if not rows:
-            return ""
-        res = {
-            "answer": rows.answer,
-            "timestamp": str(rows.timestamp),
-            "correct": rows.correct,
-        }
-        return json.dumps(res)
-    elif event == "timedExam":
-        rows = (
-            db(
-                (db.timed_exam.reset == None)  # noqa: E711
-                & (db.timed_exam.div_id == div_id)
-                & (db.timed_exam.course_name == course)
-                & (db.timed_exam.sid == sid)
-            )
-            .select(
-                db.timed_exam.correct,
-                db.timed_exam.incorrect,
-                db.timed_exam.skipped,
-                db.timed_exam.time_taken,
-                db.timed_exam.timestamp,
-                db.timed_exam.reset,
-                orderby=~db.timed_exam.id,
-            )
-            .first()
+        if event == "timedExam":
+            query &= tbl.reset == None  # noqa: E711
+        latest = db(query)._select(tbl.id.max(), groupby=tbl.div_id)
+        rows = db(tbl.id.belongs(latest)).select(
+            tbl.div_id, *[tbl[name] for name in fieldnames]
         )
-        if not rows:
-            return ""
-        res = {
-            "correct": rows.correct,
-            "incorrect": rows.incorrect,
-            "skipped": str(rows.skipped),
-            "timeTaken": str(rows.time_taken),
-            "timestamp": str(rows.timestamp),
-            "reset": str(rows.reset),
+        feedback = server_feedback(div_ids, course) if event == "fillb" else {}
+        for row in rows:
+            results[row.div_id] = _assessResult(event, row, feedback.get(row.div_id))
+    return results
+
+
+# Return what the client needs to restore an answer, given the latest ``row`` from the answer table for ``event``. For fill-in-the-blank questions graded on the server, ``feedback`` is the question's feedback.
+def _assessResult(event, row, feedback=None):
+    if event == "timedExam":
+        return {
+            "correct": row.correct,
+            "incorrect": row.incorrect,
+            "skipped": str(row.skipped),
+            "timeTaken": str(row.time_taken),
+            "timestamp": str(row.timestamp),
+            "reset": str(row.reset),
         }
-        return json.dumps(res)
+
+    res = {"answer": row.answer, "timestamp": str(row.timestamp)}
+    if event in ("mChoice", "dragNdrop", "clickableArea", "lp_build"):
+        res["correct"] = row.correct
+    if event == "fillb" and feedback is not None:
+        correct, res_update = fitb_feedback(row.answer, feedback)
+        res.update(res_update)
+    elif event == "dragNdrop":
+        res["minHeight"] = str(row.minHeight)
     elif event == "parsons":
-        rows = (
-            db(
-                (db.parsons_answers.div_id == div_id)
-                & (db.parsons_answers.course_name == course)
-                & (db.parsons_answers.sid == sid)
-            )
-            .select(
-                db.parsons_answers.answer,
-                db.parsons_answers.source,
-                db.parsons_answers.timestamp,
-                orderby=~db.parsons_answers.id,
-            )
-            .first()
-        )
-        if not rows:
-            return ""
-        res = {
-            "answer": rows.answer,
-            "source": rows.source,
-            "timestamp": str(rows.timestamp),
-        }
-        return json.dumps(res)
-    elif event == "shortanswer":
-        row = (
-            db(
-                (db.shortanswer_answers.sid == sid)
-                & (db.shortanswer_answers.div_id == div_id)
-                & (db.shortanswer_answers.course_name == course)
-            )
-            .select()
-            .first()
-        )
-        if not row:
-            return ""
-        res = {"answer": row.answer, "timestamp": str(row.timestamp)}
-        return json.dumps(res)
+        res["source"] = row.source
     elif event == "lp_build":
-        rows = (
-            db(
-                (db.lp_answers.div_id == div_id)
-                & (db.lp_answers.course_name == course)
-                & (db.lp_answers.sid == sid)
-            )
-            .select(
-                db.lp_answers.answer,
-                db.lp_answers.timestamp,
-                db.lp_answers.correct,
-                orderby=~db.lp_answers.id,
-            )
-            .first()
-        )
-        if not rows:
-            return ""  # server doesn't have it so we load from local storage instead
-        answer = json.loads(rows.answer)
-        correct = rows.correct
-        return json.dumps(
-            {"answer": answer, "timestamp": str(rows.timestamp), "correct": correct}
-        )
+        res["answer"] = json.loads(row.answer)
+    return res
 
 
 def checkTimedReset():
@@ -1353,62 +1467,8 @@ def checkTimedReset():
 def preview_question():
     try:
         code = json.loads(request.vars.code)
-        with open(
-            "applications/{}/build/preview/_sources/index.rst".format(
-                request.application
-            ),
-            "w",
-            encoding="utf-8",
-        ) as ixf:
-            ixf.write(code)
-
-        # Note that ``os.environ`` isn't a dict, it's an object whose setter modifies environment variables. So, modifications of a copy/deepcopy still `modify the original environment <https://stackoverflow.com/questions/13142972/using-copy-deepcopy-on-os-environ-in-python-appears-broken>`_. Therefore, convert it to a dict, where modifications will not affect the environment.
-        env = dict(os.environ)
-        # Prevent any changes to the database when building a preview question.
-        del env["DBURL"]
-        # Run a runestone build.
-        # We would like to use sys.executable But when we run web2py
-        # in uwsgi then sys.executable is uwsgi which doesn't work.
-        # Why not just run runestone?
-        popen_obj = subprocess.Popen(
-            [settings.python_interpreter, "-m", "runestone", "build"],
-            # The build must be run from the directory containing a ``conf.py`` and all the needed support files.
-            cwd="applications/{}/build/preview".format(request.application),
-            # Capture the build output as text in case of an error.
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            # Pass the modified environment which doesn't contain ``DBURL``.
-            env=env,
-        )
-        stdout, stderr = popen_obj.communicate()
-        # If there was an error, return stdout and stderr from the build.
-        if popen_obj.returncode != 0:
-            return json.dumps(
-                "Error: Runestone build failed:\n\n" + stdout + "\n" + stderr
-            )
-
-        with open(
-            "applications/{}/build/preview/build/preview/index.html".format(
-                request.application
-            ),
-            "r",
-            encoding="utf-8",
-        ) as ixf:
-            src = ixf.read()
-            tree = html.fromstring(src)
-            component = tree.cssselect(".runestone")
-            if len(component) > 0:
-                ctext = html.tostring(component[0]).decode("utf-8")
-            else:
-                component = tree.cssselect(".system-message")
-                if len(component) > 0:
-                    ctext = html.tostring(component[0]).decode("utf-8")
-                    logger.debug("error - ", ctext)
-                else:
-                    ctext = "Error: Runestone content missing."
-
-            return json.dumps(ctext)
+        # See ``modules/preview_pool.py``.
+        return json.dumps(get_preview_pool(settings, request.folder).render(code))
     except Exception as ex:
         return json.dumps("Error: {}".format(ex))
 
@@ -1433,27 +1493,53 @@ def get_datafile():
     course_id - string, the name of the course
     acid -  the acid of this datafile
     """
-    course = request.vars.course_id  # the course name
-    the_course = db(db.courses.course_name == course).select().first()
     acid = request.vars.acid
-    file_contents = (
-        db(
-            (db.source_code.acid == acid)
-            & (
-                (db.source_code.course_id == the_course.base_course)
-                | (db.source_code.course_id == course)
+    file_contents, file_hash = _get_datafiles(request.vars.course_id, [acid])[acid]
+    if file_hash:
+        _check_etag(file_hash)
+
+    return json.dumps(dict(data=file_contents))
+
+
+# Return the contents of several data files with one request.
+def get_datafiles():
+    """
+    course_id - string, the name of the course
+    acids - a comma-separated list of the acids of the datafiles
+
+    Returns ``{"data": {acid: contents, ...}}``; the contents of a datafile which doesn't exist are ``null``.
+    """
+    acids = [acid.strip() for acid in (request.vars.acids or "").split(",")]
+    acids = [acid for acid in acids if acid]
+    sources = _get_datafiles(request.vars.course_id, acids)
+    _check_etag(
+        content_hash(
+            "\n".join(
+                "{}:{}".format(acid, sources[acid][1]) for acid in sorted(sources)
             )
         )
-        .select(db.source_code.main_code)
+    )
+
+    return json.dumps(dict(data={acid: sources[acid][0] for acid in acids}))
+
+
+# Return a dict mapping each of ``acids`` to ``(contents, hash)`` for the datafiles available in ``course``, from the course or its base course.
+def _get_datafiles(course, acids):
+    the_course = (
+        db(db.courses.course_name == course)
+        .select(db.courses.base_course, cache=(cache.ram, 3600), cacheable=True)
         .first()
     )
+    return get_sources(db, acids, [the_course.base_course, course])
 
-    if file_contents:
-        file_contents = file_contents.main_code
-    else:
-        file_contents = None
 
-    return json.dumps(dict(data=file_contents))
+# Send ``etag``, a hash of the response, as its ``ETag``. If the browser already has this version, respond with ``304 Not Modified`` instead of the content.
+def _check_etag(etag):
+    etag = '"{}"'.format(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if request.env.http_if_none_match == etag:
+        raise HTTP(304, "", **response.headers)
 
 
 @auth.requires(
@@ -1471,29 +1557,35 @@ def broadcast_code():
         (db.user_courses.course_id == cid)
         & (db.auth_user.id == db.user_courses.user_id)
     ).select()
-    counter = 0
+    ts = datetime.datetime.utcnow()
+    rows = []
     for student in student_list:
         if student.auth_user.id == auth.user.id:
             continue
-        sid = student.auth_user.username
-        try:
-            db.code.insert(
-                sid=sid,
+        rows.append(
+            dict(
+                sid=student.auth_user.username,
                 acid=request.vars.divid,
-                code=request.vars.code,
                 emessage="",
-                timestamp=datetime.datetime.utcnow(),
+                timestamp=ts,
                 course_id=cid,
                 language=request.vars.lang,
                 comment="Instructor shared code",
             )
-        except Exception as e:
-            logger.error("Failed to insert instructor code! details: {}".format(e))
-            return json.dumps(dict(mess="failed"))
-
-        counter += 1
+        )
+    # Every student gets the same program, so store its text once and insert all of the rows in one statement.
+    try:
+        code_hash = store_code(db, request.vars.code or "")
+        for row in rows:
+            row["code_hash"] = code_hash
+        multirow_insert(db, db.code, rows)
+        for row in rows:
+            note_latest_code(db, row)
+    except Exception as e:
+        logger.error("Failed to insert instructor code! details: {}".format(e))
+        return json.dumps(dict(mess="failed"))
 
-    return json.dumps(dict(mess="success", share_count=counter))
+    return json.dumps(dict(mess="success", share_count=len(rows)))
 
 
 def _same_class(user1: str, user2: str) -> bool:
@@ -27,11 +27,15 @@ from rs_grading import (
     do_autograde,
     do_calculate_totals,
     do_check_answer,
+    plan_autograde,
+    save_autograde_plan,
     send_lti_grade,
     _get_lti_record,
     _try_to_send_lti_grade,
 )
 from db_dashboard import DashboardDataAnalyzer
+from code_store import resolve_code
+from source_cache import get_sources
 
 logger = logging.getLogger(settings.logger)
 logger.setLevel(settings.log_level)
@@ -512,6 +516,8 @@ def _autograde(
     assignment_name=None,
     assignment_id=None,
     timezoneoffset=None,
+    force=False,
+    sids=None,
 ):
     if assignment_id:
         assignment = (
@@ -543,6 +549,8 @@ def _autograde(
             timezoneoffset,
             db,
             settings,
+            sids=sids,
+            force=force,
         )
         return {
             "success": True,
@@ -602,9 +610,33 @@ def autograde():
     sid = request.vars.get("sid", None)
     question_name = request.vars.get("question", None)
     enforce_deadline = request.vars.get("enforceDeadline", None)
+    # When grading every student, regrade everyone rather than only the students with new answers.
+    force = request.vars.get("force", None) == "true"
     assignment_name = request.vars.assignment
     timezoneoffset = session.timezoneoffset if "timezoneoffset" in session else None
 
+    # The grading page grades the whole course a few students per request: ``plan=true`` returns the students to grade, ``sids`` (a JSON list) grades some of them, and ``finish=true`` records that all of them were.
+    if request.vars.plan == "true" or request.vars.finish == "true":
+        return json.dumps(
+            _autograde_plan(
+                assignment_name,
+                enforce_deadline,
+                timezoneoffset,
+                force,
+                finish=request.vars.finish == "true",
+            )
+        )
+    sids = None
+    if request.vars.sids:
+        try:
+            sids = json.loads(request.vars.sids)
+        except ValueError:
+            sids = None
+        if not isinstance(sids, list) or not all(isinstance(s, str) for s in sids):
+            return json.dumps(
+                {"success": False, "message": "sids must be a JSON list of usernames."}
+            )
+
     return json.dumps(
         _autograde(
             sid=sid,
@@ -612,10 +644,49 @@ def autograde():
             enforce_deadline=enforce_deadline,
             assignment_name=assignment_name,
             timezoneoffset=timezoneoffset,
+            force=force,
+            sids=sids,
         )
     )
 
 
+# Plan grading ``assignment_name`` for the whole course, keeping the plan in the session; or, given ``finish``, record that the planned grading is done. See ``plan_autograde``.
+def _autograde_plan(assignment_name, enforce_deadline, timezoneoffset, force, finish):
+    assignment = (
+        db(
+            (db.assignments.name == assignment_name)
+            & (db.assignments.course == auth.user.course_id)
+        )
+        .select()
+        .first()
+    )
+    if not assignment:
+        return {
+            "success": False,
+            "message": "Select an assignment before trying to autograde.",
+        }
+
+    if finish:
+        plan = session.autograde_plan
+        if not plan or plan["assignment"] != assignment.id:
+            return {"success": False, "message": "There's no grading to finish."}
+        save_autograde_plan(assignment, plan["watermarks"], db)
+        session.autograde_plan = None
+        return {"success": True, "message": "Graded every student."}
+
+    sids, watermarks = plan_autograde(
+        assignment,
+        auth.user.course_id,
+        auth.user.course_name,
+        enforce_deadline,
+        timezoneoffset,
+        db,
+        force=force,
+    )
+    session.autograde_plan = dict(assignment=assignment.id, watermarks=watermarks)
+    return {"success": True, "students": sids}
+
+
 @auth.requires(
     lambda: verifyInstructorStatus(auth.user.course_name, auth.user),
     requires_login=True,
@@ -740,6 +811,8 @@ def get_problem():
         query = query & (db.code.timestamp < deadline + offset)
         logger.debug("DEADLINE QUERY = %s", query)
     c = db(query).select(orderby=db.code.id).last()
+    if c:
+        resolve_code(db, [c])
 
     if c:
         res["code"] = c.code
@@ -749,18 +822,19 @@ def get_problem():
     source = db.source_code(acid=request.vars.acid, course_id=auth.user.course_name)
 
     if source and c and c.code:
-
-        def get_source(acid):
-            r = db.source_code(acid=acid)
-            if r:
-                return r.main_code
-            else:
-                return ""
-
+        included_divs = []
         if source.includes:
             # strip off "data-include"
             txt = source.includes[len("data-include=") :]
             included_divs = [x.strip() for x in txt.split(",") if x != ""]
+        file_divs = [x.strip() for x in source.available_files.split(",") if x != ""]
+        # Read the source of every include and file at once; see ``modules/source_cache.py``.
+        sources = get_sources(db, included_divs + file_divs)
+
+        def get_source(acid):
+            return sources[acid][0] or ""
+
+        if source.includes:
             # join together code for each of the includes
             res["includes"] = "\n".join([get_source(acid) for acid in included_divs])
             # logger.debug(res['includes'])
@@ -768,7 +842,6 @@ def get_problem():
             res["suffix_code"] = source.suffix_code
             # logger.debug(source.suffix_code)
 
-        file_divs = [x.strip() for x in source.available_files.split(",") if x != ""]
         res["file_includes"] = [
             {"acid": acid, "contents": get_source(acid)} for acid in file_divs
         ]
@@ -838,7 +911,7 @@ def doAssignment():
     )
 
     try:
-        db.useinfo.insert(
+        log_useinfo(
             sid=auth.user.username,
             act="viewassignment",
             div_id=assignment.name,
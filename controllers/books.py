@@ -22,18 +22,26 @@ import json
 import logging
 import datetime
 import importlib
-
-
-logger = logging.getLogger(settings.logger)
-logger.setLevel(settings.log_level)
+import stat
+import urllib.parse
 
 # Third-party imports
 # -------------------
-# None.
-#
+from gluon.contenttype import contenttype
+from gluon.restricted import restricted
+
 # Local application imports
 # -------------------------
-# None.
+from book_templates import compiled_template
+from page_metadata import page_metadata
+from reader_progress import completion_status, last_pages
+from sid_alias import sid_and_aliases
+from user_interactions import interacted_div_ids
+
+
+logger = logging.getLogger(settings.logger)
+logger.setLevel(settings.log_level)
+
 #
 #
 # Supporting functions
@@ -135,9 +143,7 @@ def _route_book(is_published=True):
 
     # See if this is static content. By default, the Sphinx static directory names are ``_static`` and ``_images``.
     if request.args(1) in ["_static", "_images"]:
-        # See the `response <http://web2py.com/books/default/chapter/29/04/the-core#response>`_.
-        # Warning: this is slow. Configure a production server to serve this statically.
-        return response.stream(book_path, 2 ** 20, request=request)
+        return _serve_static(book_path)
 
     # It's HTML -- use the file as a template.
     #
@@ -145,37 +151,49 @@ def _route_book(is_published=True):
     if not os.path.isfile(book_path):
         logger.error("Bad Path for {} given {}".format(book_path, request.args[1:]))
         raise HTTP(404)
-    response.view = book_path
     chapter = os.path.split(os.path.split(book_path)[0])[1]
     subchapter = os.path.basename(os.path.splitext(book_path)[0])
+    # The questions and table of contents only change when the book is rebuilt; see ``modules/page_metadata.py``.
+    metadata = page_metadata(db, base_course, chapter, subchapter, book_path)
     div_counts = {}
     if auth.user:
         user_id = auth.user.username
         email = auth.user.email
         is_logged_in = "true"
         # Get the necessary information to update subchapter progress on the page
-        page_divids = db(
-            (db.questions.subchapter == subchapter)
-            & (db.questions.chapter == chapter)
-            & (db.questions.from_source == True)  # noqa: E712
-            & (db.questions.base_course == base_course)
-        ).select(db.questions.name)
-        div_counts = {q.name: 0 for q in page_divids}
-        sid_counts = db(
-            (db.questions.subchapter == subchapter)
-            & (db.questions.chapter == chapter)
-            & (db.questions.base_course == base_course)
-            & (db.questions.from_source == True)  # noqa: E712
-            & (db.questions.name == db.useinfo.div_id)
-            & (db.useinfo.course_id == auth.user.course_name)
-            & (db.useinfo.sid == auth.user.username)
-        ).select(db.useinfo.div_id, distinct=True)
-        for row in sid_counts:
-            div_counts[row.div_id] = 1
+        div_counts = {name: 0 for name in metadata["question_names"]}
+        # See ``modules/user_interactions.py``.
+        for div_id in interacted_div_ids(
+            db,
+            auth.user.course_name,
+            sid_and_aliases(db, auth.user.username),
+            metadata["question_names"],
+        ):
+            div_counts[div_id] = 1
+
+        # Include what ``ajax.getCompletionStatus``, ``ajax.getAllCompletionStatus`` and ``ajax.getlastpage`` return, saving the page those requests.
+        status, all_statuses = completion_status(
+            db, auth.user.id, base_course, chapter, subchapter
+        )
+        last_page = last_pages(db, auth.user.id, course)
+        if (
+            not last_page
+            and db(
+                (db.user_state.user_id == auth.user.id)
+                & (db.user_state.course_id == course.course_name)
+            ).isempty()
+        ):
+            db.user_state.insert(user_id=auth.user.id, course_id=course.course_name)
+        progress_info = dict(
+            completionStatus=status,
+            allCompletionStatus=all_statuses,
+            lastPage=last_page[0] if last_page else None,
+        )
     else:
         user_id = "Anonymous"
         email = ""
         is_logged_in = "false"
+        progress_info = None
 
     if session.readings:
         reading_list = session.readings
@@ -184,7 +202,7 @@ def _route_book(is_published=True):
 
     # TODO: - Add log entry for page view
     try:
-        db.useinfo.insert(
+        log_useinfo(
             sid=user_id,
             act="view",
             div_id=book_path,
@@ -206,7 +224,8 @@ def _route_book(is_published=True):
         else "false"
     )
 
-    return dict(
+    page = _render_page(
+        book_path,
         course_name=course.course_name,
         base_course=base_course,
         is_logged_in=is_logged_in,
@@ -216,37 +235,71 @@ def _route_book(is_published=True):
         allow_pairs=allow_pairs,
         readings=XML(reading_list),
         activity_info=json.dumps(div_counts),
+        progress_info=json.dumps(progress_info),
         downloads_enabled=downloads_enabled,
-        subchapter_list=_subchaptoc(base_course, chapter),
+        subchapter_list=metadata["subchapter_list"],
     )
+    if progress_info:
+        # The book's layout comes from the Runestone Components, which don't know about ``progress_info``; add it to ``eBookConfig`` at the end of the ``<head>``.
+        page = page.replace(
+            "</head>",
+            "<script>window.eBookConfig = window.eBookConfig || {{}}; "
+            "eBookConfig.progressInfo = {};</script>\n</head>".format(
+                json.dumps(progress_info).replace("</", "<\\/")
+            ),
+            1,
+        )
+    return page
 
 
-def _subchaptoc(course, chap):
-    res = db(
-        (db.chapters.id == db.sub_chapters.chapter_id)
-        & (db.chapters.course_id == course)
-        & (db.chapters.chapter_label == chap)
-    ).select(
-        db.chapters.chapter_num,
-        db.sub_chapters.sub_chapter_num,
-        db.chapters.chapter_label,
-        db.sub_chapters.sub_chapter_label,
-        db.sub_chapters.sub_chapter_name,
-        orderby=db.sub_chapters.sub_chapter_num,
-        cache=(cache.ram, 3600),
-        cacheable=True,
+# Render the book page ``book_path``, a web2py template, with the variables in ``page_vars``. This does what setting ``response.view`` would, but reuses the compiled template; see ``modules/book_templates.py``.
+def _render_page(book_path, **page_vars):
+    env = response._view_environment
+    code = compiled_template(
+        book_path,
+        os.path.join(request.folder, "views"),
+        os.path.join(request.folder, "build", "compiled_books"),
+        env,
     )
-    toclist = []
-    for row in res:
-        sc_url = "{}.html".format(row.sub_chapters.sub_chapter_label)
-        title = "{}.{} {}".format(
-            row.chapters.chapter_num,
-            row.sub_chapters.sub_chapter_num,
-            row.sub_chapters.sub_chapter_name,
-        )
-        toclist.append(dict(subchap_uri=sc_url, title=title))
+    env.update(page_vars)
+    restricted(code, env, layer=book_path)
+    return response.body.getvalue()
+
+
+# Serve the static file ``book_path``. Ideally, a production server serves these itself; otherwise, ``settings.static_offload`` can hand the file back to it:
+#
+# - ``"x-sendfile"`` sends an ``X-Sendfile`` header with the file's path (Apache's ``mod_xsendfile``, lighttpd).
+# - ``"x-accel"`` sends an ``X-Accel-Redirect`` header to nginx, replacing the ``books`` directory with ``settings.static_accel_prefix``, which must be an ``internal`` location aliased to that directory.
+# - Otherwise, the file is streamed here, using the server's ``wsgi.file_wrapper`` (zero-copy ``sendfile`` under uwsgi) when it has one. ``response.stream`` answers ``Range`` requests with ``206 Partial Content``, so videos can seek.
+#
+# In every case the ``ETag``, from the file's modification time and size, is checked here, so a browser revalidating an unchanged file gets ``304 Not Modified`` without the file being opened.
+def _serve_static(book_path):
+    try:
+        st = os.stat(book_path)
+    except OSError:
+        raise HTTP(404)
+    if not stat.S_ISREG(st.st_mode):
+        raise HTTP(404)
+    etag = '"{:x}-{:x}"'.format(st.st_mtime_ns, st.st_size)
+    response.headers["ETag"] = etag
+    if request.env.http_if_none_match == etag:
+        raise HTTP(304, "", **response.headers)
+
+    offload = settings.static_offload
+    if offload in ("x-sendfile", "x-accel"):
+        response.headers["Content-Type"] = contenttype(book_path)
+        if offload == "x-sendfile":
+            response.headers["X-Sendfile"] = book_path
+        else:
+            path = os.path.relpath(book_path, os.path.join(request.folder, "books"))
+            response.headers["X-Accel-Redirect"] = posixpath.join(
+                settings.static_accel_prefix, urllib.parse.quote(path)
+            )
+        return ""
 
-    return toclist
+    request.env.web2py_use_wsgi_file_wrapper = True
+    # See the `response <http://web2py.com/books/default/chapter/29/04/the-core#response>`_.
+    return response.stream(book_path, 2 ** 20, request=request)
 
 
 # This is copied verbatim from https://github.com/pallets/werkzeug/blob/master/werkzeug/security.py#L30.
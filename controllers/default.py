@@ -8,6 +8,9 @@ import logging
 
 from gluon.restricted import RestrictedError
 from stripe_form import StripeForm
+from answer_stats import delete_poll_votes
+from code_store import prune_code_blobs
+from sid_alias import unmerged_aliases
 
 logger = logging.getLogger(settings.logger)
 logger.setLevel(settings.log_level)
@@ -625,7 +628,28 @@ def delete():
         session.flash = "Account Deleted"
         db(db.auth_user.id == auth.user.id).delete()
         db(db.useinfo.sid == auth.user.username).delete()
+        db(db.user_interactions.sid == auth.user.username).delete()
+        delete_poll_votes(db, auth.user.username)
+        db(db.user_answer_counters.sid == auth.user.username).delete()
+        db(db.user_first_seen.sid == auth.user.username).delete()
+        db(db.presence.sid == auth.user.username).delete()
+        # The history logged before logging in, if it hasn't been merged yet, is this account's too.
+        aliases = list(unmerged_aliases(db, [auth.user.username]))
+        if aliases:
+            db(db.useinfo.sid.belongs(aliases)).delete()
+            db(db.user_interactions.sid.belongs(aliases)).delete()
+        db(db.sid_alias.sid == auth.user.username).delete()
+        # Delete the code and the pointers to its latest versions, then any blobs which only it referenced.
+        code_hashes = {
+            row.code_hash
+            for row in db(
+                (db.code.sid == auth.user.username)
+                & (db.code.code_hash != None)  # noqa: E711
+            ).select(db.code.code_hash, distinct=True)
+        }
         db(db.code.sid == auth.user.username).delete()
+        db(db.code_latest.sid == auth.user.username).delete()
+        prune_code_blobs(db, code_hashes)
         db(db.acerror_log.sid == auth.user.username).delete()
         for t in [
             "clickablearea",
@@ -4,6 +4,8 @@ from os import path
 import random
 import datetime
 
+from user_interactions import mark_backfilled
+
 #########################################################################
 ## This is a samples controller
 ## - index is the default action of any application
@@ -109,6 +111,9 @@ def build():
             % (auth.user.id, cid)
         )
 
+        # A new course has no interactions to copy into ``user_interactions``.
+        mark_backfilled(db, request.vars.projectname)
+
         # Create a default section for this course and add the instructor.
         sectid = db.sections.update_or_insert(name="default", course_id=cid)
         db.section_users.update_or_insert(auth_user=auth.user.id, section=sectid)
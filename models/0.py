@@ -7,7 +7,7 @@
 
 from gluon.storage import Storage
 import logging
-from os import environ
+from os import environ, path
 import sys
 
 settings = Storage()
@@ -65,3 +65,29 @@ settings.sched_logger = (
 )  # works for production where sending log to syslog but not for dev.
 settings.log_level = logging.DEBUG
 settings.python_interpreter = sys.executable
+
+# Queue ``useinfo`` rows in-process and write them in bulk, along with the
+# tables derived from them, from a background thread, rather than during each
+# request. See ``modules/useinfo_buffer.py``.
+settings.useinfo_write_behind = environ.get("RS_USEINFO_WRITE_BEHIND") == "Yes"
+settings.useinfo_flush_interval = 0.5  # seconds
+settings.useinfo_flush_rows = 500
+settings.useinfo_max_queue = 20000
+settings.useinfo_spill_dir = path.join(request.folder, "databases")
+settings.useinfo_stats_interval = 60  # seconds
+
+# Write a reader's scroll location on the same page at most this often; a new
+# page is always written at once. See ``modules/last_page.py``.
+settings.last_page_write_interval = 10  # seconds
+
+# Render question previews in this many warm worker processes per server
+# process. See ``modules/preview_pool.py``.
+settings.preview_workers = 2
+settings.preview_timeout = 60  # seconds
+
+# How to serve the ``_static`` and ``_images`` files of books when a request
+# reaches web2py: ``None`` streams them from web2py; ``"x-sendfile"`` or
+# ``"x-accel"`` hands them to the front-end server. See ``_serve_static`` in
+# ``controllers/books.py``.
+settings.static_offload = environ.get("RS_STATIC_OFFLOAD") or None
+settings.static_accel_prefix = "/_books_internal/"
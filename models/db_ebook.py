@@ -1,5 +1,12 @@
 # Files in the model directory are loaded in alphabetical order.  This one needs to be loaded after db.py
 
+from answer_stats import record_answer_stats
+from code_store import note_latest_code, store_code
+from db_bulk import multirow_insert
+from presence import note_presence
+from useinfo_buffer import get_buffer as get_useinfo_buffer
+from user_interactions import record_interactions
+
 db.define_table(
     "useinfo",
     Field("timestamp", "datetime"),
@@ -11,6 +18,89 @@ db.define_table(
     migrate=table_migrate_prefix + "useinfo.table",
 )
 
+# Maps the ``ipuser`` cookie of an anonymous reader to the username they later logged in with. ``merged`` is set once their ``useinfo`` rows have been rewritten; see ``modules/sid_alias.py``.
+db.define_table(
+    "sid_alias",
+    Field("alias", "string"),
+    Field("sid", "string"),
+    Field("created", "datetime"),
+    Field("merged", "datetime"),
+    migrate=table_migrate_prefix + "sid_alias.table",
+)
+
+# Who was active in each minute, for the last few minutes; see ``modules/presence.py``.
+db.define_table(
+    "presence",
+    Field("minute", "datetime"),
+    Field("course_name", "string"),
+    Field("sid", "string"),
+    migrate=table_migrate_prefix + "presence.table",
+)
+
+# When each sid was first seen in each course; rows with no ``course_name`` record when it was first seen anywhere. Filled from ``useinfo`` by ``rollup_first_seen`` in ``modules/user_counts.py``.
+db.define_table(
+    "user_first_seen",
+    Field("sid", "string"),
+    Field("course_name", "string"),
+    Field("first_seen", "datetime"),
+    migrate=table_migrate_prefix + "user_first_seen.table",
+)
+
+# The last row of a table processed by an incremental rollup, by rollup name.
+db.define_table(
+    "rollup_watermarks",
+    Field("name", "string"),
+    Field("last_id", "bigint", default=0),
+    migrate=table_migrate_prefix + "rollup_watermarks.table",
+)
+
+# The questions each reader has interacted with in each course, and when they first did; see ``modules/user_interactions.py``.
+db.define_table(
+    "user_interactions",
+    Field("course_name", "string"),
+    Field("sid", "string"),
+    Field("div_id", "string"),
+    Field("first_seen", "datetime"),
+    migrate=table_migrate_prefix + "user_interactions.table",
+)
+
+
+# Record events in ``useinfo``. All of the server's event logging goes through
+# these two functions, so that ingestion can be buffered in one place. Each row
+# is a dict of ``useinfo`` fields.
+def log_useinfo_rows(rows):
+    if settings.useinfo_write_behind and get_useinfo_buffer(
+        db, settings, record_logged_rows, LOGGED_ROW_TABLES
+    ).put(rows):
+        return
+    if len(rows) == 1:
+        db.useinfo.insert(**rows[0])
+    else:
+        multirow_insert(db, db.useinfo, rows)
+    record_logged_rows(db, rows)
+
+
+def log_useinfo(**fields):
+    log_useinfo_rows([fields])
+
+
+# Update the tables derived from ``rows``, which were just logged in ``useinfo`` on ``db``. With write-behind, the buffer's flusher calls this on its own connection.
+def record_logged_rows(db, rows):
+    note_presence(db, rows)
+    record_answer_stats(db, rows)
+    record_interactions(db, rows)
+
+
+# The tables ``record_logged_rows`` writes.
+LOGGED_ROW_TABLES = (
+    "presence",
+    "question_answer_stats",
+    "poll_votes",
+    "poll_option_counts",
+    "user_interactions",
+)
+
+
 # stores student's saved code and, unfortunately, comments and grades, which really should be their own table linked to this
 db.define_table(
     "code",
@@ -23,9 +113,43 @@ db.define_table(
     Field("timestamp", "datetime"),
     Field("comment", "text"),
     Field("language", "text", default="python"),
+    # The hash of this row's program text in ``code_blobs``. Rows saved before blobs existed have no hash and keep their text in ``code``.
+    Field("code_hash", "string"),
     migrate=table_migrate_prefix + "code.table",
 )
 
+# Program text referenced by ``code.code_hash``; see ``modules/code_store.py``.
+db.define_table(
+    "code_blobs",
+    Field("hash", "string"),
+    Field("code", "text"),
+    migrate=table_migrate_prefix + "code_blobs.table",
+)
+
+# The latest version of each program in ``code``, so it can be loaded without reading every version. Rows saved before this table existed are added as they're read; see ``modules/code_store.py``.
+db.define_table(
+    "code_latest",
+    Field("sid", "string"),
+    Field("acid", "string"),
+    Field("course_id", "integer"),
+    # The ``code`` row holding this version, if known, and the hash of its text, if stored in ``code_blobs``.
+    Field("code_id", "integer"),
+    Field("code_hash", "string"),
+    Field("timestamp", "datetime"),
+    migrate=table_migrate_prefix + "code_latest.table",
+)
+
+
+# Save a row in ``code``. The program text is stored once in ``code_blobs`` and the row references it by hash; the row becomes the latest version of its program.
+def save_code(**fields):
+    code = fields.pop("code", None)
+    if code is not None:
+        fields["code_hash"] = store_code(db, code)
+    code_id = db.code.insert(**fields)
+    note_latest_code(db, fields, code_id)
+    return code_id
+
+
 # Stores the source code for activecodes, including prefix and suffix code, so that prefixes and suffixes can be run when grading
 # Contents of this table are filled when processing activecode directives, in activecod.py
 db.define_table(
@@ -200,3 +324,59 @@ db.define_table(
     Field("correct", "double"),
     migrate=table_migrate_prefix + "lp_answers.table",
 )
+
+# Answer counts for each multiple choice question, per course and day; see ``modules/answer_stats.py``.
+db.define_table(
+    "question_answer_stats",
+    Field("course_name", "string"),
+    Field("div_id", "string"),
+    Field("answer", "string"),
+    Field("correct", "boolean"),
+    Field("day", "date"),
+    Field("answer_count", "integer", default=0),
+    migrate=table_migrate_prefix + "question_answer_stats.table",
+)
+
+# Each reader's latest vote in each poll; see ``modules/answer_stats.py``.
+db.define_table(
+    "poll_votes",
+    Field("course_name", "string"),
+    Field("div_id", "string"),
+    Field("sid", "string"),
+    Field("act", "string"),
+    Field("vote", "integer"),
+    Field("timestamp", "datetime"),
+    migrate=table_migrate_prefix + "poll_votes.table",
+)
+
+# The number of readers whose latest vote in a poll is for each option.
+db.define_table(
+    "poll_option_counts",
+    Field("course_name", "string"),
+    Field("div_id", "string"),
+    Field("vote", "integer"),
+    Field("vote_count", "integer", default=0),
+    migrate=table_migrate_prefix + "poll_option_counts.table",
+)
+
+# How often each answer was given to each fill-in-the-blank question, per course and day.
+db.define_table(
+    "fitb_answer_counts",
+    Field("course_name", "string"),
+    Field("div_id", "string"),
+    Field("answer", "string"),
+    Field("day", "date"),
+    Field("answer_count", "integer", default=0),
+    migrate=table_migrate_prefix + "fitb_answer_counts.table",
+)
+
+# The number of answers, and of correct answers, each reader has given to each type of question in each course.
+db.define_table(
+    "user_answer_counters",
+    Field("course_name", "string"),
+    Field("sid", "string"),
+    Field("event", "string"),
+    Field("answer_count", "integer", default=0),
+    Field("correct_count", "integer", default=0),
+    migrate=table_migrate_prefix + "user_answer_counters.table",
+)
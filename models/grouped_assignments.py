@@ -64,3 +64,14 @@ db.define_table(
     Field("comment", type="text"),
     migrate=table_migrate_prefix + "question_grades.table",
 )
+
+# When each question of an assignment was last autograded for the whole course: the id of the last row of its answer table then, and the settings it was graded with. Later runs only regrade students with newer answers; see ``_bulk_autograde`` in ``modules/rs_grading.py``.
+db.define_table(
+    "autograde_watermarks",
+    Field("assignment_id", db.assignments),
+    Field("div_id", "string"),
+    Field("last_id", "bigint"),
+    Field("grading_settings", "string"),
+    Field("graded_at", "datetime"),
+    migrate=table_migrate_prefix + "autograde_watermarks.table",
+)
@@ -2,7 +2,19 @@ from gluon.scheduler import Scheduler
 from gluon import current
 
 from feedback import _scheduled_builder  # noqa: F401
+from sid_alias import merge_sid_aliases
+from user_counts import rollup_first_seen
 
 if settings.academy_mode:
     scheduler = Scheduler(db, migrate=table_migrate_prefix, heartbeat=1)
     current.scheduler = scheduler
+
+
+# Rewrite the history of anonymous readers who have since logged in. ``rsmanage mergesids --every`` queues this as a repeating task.
+def merge_sid_aliases_task():
+    return merge_sid_aliases(db)
+
+
+# Add the readers seen since the last run to ``user_first_seen``. ``rsmanage rollupusers --every`` queues this as a repeating task.
+def rollup_first_seen_task():
+    return rollup_first_seen(db)
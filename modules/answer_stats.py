@@ -0,0 +1,378 @@
+# ************************************************
+# |docname| - Incrementally maintained answer stats
+# ************************************************
+# Reports such as ``getaggregateresults``, ``getpollresults`` and
+# ``gettop10Answers``, and the reader's own percent correct shown with them,
+# used to aggregate ``useinfo`` or an answer table on every request. Instead, the tables here are updated as events are logged, by
+# :func:`record_answer_stats`, which ``log_useinfo_rows`` calls, and by
+# :func:`record_answer_rows`, which ``hsblog`` calls after saving answers. Each
+# can be rebuilt with ``rsmanage rebuildstats``.
+#
+# PostgreSQL 9.4 lacks ``INSERT ... ON CONFLICT``, so counters are updated in
+# place and inserted only if no row was updated. Two processes may both insert
+# the same key at once; readers always ``SUM`` over matching rows, so that's
+# harmless. Each row's updates run in a savepoint: on PostgreSQL a failed
+# statement aborts the transaction, which would lose the caller's writes too.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import datetime
+import logging
+
+# Third-party imports
+# -------------------
+from gluon import current
+
+# Local imports
+# -------------
+from db_bulk import multirow_insert, savepoint
+
+logger = logging.getLogger(current.settings.logger)
+logger.setLevel(current.settings.log_level)
+
+
+# The answer tables whose rows are counted in ``user_answer_counters``, mapped to the event stored there.
+COUNTED_TABLES = {"mchoice_answers": "mChoice", "fitb_answers": "fillb"}
+
+# The ``useinfo`` events ``record_answer_stats`` updates stats for.
+STATS_EVENTS = ("mChoice", "poll")
+
+
+# Return ``(answer, correct)`` for the ``act`` of an ``mChoice`` event, such as ``answer:2:correct``. Acts which can't be parsed give an empty answer; they still count toward the total.
+def parse_mchoice_act(act):
+    parts = act.split(":")
+    answer = parts[1] if len(parts) > 1 else ""
+    return answer, "correct" in act
+
+
+# Return True if ``value``, as received for a boolean field, is stored as true; this matches the way pydal represents booleans.
+def is_correct(value):
+    return bool(value) and str(value)[:1].upper() not in ("0", "F")
+
+
+# Add to the counters of the row selected by ``key``, a dict of field values, in ``table``. ``counts`` maps each counter field to the amount to add.
+def increment(db, table, key, counts):
+    query = None
+    for name, value in key.items():
+        q = table[name] == value
+        query = q if query is None else query & q
+    if not db(query).update(
+        **{name: table[name] + count for name, count in counts.items()}
+    ):
+        fields = dict(key)
+        fields.update(counts)
+        table.insert(**fields)
+
+
+# Return the option number voted for in the ``act`` of a ``poll`` event, or ``None`` if it can't be parsed.
+def parse_poll_act(act):
+    try:
+        return int(act.split(":")[0])
+    except ValueError:
+        return None
+
+
+# Record the vote in ``row``, a ``poll`` event, replacing the reader's previous vote, if any, in ``poll_votes`` and adjusting ``poll_option_counts`` to match.
+def record_poll_vote(db, row):
+    vote = parse_poll_act(row.get("act") or "")
+    if vote is None:
+        return
+    votes = db.poll_votes
+    key = dict(course_name=row.get("course_id"), div_id=row.get("div_id"))
+    fields = dict(
+        key,
+        sid=row.get("sid"),
+        act=row.get("act"),
+        vote=vote,
+        timestamp=row.get("timestamp") or datetime.datetime.utcnow(),
+    )
+    previous = (
+        db(
+            (votes.course_name == key["course_name"])
+            & (votes.div_id == key["div_id"])
+            & (votes.sid == fields["sid"])
+        )
+        .select(votes.id, votes.vote, for_update=True)
+        .first()
+    )
+    if previous:
+        db(votes.id == previous.id).update(**fields)
+        if previous.vote == vote:
+            return
+        increment(
+            db, db.poll_option_counts, dict(key, vote=previous.vote), {"vote_count": -1}
+        )
+    else:
+        votes.insert(**fields)
+    increment(db, db.poll_option_counts, dict(key, vote=vote), {"vote_count": 1})
+
+
+# Delete the votes of ``sid`` from ``poll_votes``, removing them from ``poll_option_counts``.
+def delete_poll_votes(db, sid):
+    votes = db.poll_votes
+    for row in db(votes.sid == sid).select(votes.course_name, votes.div_id, votes.vote):
+        increment(
+            db,
+            db.poll_option_counts,
+            dict(course_name=row.course_name, div_id=row.div_id, vote=row.vote),
+            {"vote_count": -1},
+        )
+    db(votes.sid == sid).delete()
+
+
+# Update the stats for ``rows``, a list of ``useinfo`` rows (dicts) which were just logged. Errors are logged, never raised, since this is a side effect of logging.
+def record_answer_stats(db, rows):
+    for row in rows:
+        # Most events, such as page views, update no stats; don't open a savepoint for them.
+        if row.get("event") not in STATS_EVENTS:
+            continue
+        try:
+            with savepoint(db):
+                if row.get("event") == "mChoice":
+                    answer, correct = parse_mchoice_act(row.get("act") or "")
+                    ts = row.get("timestamp") or datetime.datetime.utcnow()
+                    increment(
+                        db,
+                        db.question_answer_stats,
+                        dict(
+                            course_name=row.get("course_id"),
+                            div_id=row.get("div_id"),
+                            answer=answer,
+                            correct=correct,
+                            day=ts.date(),
+                        ),
+                        {"answer_count": 1},
+                    )
+                elif row.get("event") == "poll":
+                    record_poll_vote(db, row)
+        except Exception as e:
+            logger.error(
+                "failed to update answer stats for {} -- {}".format(
+                    row.get("div_id"), e
+                )
+            )
+
+
+# Update the stats for ``rows``, a list of dicts just inserted into the answer table ``tablename``. Errors are logged, never raised, since the answers are already saved.
+def record_answer_rows(db, tablename, rows):
+    for row in rows:
+        try:
+            with savepoint(db):
+                if tablename in COUNTED_TABLES:
+                    increment(
+                        db,
+                        db.user_answer_counters,
+                        dict(
+                            course_name=row.get("course_name"),
+                            sid=row.get("sid"),
+                            event=COUNTED_TABLES[tablename],
+                        ),
+                        {
+                            "answer_count": 1,
+                            "correct_count": 1 if is_correct(row.get("correct")) else 0,
+                        },
+                    )
+                if tablename == "fitb_answers":
+                    ts = row.get("timestamp") or datetime.datetime.utcnow()
+                    increment(
+                        db,
+                        db.fitb_answer_counts,
+                        dict(
+                            course_name=row.get("course_name"),
+                            div_id=row.get("div_id"),
+                            answer=row.get("answer"),
+                            day=ts.date(),
+                        ),
+                        {"answer_count": 1},
+                    )
+        except Exception as e:
+            logger.error(
+                "failed to update {} stats for {} -- {}".format(
+                    tablename, row.get("div_id"), e
+                )
+            )
+
+
+# Return ``(answers, correct answers)`` given by ``sid`` in ``course_name`` to questions of type ``event``, which is ``mChoice`` or ``fillb``.
+def user_answer_counts(db, course_name, sid, event):
+    counters = db.user_answer_counters
+    total = counters.answer_count.sum()
+    correct = counters.correct_count.sum()
+    row = (
+        db(
+            (counters.course_name == course_name)
+            & (counters.sid == sid)
+            & (counters.event == event)
+        )
+        .select(total, correct)
+        .first()
+    )
+    return (row[total] or 0, row[correct] or 0) if row else (0, 0)
+
+
+# Return the ``limit`` most frequent answers to the fill-in-the-blank question ``div_id`` in ``course_name`` since the date ``since``, as a list of ``(answer, count)``, most frequent first.
+def top_fitb_answers(db, course_name, div_id, since, limit=10):
+    counts = db.fitb_answer_counts
+    total = counts.answer_count.sum()
+    rows = db(
+        (counts.course_name == course_name)
+        & (counts.div_id == div_id)
+        & (counts.day >= since)
+    ).select(
+        counts.answer,
+        total,
+        groupby=counts.answer,
+        orderby=~total | counts.answer,
+        limitby=(0, limit),
+    )
+    return [(row.fitb_answer_counts.answer, row[total]) for row in rows]
+
+
+# Recompute ``question_answer_stats`` from ``useinfo`` for ``course_name``. Returns the number of rows written.
+def rebuild_question_answer_stats(db, course_name):
+    stats = db.question_answer_stats
+    db(stats.course_name == course_name).delete()
+    totals = {}
+    for div_id, act, day, count in db.executesql(
+        """SELECT div_id, act, date("timestamp"), count(*) FROM {useinfo}
+        WHERE course_id = {course} AND event = 'mChoice'
+        GROUP BY div_id, act, date("timestamp");""".format(
+            useinfo=db.useinfo._rname,
+            course=db._adapter.represent(course_name, "string"),
+        )
+    ):
+        answer, correct = parse_mchoice_act(act or "")
+        key = (div_id, answer, correct, _as_date(day))
+        totals[key] = totals.get(key, 0) + count
+    insert_chunked(
+        db,
+        stats,
+        [
+            dict(
+                course_name=course_name,
+                div_id=div_id,
+                answer=answer,
+                correct=correct,
+                day=day,
+                answer_count=count,
+            )
+            for (div_id, answer, correct, day), count in totals.items()
+        ],
+    )
+    db.commit()
+    return len(totals)
+
+
+# Recompute ``poll_votes`` and ``poll_option_counts`` from ``useinfo`` for ``course_name``, keeping each reader's latest vote. Returns the number of votes.
+def rebuild_poll_tallies(db, course_name):
+    db(db.poll_votes.course_name == course_name).delete()
+    db(db.poll_option_counts.course_name == course_name).delete()
+    useinfo = db.useinfo._rname
+    votes = []
+    counts = {}
+    for div_id, sid, act, timestamp in db.executesql(
+        """SELECT div_id, sid, act, "timestamp" FROM {useinfo}
+        JOIN (SELECT max(id) AS mid FROM {useinfo}
+            WHERE event = 'poll' AND course_id = {course} GROUP BY div_id, sid) AS T
+        ON id = T.mid;""".format(
+            useinfo=useinfo, course=db._adapter.represent(course_name, "string")
+        )
+    ):
+        vote = parse_poll_act(act or "")
+        if vote is None:
+            continue
+        votes.append(
+            dict(
+                course_name=course_name,
+                div_id=div_id,
+                sid=sid,
+                act=act,
+                vote=vote,
+                timestamp=timestamp,
+            )
+        )
+        counts[(div_id, vote)] = counts.get((div_id, vote), 0) + 1
+    insert_chunked(db, db.poll_votes, votes)
+    insert_chunked(
+        db,
+        db.poll_option_counts,
+        [
+            dict(course_name=course_name, div_id=div_id, vote=vote, vote_count=count)
+            for (div_id, vote), count in counts.items()
+        ],
+    )
+    db.commit()
+    return len(votes)
+
+
+# Recompute ``fitb_answer_counts`` from ``fitb_answers`` for ``course_name``. Returns the number of rows written.
+def rebuild_fitb_answer_counts(db, course_name):
+    counts = db.fitb_answer_counts
+    db(counts.course_name == course_name).delete()
+    rows = [
+        dict(
+            course_name=course_name,
+            div_id=div_id,
+            answer=answer,
+            day=_as_date(day),
+            answer_count=count,
+        )
+        for div_id, answer, day, count in db.executesql(
+            """SELECT div_id, answer, date("timestamp"), count(*) FROM {fitb}
+            WHERE course_name = {course}
+            GROUP BY div_id, answer, date("timestamp");""".format(
+                fitb=db.fitb_answers._rname,
+                course=db._adapter.represent(course_name, "string"),
+            )
+        )
+    ]
+    insert_chunked(db, counts, rows)
+    db.commit()
+    return len(rows)
+
+
+# Recompute ``user_answer_counters`` from ``mchoice_answers`` and ``fitb_answers`` for ``course_name``. Returns the number of rows written.
+def rebuild_user_answer_counters(db, course_name):
+    counters = db.user_answer_counters
+    db(counters.course_name == course_name).delete()
+    rep = db._adapter.represent
+    rows = []
+    for tablename, event in COUNTED_TABLES.items():
+        for sid, total, correct in db.executesql(
+            """SELECT sid, count(*), sum(CASE WHEN correct = {true} THEN 1 ELSE 0 END)
+            FROM {table} WHERE course_name = {course} GROUP BY sid;""".format(
+                table=db[tablename]._rname,
+                true=rep(True, "boolean"),
+                course=rep(course_name, "string"),
+            )
+        ):
+            rows.append(
+                dict(
+                    course_name=course_name,
+                    sid=sid,
+                    event=event,
+                    answer_count=total,
+                    correct_count=correct or 0,
+                )
+            )
+    insert_chunked(db, counters, rows)
+    db.commit()
+    return len(rows)
+
+
+# Insert ``rows`` into ``table`` with one ``INSERT`` per ``chunk_size`` rows.
+def insert_chunked(db, table, rows, chunk_size=1000):
+    for i in range(0, len(rows), chunk_size):
+        multirow_insert(db, table, rows[i : i + chunk_size])
+
+
+# Some databases return a date as a string.
+def _as_date(value):
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value[:10], "%Y-%m-%d").date()
+    return value
@@ -0,0 +1,159 @@
+# ******************************************
+# |docname| - Compiled book page templates
+# ******************************************
+# Each page of a book is a web2py template. Setting ``response.view`` to the
+# page makes web2py parse and compile it on every request, and pages with long
+# code listings are hundreds of KB. Instead, :func:`compiled_template` keeps
+# each page's compiled code in an LRU cache in each process, keyed by path and
+# checked against the file's modification time and size. Pages ``extend`` and
+# ``include`` views such as ``views/_sphinx_static_files.html``, so the check
+# also covers a digest of the modification times and sizes of every view,
+# recomputed at most every ``_VIEWS_CHECK_SECONDS``. Compiled pages are
+# also saved under ``build/compiled_books``, so other processes (and
+# restarted ones) load them instead of parsing them again.
+# ``rsmanage compilebook`` compiles a whole book there after it's deployed.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import hashlib
+import importlib.util
+import marshal
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Third-party imports
+# -------------------
+from gluon.template import parse_template
+
+# Local imports
+# -------------
+# None.
+
+# The most pages each process keeps compiled.
+_MAX_CACHED = 500
+# How long to reuse the digest of the views before checking them again.
+_VIEWS_CHECK_SECONDS = 2
+
+_lock = threading.Lock()
+# Maps a page's path to ``((modification time, size, views digest), code)``.
+_templates = OrderedDict()
+# Maps a views directory to ``(time to check again, digest)``.
+_views_digests = {}
+
+
+# Return the compiled code of the template ``path``. ``views_dir`` is the directory ``extend`` and ``include`` are relative to, ``cache_dir`` holds compiled pages, and ``context`` is the environment to use when parsing.
+def compiled_template(path, views_dir, cache_dir, context=None):
+    stamp = _stamp(path, views_dir)
+    with _lock:
+        entry = _templates.get(path)
+        if entry and entry[0] == stamp:
+            _templates.move_to_end(path)
+            return entry[1]
+
+    code = _load(path, stamp, cache_dir)
+    if code is None:
+        code = compile_template(path, views_dir, context)
+        _save(path, stamp, cache_dir, code)
+    with _lock:
+        _templates[path] = (stamp, code)
+        _templates.move_to_end(path)
+        while len(_templates) > _MAX_CACHED:
+            _templates.popitem(last=False)
+    return code
+
+
+# Parse and compile the template ``path``, as web2py does for a view.
+def compile_template(path, views_dir, context=None):
+    src = parse_template(path, views_dir, context=context or {})
+    return compile(src.rstrip().replace("\r\n", "\n") + "\n", path, "exec")
+
+
+# Compile every page of the book in ``book_dir`` into ``cache_dir``. ``progress``, if given, is called with the path of each page. Returns the number of pages compiled.
+def compile_book(book_dir, views_dir, cache_dir, progress=None):
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(book_dir):
+        # Static files aren't templates.
+        dirnames[:] = [d for d in dirnames if d not in ("_static", "_images")]
+        for filename in filenames:
+            if not filename.endswith(".html"):
+                continue
+            path = os.path.join(dirpath, filename)
+            code = compile_template(path, views_dir)
+            _save(path, _stamp(path, views_dir), cache_dir, code)
+            count += 1
+            if progress:
+                progress(path)
+    return count
+
+
+# Return what a compiled copy of ``path`` must match: its modification time and size, and the digest of the views it may use.
+def _stamp(path, views_dir):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size, _views_digest(views_dir))
+
+
+# Return a digest of the names, modification times and sizes of the files in ``views_dir``.
+def _views_digest(views_dir):
+    now = time.time()
+    with _lock:
+        entry = _views_digests.get(views_dir)
+        if entry and entry[0] > now:
+            return entry[1]
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(views_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            h.update(
+                "{} {} {}\n".format(path, st.st_mtime_ns, st.st_size).encode("utf-8")
+            )
+    digest = h.hexdigest()
+    with _lock:
+        _views_digests[views_dir] = (now + _VIEWS_CHECK_SECONDS, digest)
+    return digest
+
+
+def _cache_path(path, cache_dir):
+    return os.path.join(
+        cache_dir, hashlib.sha1(path.encode("utf-8")).hexdigest() + ".code"
+    )
+
+
+# Return the compiled code saved for ``path``, or ``None`` if there's none for this version of the file and of Python.
+def _load(path, stamp, cache_dir):
+    try:
+        with open(_cache_path(path, cache_dir), "rb") as f:
+            magic, saved_path, saved_stamp, code = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if (
+        magic != importlib.util.MAGIC_NUMBER
+        or saved_path != path
+        or tuple(saved_stamp) != stamp
+    ):
+        return None
+    return code
+
+
+def _save(path, stamp, cache_dir, code):
+    cache_path = _cache_path(path, cache_dir)
+    tmp_path = "{}.{}".format(cache_path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            marshal.dump((importlib.util.MAGIC_NUMBER, path, stamp, code), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # The cache is only an optimization.
+        pass
@@ -0,0 +1,246 @@
+# ****************************************************
+# |docname| - Content-addressed storage for saved code
+# ****************************************************
+# Each save of an activecode, each copy shared with a partner and each copy
+# broadcast by an instructor used to store the full program text in the
+# ``code`` table. Most of these copies are identical, so the text now lives
+# once in ``code_blobs``, keyed by its SHA-256 hash, and ``code`` rows hold only
+# ``code_hash``. Rows saved before this change keep their text in ``code.code``
+# until ``rsmanage dedupcode`` moves it; readers use :func:`resolve_code`, which
+# handles both kinds of rows.
+#
+# Two processes may store the same new blob at the same moment, producing two
+# identical rows in ``code_blobs``. That's harmless: readers take either one.
+# :func:`store_code` looks blobs up by hash. ``rsmanage initdb`` creates that
+# index; on an existing database, ``rsmanage dedupcode`` calls
+# :func:`ensure_blob_index` to create it before moving any code.
+# Blobs no row references any longer, such as those of a deleted account, are
+# removed by :func:`prune_code_blobs`.
+#
+# ``code_latest`` points to the latest version of each program, so loading it
+# doesn't read every saved version. :func:`note_latest_code` updates it as
+# code is saved; :func:`latest_code` adds the pointer for programs saved
+# before the table existed the first time they're loaded.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import datetime
+import hashlib
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+from db_bulk import multirow_insert, savepoint
+
+
+# Return the key used to store ``code`` in ``code_blobs``.
+def code_hash(code):
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+
+# Create the index on ``code_blobs.hash`` unless it exists.
+def ensure_blob_index(db):
+    if db._dbname == "postgres":
+        # PostgreSQL 9.4 lacks ``CREATE INDEX IF NOT EXISTS``.
+        if not db.executesql("SELECT to_regclass('code_blobs_hash_idx');")[0][0]:
+            try:
+                with savepoint(db):
+                    db.executesql(
+                        "CREATE INDEX code_blobs_hash_idx ON {} USING btree({});".format(
+                            db.code_blobs._rname, db.code_blobs.hash._rname
+                        )
+                    )
+                db.commit()
+            except Exception:
+                # Another process created it first.
+                pass
+
+
+# Store ``code`` in ``code_blobs`` unless it's already there. Returns its hash.
+def store_code(db, code):
+    h = code_hash(code)
+    blobs = db.code_blobs
+    rep = db._adapter.represent
+    db.executesql(
+        "INSERT INTO {table} ({hash}, {code}) SELECT {h}, {c} "
+        "WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {hash} = {h});".format(
+            table=blobs._rname,
+            hash=blobs.hash._rname,
+            code=blobs.code._rname,
+            h=rep(h, "string"),
+            c=rep(code, "text"),
+        )
+    )
+    return h
+
+
+# Fill in ``row.code`` for rows from the ``code`` table which reference a blob, using one query for all of them. Returns ``rows``.
+def resolve_code(db, rows):
+    hashes = {row.code_hash for row in rows if row.code is None and row.code_hash}
+    if hashes:
+        blobs = {
+            blob.hash: blob.code
+            for blob in db(db.code_blobs.hash.belongs(hashes)).select(
+                db.code_blobs.hash, db.code_blobs.code
+            )
+        }
+        for row in rows:
+            if row.code is None and row.code_hash:
+                row.code = blobs.get(row.code_hash)
+    return rows
+
+
+# Note that ``fields``, a row just saved in ``code`` (as ``code_id``, if known), is the latest version of its program.
+def note_latest_code(db, fields, code_id=None):
+    latest = db.code_latest
+    values = dict(
+        code_id=code_id,
+        code_hash=fields.get("code_hash"),
+        timestamp=fields.get("timestamp"),
+    )
+    if not db(
+        (latest.sid == fields.get("sid"))
+        & (latest.acid == fields.get("acid"))
+        & (latest.course_id == fields.get("course_id"))
+    ).update(**values):
+        latest.insert(
+            sid=fields.get("sid"),
+            acid=fields.get("acid"),
+            course_id=fields.get("course_id"),
+            **values
+        )
+
+
+# Move the ``code_latest`` rows of ``sid`` in the course with id ``from_course_id`` to ``to_course_id``, as ``admin.removeStudents`` does with their ``code`` rows. Where ``sid`` already has a row for the same program there, the later version is kept.
+def move_latest_code(db, sid, from_course_id, to_course_id):
+    latest = db.code_latest
+    existing = {
+        row.acid: row
+        for row in db((latest.sid == sid) & (latest.course_id == to_course_id)).select(
+            latest.id, latest.acid, latest.timestamp
+        )
+    }
+    for row in db((latest.sid == sid) & (latest.course_id == from_course_id)).select(
+        latest.id, latest.acid, latest.timestamp
+    ):
+        other = existing.get(row.acid)
+        if other and (other.timestamp or datetime.datetime.min) > (
+            row.timestamp or datetime.datetime.min
+        ):
+            db(latest.id == row.id).delete()
+            continue
+        if other:
+            db(latest.id == other.id).delete()
+        db(latest.id == row.id).update(course_id=to_course_id)
+
+
+# Return the text of the latest version of the program ``acid`` saved by ``sid`` in any course, or ``None`` if there's none.
+def latest_code(db, sid, acid):
+    latest = db.code_latest
+    row = (
+        db((latest.sid == sid) & (latest.acid == acid))
+        .select(orderby=~latest.timestamp | ~latest.id, limitby=(0, 1))
+        .first()
+    )
+    if not row:
+        # Look for a version saved before ``code_latest`` existed.
+        codetbl = db.code
+        code = (
+            db(
+                (codetbl.sid == sid)
+                & (codetbl.acid == acid)
+                & (codetbl.timestamp != None)  # noqa: E711
+            )
+            .select(orderby=~codetbl.id, limitby=(0, 1))
+            .first()
+        )
+        if not code:
+            return None
+        note_latest_code(db, code.as_dict(), code.id)
+        return resolve_code(db, [code])[0].code
+    if row.code_hash:
+        blob = (
+            db(db.code_blobs.hash == row.code_hash)
+            .select(db.code_blobs.code, limitby=(0, 1))
+            .first()
+        )
+        return blob and blob.code
+    code = db.code(row.code_id)
+    return code and resolve_code(db, [code])[0].code
+
+
+# Move the text of ``code`` rows saved before blobs existed into ``code_blobs``, ``batch_size`` rows at a time, committing after each batch so the backfill can be interrupted and resumed. ``progress``, if given, is called with the number of rows moved so far. Returns the number of rows moved.
+def dedup_code(db, batch_size=1000, progress=None):
+    moved = 0
+    last_id = 0
+    while True:
+        rows = db(
+            (db.code.id > last_id)
+            & (db.code.code_hash == None)  # noqa: E711
+            & (db.code.code != None)  # noqa: E711
+        ).select(db.code.id, db.code.code, orderby=db.code.id, limitby=(0, batch_size))
+        if not rows:
+            break
+        last_id = rows.last().id
+
+        by_hash = {}
+        text = {}
+        for row in rows:
+            h = code_hash(row.code)
+            by_hash.setdefault(h, []).append(row.id)
+            text[h] = row.code
+        present = {
+            blob.hash
+            for blob in db(db.code_blobs.hash.belongs(list(by_hash))).select(
+                db.code_blobs.hash, distinct=True
+            )
+        }
+        multirow_insert(
+            db,
+            db.code_blobs,
+            [dict(hash=h, code=text[h]) for h in by_hash if h not in present],
+        )
+        for h, ids in by_hash.items():
+            db(db.code.id.belongs(ids)).update(code_hash=h, code=None)
+        db.commit()
+
+        moved += len(rows)
+        if progress:
+            progress(moved)
+    return moved
+
+
+# Delete the blobs which no ``code`` or ``code_latest`` row references; if ``hashes`` is given, only those blobs are considered. Returns the number of blobs deleted.
+def prune_code_blobs(db, hashes=None):
+    if hashes is not None and not hashes:
+        return 0
+    blobs = db.code_blobs
+    rep = db._adapter.represent
+    only = ""
+    if hashes is not None:
+        only = "{} IN ({}) AND ".format(
+            blobs.hash._rname, ", ".join(rep(h, "string") for h in sorted(hashes))
+        )
+    deleted = db.executesql(
+        "DELETE FROM {blobs} WHERE {only}"
+        "NOT EXISTS (SELECT 1 FROM {code} WHERE {code}.{code_hash} = {blobs}.{hash}) "
+        "AND NOT EXISTS (SELECT 1 FROM {latest} "
+        "WHERE {latest}.{latest_hash} = {blobs}.{hash}) RETURNING 1;".format(
+            blobs=blobs._rname,
+            hash=blobs.hash._rname,
+            only=only,
+            code=db.code._rname,
+            code_hash=db.code.code_hash._rname,
+            latest=db.code_latest._rname,
+            latest_hash=db.code_latest.code_hash._rname,
+        )
+    )
+    return len(deleted)
@@ -0,0 +1,110 @@
+# ***************************************
+# |docname| - Multi-row writes via the DAL
+# ***************************************
+# The DAL's ``bulk_insert`` issues one ``INSERT`` per row on PostgreSQL. The
+# helpers here build a single statement instead, using the DAL's adapter to
+# quote names and to represent values, so they work for any table defined in
+# the models.
+#
+# :func:`savepoint` lets a write which may fail be undone without losing the
+# rest of the request's transaction.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+from contextlib import contextmanager
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+# None.
+
+
+# Return the SQL literal for ``value`` stored in ``field``.
+def _sql_value(db, field, value):
+    return db._adapter.represent(value, field.type)
+
+
+# Insert ``rows``, a list of dicts, into ``table`` using one ``INSERT`` statement. Every row is written with the union of the keys found in ``rows``; missing keys are stored as ``NULL``. Returns the number of rows written.
+def multirow_insert(db, table, rows):
+    if not rows:
+        return 0
+    names = []
+    for row in rows:
+        for name in row:
+            if name not in names:
+                names.append(name)
+    fields = [table[name] for name in names]
+    values = ",".join(
+        "({})".format(
+            ",".join(_sql_value(db, field, row.get(field.name)) for field in fields)
+        )
+        for row in rows
+    )
+    db.executesql(
+        "INSERT INTO {} ({}) VALUES {};".format(
+            table._rname, ",".join(field._rname for field in fields), values
+        )
+    )
+    return len(rows)
+
+
+# The SQL types ``multirow_update`` casts values to, by field type; values of other types are cast to ``TEXT``. Without a cast, PostgreSQL can't tell the type of a ``VALUES`` column holding only ``NULL`` values.
+_CAST_TYPES = {
+    "id": "INTEGER",
+    "integer": "INTEGER",
+    "bigint": "BIGINT",
+    "double": "DOUBLE PRECISION",
+    "date": "DATE",
+    "datetime": "TIMESTAMP",
+}
+
+
+def _cast_value(db, field, value):
+    field_type = "integer" if field.type.startswith("reference") else field.type
+    return "CAST({} AS {})".format(
+        _sql_value(db, field, value), _CAST_TYPES.get(field_type, "TEXT")
+    )
+
+
+# Update the rows of ``table`` given by ``rows``, a list of dicts which each hold the row's ``id`` and the same other keys, using one ``UPDATE`` statement. Returns the number of rows given.
+def multirow_update(db, table, rows):
+    if not rows:
+        return 0
+    fields = [table._id] + [table[name] for name in rows[0] if name != "id"]
+    values = ",".join(
+        "({})".format(
+            ",".join(_cast_value(db, field, row.get(field.name)) for field in fields)
+        )
+        for row in rows
+    )
+    db.executesql(
+        "UPDATE {table} SET {sets} FROM (VALUES {values}) AS v ({names}) "
+        "WHERE {table}.{id} = v.{id};".format(
+            table=table._rname,
+            sets=",".join("{0} = v.{0}".format(field._rname) for field in fields[1:]),
+            values=values,
+            names=",".join(field._rname for field in fields),
+            id=table._id._rname,
+        )
+    )
+    return len(rows)
+
+
+# Run the body of a ``with`` statement inside a savepoint. If it raises, its writes are rolled back and the exception is re-raised; the rest of the transaction is kept. Without this, one failed statement makes PostgreSQL reject every later statement in the transaction, including the request's other writes.
+@contextmanager
+def savepoint(db, name="rs_savepoint"):
+    db.executesql("SAVEPOINT {};".format(name))
+    try:
+        yield
+    except Exception:
+        db.executesql("ROLLBACK TO SAVEPOINT {};".format(name))
+        raise
+    db.executesql("RELEASE SAVEPOINT {};".format(name))
@@ -3,6 +3,7 @@ import logging
 import datetime
 import six
 from gluon import current, URL, redirect
+from sid_alias import sid_and_aliases
 
 rslogger = logging.getLogger(current.settings.logger)
 rslogger.setLevel(current.settings.log_level)
@@ -499,7 +500,7 @@ class DashboardDataAnalyzer(object):
 
         self.logs = current.db(
             (current.db.useinfo.course_id == self.course.course_name)
-            & (current.db.useinfo.sid == username)
+            & (current.db.useinfo.sid.belongs(sid_and_aliases(current.db, username)))
             & (current.db.useinfo.timestamp >= self.course.term_start_date)
         ).select(
             current.db.useinfo.timestamp,
@@ -66,6 +66,21 @@ def is_server_feedback(div_id, course):
         return False, None
 
 
+# Return a dict mapping each of ``div_ids`` in ``course`` whose feedback should be computed on the server to that feedback, using one query. This is :func:`is_server_feedback` for a page of questions.
+def server_feedback(div_ids, course):
+    db = current.db
+    rows = db(
+        (db.questions.name.belongs(div_ids))
+        & (db.questions.base_course == db.courses.base_course)
+        & (db.courses.course_name == course)
+    ).select(db.questions.name, db.questions.feedback, db.courses.login_required)
+    res = {}
+    for row in rows:
+        if row.questions.feedback is not None and row.courses.login_required:
+            res.setdefault(row.questions.name, json.loads(row.questions.feedback))
+    return res
+
+
 # Provide feedback for a fill-in-the-blank problem. This should produce
 # identical results to the code in ``evaluateAnswers`` in ``fitb.js``.
 def fitb_feedback(answer_json, feedback):
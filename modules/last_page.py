@@ -0,0 +1,188 @@
+# ***************************************************
+# |docname| - Coalesce writes of a reader's last page
+# ***************************************************
+# ``updatelastpage`` is called as readers scroll, so most calls only move the
+# scroll location on the page already saved in ``user_state``. Each process
+# remembers when it last wrote each reader's position. A new page is written
+# at once; a new scroll location on the same page is held in memory until
+# ``settings.last_page_write_interval`` seconds have passed since the last
+# write, so a reader costs at most one ``UPDATE`` per interval while scrolling.
+# Held positions are written by a background thread, using its own database
+# connection, once the interval has passed; when the process exits; and before
+# the reader's own position is read by :func:`flush_last_page`. A position is
+# only written over an older one, so a slow write of a held position can't
+# replace a newer position written meanwhile.
+#
+# Under uwsgi, this requires ``enable-threads`` (or ``threads`` > 1) so the
+# flusher thread runs.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# Third-party imports
+# -------------------
+from gluon import current
+from gluon.dal import DAL, Field
+
+#
+# Local imports
+# -------------
+# None.
+
+logger = logging.getLogger(current.settings.logger)
+logger.setLevel(current.settings.log_level)
+
+# The most readers each process remembers.
+_MAX_CACHED = 10000
+
+_lock = threading.Lock()
+# Maps ``(user_id, course_name)`` to ``[time written, page url written, fields held or None]``.
+_positions = OrderedDict()
+# The thread which writes held positions, once started.
+_flusher = None
+
+
+# Save ``fields``, the ``user_state`` fields describing the last page ``user_id`` read in ``course_name``, holding scroll-only changes for up to ``interval`` seconds. ``database_uri`` is used by the thread which writes them.
+def save_last_page(db, user_id, course_name, fields, interval, database_uri):
+    _start_flusher(db, database_uri, interval)
+    key = (user_id, course_name)
+    now = time.time()
+    with _lock:
+        entry = _positions.get(key)
+        hold = (
+            entry is not None
+            and entry[1] == fields["last_page_url"]
+            and now - entry[0] < interval
+        )
+        if hold:
+            entry[2] = fields
+    if not hold:
+        _write(db, key, fields, now)
+
+
+# Write any position held for ``user_id`` in ``course_name``, so it can be read from ``user_state``.
+def flush_last_page(db, user_id, course_name):
+    key = (user_id, course_name)
+    _flush(db, lambda k, entry: k == key)
+
+
+# Write the held positions whose key and entry satisfy ``select``.
+def _flush(db, select):
+    with _lock:
+        held = [
+            (key, entry[2])
+            for key, entry in _positions.items()
+            if entry[2] and select(key, entry)
+        ]
+        for key, fields in held:
+            _positions[key][2] = None
+    now = time.time()
+    for key, fields in held:
+        _write(db, key, fields, now)
+
+
+def _write(db, key, fields, now):
+    count = _update(db, key, fields)
+    evicted = []
+    with _lock:
+        if count:
+            _positions[key] = [now, fields["last_page_url"], None]
+            _positions.move_to_end(key)
+        else:
+            # There's no row to update yet; don't hold later changes for it.
+            _positions.pop(key, None)
+        while len(_positions) > _MAX_CACHED:
+            evicted.append(_positions.popitem(last=False))
+    for key, entry in evicted:
+        if entry[2]:
+            _update(db, key, entry[2])
+
+
+def _update(db, key, fields):
+    user_id, course_name = key
+    state = db.user_state
+    return db(
+        (state.user_id == user_id)
+        & (state.course_id == course_name)
+        & (
+            (state.last_page_accessed_on < fields["last_page_accessed_on"])
+            | (state.last_page_accessed_on == None)  # noqa: E711
+        )
+    ).update(**fields)
+
+
+def _start_flusher(db, database_uri, interval):
+    global _flusher
+    with _lock:
+        if _flusher is not None:
+            return
+        fields = [
+            (field.name, field.type) for field in db.user_state if field.name != "id"
+        ]
+        _flusher = threading.Thread(
+            target=_run_flusher,
+            args=(database_uri, fields, interval),
+            name="last-page-flusher",
+        )
+        _flusher.daemon = True
+        _flusher.start()
+    atexit.register(_flush_at_exit, database_uri, fields)
+
+
+# Every ``interval`` seconds, write the positions held for at least that long, reusing the thread's connection.
+def _run_flusher(database_uri, fields, interval):
+    db = None
+    while True:
+        time.sleep(interval)
+        now = time.time()
+        db = _flush_held(
+            database_uri, fields, lambda key, entry: now - entry[0] >= interval, db
+        )
+
+
+def _flush_at_exit(database_uri, fields):
+    db = _flush_held(database_uri, fields, lambda key, entry: True)
+    _close(db)
+
+
+# Write the held positions whose key and entry satisfy ``select`` using ``db``, a connection of this thread's own; if it's ``None``, connect, defining ``user_state`` from ``fields``, a list of ``(name, type)``. Returns the connection to use next time, or ``None`` if it failed.
+def _flush_held(database_uri, fields, select, db=None):
+    with _lock:
+        if not any(
+            entry[2] and select(key, entry) for key, entry in _positions.items()
+        ):
+            return db
+    try:
+        if db is None:
+            # DAL instances are per-thread singletons keyed by ``db_uid``; use our own so this never picks up a request's ``db``.
+            db = DAL(database_uri, pool_size=0, migrate=False, db_uid="last_page")
+            db.define_table(
+                "user_state",
+                *[Field(name, type) for (name, type) in fields],
+                migrate=False
+            )
+        _flush(db, select)
+        db.commit()
+    except Exception as e:
+        logger.error("failed to write held last page positions -- {}".format(e))
+        _close(db)
+        return None
+    return db
+
+
+def _close(db):
+    if db is not None:
+        try:
+            db.close()
+        except Exception:
+            pass
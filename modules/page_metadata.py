@@ -0,0 +1,87 @@
+# ********************************************
+# |docname| - Cache what a book page contains
+# ********************************************
+# Every view of a book page needs the questions on the page and the table of
+# contents of its chapter. These only change when the book is rebuilt, so
+# each process caches them by ``(base_course, chapter, subchapter)``. A
+# rebuild or deploy rewrites the page's HTML file, so an entry is used only
+# while the file's modification time matches the one it was cached with.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import os
+import threading
+from collections import OrderedDict
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+# None.
+
+# The most pages each process remembers.
+_MAX_CACHED = 5000
+
+_lock = threading.Lock()
+# Maps ``(base_course, chapter, subchapter)`` to ``(modification time, metadata)``.
+_pages = OrderedDict()
+
+
+# Return a dict describing the page ``subchapter`` of ``chapter`` in ``base_course``, whose HTML is in ``book_path``: ``question_names`` lists the questions on the page and ``subchapter_list`` is the chapter's table of contents.
+def page_metadata(db, base_course, chapter, subchapter, book_path):
+    key = (base_course, chapter, subchapter)
+    mtime = os.stat(book_path).st_mtime
+    entry = _pages.get(key)
+    if entry and entry[0] == mtime:
+        return entry[1]
+
+    questions = db(
+        (db.questions.subchapter == subchapter)
+        & (db.questions.chapter == chapter)
+        & (db.questions.from_source == True)  # noqa: E712
+        & (db.questions.base_course == base_course)
+    ).select(db.questions.name)
+    metadata = dict(
+        question_names=[q.name for q in questions],
+        subchapter_list=subchapter_toc(db, base_course, chapter),
+    )
+    with _lock:
+        _pages[key] = (mtime, metadata)
+        _pages.move_to_end(key)
+        while len(_pages) > _MAX_CACHED:
+            _pages.popitem(last=False)
+    return metadata
+
+
+# Return the table of contents of ``chap`` in ``course``: a list of dicts giving the URI and title of each sub-chapter.
+def subchapter_toc(db, course, chap):
+    res = db(
+        (db.chapters.id == db.sub_chapters.chapter_id)
+        & (db.chapters.course_id == course)
+        & (db.chapters.chapter_label == chap)
+    ).select(
+        db.chapters.chapter_num,
+        db.sub_chapters.sub_chapter_num,
+        db.chapters.chapter_label,
+        db.sub_chapters.sub_chapter_label,
+        db.sub_chapters.sub_chapter_name,
+        orderby=db.sub_chapters.sub_chapter_num,
+    )
+    toclist = []
+    for row in res:
+        sc_url = "{}.html".format(row.sub_chapters.sub_chapter_label)
+        title = "{}.{} {}".format(
+            row.chapters.chapter_num,
+            row.sub_chapters.sub_chapter_num,
+            row.sub_chapters.sub_chapter_name,
+        )
+        toclist.append(dict(subchap_uri=sc_url, title=title))
+
+    return toclist
@@ -0,0 +1,93 @@
+# ******************************************
+# |docname| - Track which readers are online
+# ******************************************
+# ``getnumonline`` is polled by every open book page. Counting the distinct
+# sids in the last five minutes of ``useinfo`` made each poll scan the largest
+# table. Instead, every event logged through ``log_useinfo`` notes its reader
+# in the ``presence`` table, which holds one row per (minute, course, sid) for
+# the last few minutes. Each process remembers who it has noted in the
+# current minute, so a reader costs at most one small ``INSERT`` per minute per
+# process; the table stays small enough to count directly.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import datetime
+import logging
+import threading
+
+# Third-party imports
+# -------------------
+from gluon import current
+
+# Local imports
+# -------------
+from db_bulk import multirow_insert, savepoint
+
+logger = logging.getLogger(current.settings.logger)
+logger.setLevel(current.settings.log_level)
+
+# How many minutes of activity count as online.
+ONLINE_MINUTES = 5
+# How many minutes of rows to keep.
+_KEEP_MINUTES = 2 * ONLINE_MINUTES
+
+_lock = threading.Lock()
+_current_minute = None
+# The ``(minute, course_name, sid)`` keys noted by this process during ``_current_minute``.
+_seen = set()
+
+
+def _minute(ts):
+    return ts.replace(second=0, microsecond=0)
+
+
+# Note the readers of ``rows``, a list of ``useinfo`` rows (dicts), as present. Errors are logged, never raised, since this is a side effect of logging.
+def note_presence(db, rows):
+    global _current_minute
+    new = set()
+    prune_before = None
+    with _lock:
+        for row in rows:
+            minute = _minute(row.get("timestamp") or datetime.datetime.utcnow())
+            if _current_minute is None or minute > _current_minute:
+                _current_minute = minute
+                _seen.clear()
+                prune_before = minute - datetime.timedelta(minutes=_KEEP_MINUTES)
+            key = (minute, row.get("course_id"), row.get("sid"))
+            if key not in _seen:
+                new.add(key)
+    # Most events are from readers already noted this minute; don't open a savepoint for nothing.
+    if not new and not prune_before:
+        return
+
+    # A failed statement would abort the caller's transaction on PostgreSQL, so these writes are undone on their own. The readers are only remembered once they're saved.
+    try:
+        with savepoint(db):
+            multirow_insert(
+                db,
+                db.presence,
+                [dict(minute=m, course_name=c, sid=s) for m, c, s in sorted(new)],
+            )
+            if prune_before:
+                db(db.presence.minute < prune_before).delete()
+    except Exception as e:
+        logger.error("failed to record presence -- {}".format(e))
+        return
+    with _lock:
+        _seen.update(key for key in new if key[0] == _current_minute)
+
+
+# Return the number of distinct readers active in the last ``ONLINE_MINUTES`` minutes, in ``course_name`` if given.
+def count_online(db, course_name=None, cache=None):
+    since = _minute(
+        datetime.datetime.utcnow() - datetime.timedelta(minutes=ONLINE_MINUTES)
+    )
+    query = db.presence.minute >= since
+    if course_name:
+        query &= db.presence.course_name == course_name
+    return db(query).count(distinct=db.presence.sid, cache=cache)
@@ -0,0 +1,178 @@
+# ***************************************************
+# |docname| - A pool of warm question-preview workers
+# ***************************************************
+# ``ajax.preview_question`` used to write the question to
+# ``build/preview/_sources/index.rst`` and run ``python -m runestone build``
+# for every preview. Each build re-imported Sphinx and took seconds, and two
+# previews at once overwrote each other's files. Instead, each web server
+# process keeps up to ``settings.preview_workers`` workers (see
+# ``preview_worker.py``), each with Sphinx already imported and its own
+# scratch copy of the preview project. A preview waits for an idle worker, so
+# previews run in parallel up to the pool size. Rendered previews are cached
+# by the hash of their source, so previewing the same question again is
+# immediate.
+#
+# Workers are started on first use. A worker which dies, or takes longer than
+# ``settings.preview_timeout`` seconds, is killed and replaced on the next
+# preview.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import atexit
+import hashlib
+import itertools
+import json
+import os
+import queue
+import subprocess
+import threading
+from collections import OrderedDict
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+# None.
+
+_WORKER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "preview_worker.py"
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PreviewPool(object):
+    def __init__(
+        self,
+        # The Python interpreter which runs the workers.
+        python,
+        # The preview project, which holds ``conf.py`` and ``pavement.py``.
+        project_dir,
+        # The directory holding each worker's scratch directory.
+        scratch_root,
+        # The number of workers.
+        size=2,
+        # Seconds to wait for a worker, and for it to render a preview.
+        timeout=60,
+        # The number of rendered previews to keep.
+        cache_size=500,
+    ):
+        self.python = python
+        self.project_dir = project_dir
+        self.scratch_root = scratch_root
+        self.timeout = timeout
+        self.cache_size = cache_size
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        # Maps the hash of a question's source to its rendered HTML.
+        self._cache = OrderedDict()
+        # Idle workers; ``None`` is a slot whose worker hasn't been started.
+        self._idle = queue.Queue()
+        self._workers = []
+        for i in range(size):
+            self._idle.put(None)
+        atexit.register(self.close)
+
+    # Return the HTML of the component in ``source``, a question in RST, or a string starting with ``Error:``.
+    def render(self, source):
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            return "Error: all preview workers are busy; try again."
+        try:
+            if worker is None or worker.poll() is not None:
+                worker = self._start()
+            res = self._request(worker, source)
+        except Exception as e:
+            res = {"error": "Error: {}".format(e)}
+        finally:
+            if worker is not None and worker.poll() is not None:
+                worker = None
+            self._idle.put(worker)
+
+        if "error" in res:
+            return res["error"]
+        with self._lock:
+            self._cache[key] = res["html"]
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return res["html"]
+
+    # Stop every worker.
+    def close(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            if worker.poll() is None:
+                worker.stdin.close()
+                try:
+                    worker.wait(5)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+
+    def _start(self):
+        # Prevent any changes to the database when building a preview question.
+        env = dict(os.environ)
+        env.pop("DBURL", None)
+        scratch_dir = os.path.join(
+            self.scratch_root, "{}-{}".format(os.getpid(), next(self._ids))
+        )
+        worker = subprocess.Popen(
+            [self.python, _WORKER_SCRIPT, self.project_dir, scratch_dir],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            encoding="utf-8",
+            env=env,
+        )
+        with self._lock:
+            self._workers = [w for w in self._workers if w.poll() is None]
+            self._workers.append(worker)
+        return worker
+
+    # Send ``source`` to ``worker`` and return its response. The worker is killed if it takes too long.
+    def _request(self, worker, source):
+        t = threading.Timer(self.timeout, worker.kill)
+        t.start()
+        try:
+            worker.stdin.write(json.dumps(dict(source=source)) + "\n")
+            worker.stdin.flush()
+            line = worker.stdout.readline()
+        finally:
+            t.cancel()
+        if not line:
+            worker.kill()
+            worker.wait()
+            return {"error": "Error: the preview worker stopped or timed out."}
+        return json.loads(line)
+
+
+# Return this process's pool, creating it on first use.
+def get_pool(settings, folder):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PreviewPool(
+                    settings.python_interpreter,
+                    os.path.join(folder, "build", "preview"),
+                    os.path.join(folder, "build", "preview_workers"),
+                    size=settings.preview_workers,
+                    timeout=settings.preview_timeout,
+                )
+    return _pool
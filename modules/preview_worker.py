@@ -0,0 +1,111 @@
+# ***********************************************
+# |docname| - Render question previews in-process
+# ***********************************************
+# A worker started by :class:`preview_pool.PreviewPool`, as::
+#
+#   python preview_worker.py <preview project directory> <scratch directory>
+#
+# It copies the preview project (``build/preview``) to its own scratch
+# directory, imports Sphinx and the Runestone extensions once, then reads
+# requests from stdin, one JSON object per line, each holding the RST
+# ``source`` of a question. For each, it builds the page with Sphinx and writes
+# one line of JSON to stdout: ``{"html": ...}`` holding the rendered component,
+# or ``{"error": ...}``. It exits when stdin is closed.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import io
+import json
+import os
+import shutil
+import sys
+
+# Third-party imports
+# -------------------
+from lxml import html
+from sphinx.application import Sphinx
+
+# Local imports
+# -------------
+# None.
+
+
+# Copy the preview project in ``project_dir`` to ``scratch_dir``, without any previous build output, and make it the current directory.
+def setup_scratch(project_dir, scratch_dir):
+    if os.path.exists(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    shutil.copytree(
+        project_dir, scratch_dir, ignore=shutil.ignore_patterns("build", "_sources")
+    )
+    os.makedirs(os.path.join(scratch_dir, "_sources"))
+    os.chdir(scratch_dir)
+    sys.path.insert(0, scratch_dir)
+
+
+# Build ``source`` as the preview page and return the response to send.
+def render(source, template_args):
+    with open(os.path.join("_sources", "index.rst"), "w", encoding="utf-8") as ixf:
+        ixf.write(source)
+
+    # The same values ``runestone build`` passes to the templates, as ``-A`` options.
+    confoverrides = {
+        "html_context.{}".format(key): value for key, value in template_args.items()
+    }
+    log = io.StringIO()
+    app = Sphinx(
+        srcdir="_sources",
+        confdir=".",
+        outdir=os.path.join("build", "preview"),
+        doctreedir=os.path.join("build", "doctrees"),
+        buildername="html",
+        confoverrides=confoverrides,
+        status=log,
+        warning=log,
+        freshenv=True,
+    )
+    app.build()
+    if app.statuscode:
+        return {"error": "Error: Runestone build failed:\n\n" + log.getvalue()}
+
+    with open(
+        os.path.join("build", "preview", "index.html"), "r", encoding="utf-8"
+    ) as ixf:
+        tree = html.fromstring(ixf.read())
+    component = tree.cssselect(".runestone")
+    if len(component) == 0:
+        component = tree.cssselect(".system-message")
+    if len(component) == 0:
+        return {"error": "Error: Runestone content missing."}
+    return {"html": html.tostring(component[0]).decode("utf-8")}
+
+
+def main(project_dir, scratch_dir):
+    # Keep stdout for responses; anything Sphinx or an extension prints goes to stderr.
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    sys.stdout = sys.stderr
+
+    setup_scratch(project_dir, scratch_dir)
+    # ``pavement.py`` holds the template values for ``runestone build``; use the same ones.
+    import pavement
+
+    template_args = dict(pavement.options.build.template_args)
+    try:
+        for line in sys.stdin:
+            try:
+                res = render(json.loads(line)["source"], template_args)
+            except Exception as e:
+                res = {"error": "Error: {}".format(e)}
+            responses.write(json.dumps(res) + "\n")
+            responses.flush()
+    finally:
+        os.chdir(project_dir)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(os.path.abspath(sys.argv[1]), os.path.abspath(sys.argv[2]))
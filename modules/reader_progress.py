@@ -0,0 +1,118 @@
+# ******************************************************
+# |docname| - A reader's completion status and last page
+# ******************************************************
+# A book page needs the completion status of its sub-chapter, the status of
+# every sub-chapter (for the table of contents) and the reader's last page.
+# ``ajax.getCompletionStatus``, ``ajax.getAllCompletionStatus`` and
+# ``ajax.getlastpage`` return these separately; ``books._route_book`` embeds
+# all of them in the page it renders. Both use the functions here. Progress is
+# only started for pages which are sub-chapters of the book, not for pages
+# such as its index.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import datetime
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+from last_page import flush_last_page
+
+
+# Return the dict describing ``row``, from ``user_sub_chapter_progress``, which ``getAllCompletionStatus`` returns.
+def completion_dict(row):
+    return {
+        "chapterName": row.chapter_id,
+        "subChapterName": row.sub_chapter_id,
+        "completionStatus": row.status,
+        "endDate": 0 if row.end_date is None else row.end_date.strftime("%d %b, %Y"),
+    }
+
+
+# Note that ``user_id`` has started ``sub_chapter`` of ``chapter``, adding the chapter as well if needed. Nothing is recorded unless it's a sub-chapter of ``base_course``. Returns ``True`` if progress was started.
+def start_progress(db, user_id, base_course, chapter, sub_chapter):
+    if db(
+        (db.chapters.course_id == base_course)
+        & (db.chapters.chapter_label == chapter)
+        & (db.sub_chapters.chapter_id == db.chapters.id)
+        & (db.sub_chapters.sub_chapter_label == sub_chapter)
+    ).isempty():
+        return False
+    db.user_sub_chapter_progress.insert(
+        user_id=user_id,
+        chapter_id=chapter,
+        sub_chapter_id=sub_chapter,
+        status=-1,
+        start_date=datetime.datetime.utcnow(),
+    )
+    # the chapter might exist without the subchapter
+    if db(
+        (db.user_chapter_progress.user_id == user_id)
+        & (db.user_chapter_progress.chapter_id == chapter)
+    ).isempty():
+        db.user_chapter_progress.insert(user_id=user_id, chapter_id=chapter, status=-1)
+    return True
+
+
+# Return ``(status, statuses)``: the completion status of ``sub_chapter`` of ``chapter`` for ``user_id``, and a list of the :func:`completion_dict` of every sub-chapter the reader has started. Both come from one query. If this is the reader's first view of the sub-chapter, it's started; see :func:`start_progress`.
+def completion_status(db, user_id, base_course, chapter, sub_chapter):
+    progress = db.user_sub_chapter_progress
+    rows = db(progress.user_id == user_id).select(
+        progress.chapter_id, progress.sub_chapter_id, progress.status, progress.end_date
+    )
+    current = [
+        row
+        for row in rows
+        if row.chapter_id == chapter and row.sub_chapter_id == sub_chapter
+    ]
+    statuses = [completion_dict(row) for row in rows]
+    if current:
+        return current[0].status, statuses
+
+    if start_progress(db, user_id, base_course, chapter, sub_chapter):
+        statuses.append(
+            {
+                "chapterName": chapter,
+                "subChapterName": sub_chapter,
+                "completionStatus": -1,
+                "endDate": 0,
+            }
+        )
+    return -1, statuses
+
+
+# Return a list of dicts describing the last page ``user_id`` read in ``course``, a row from ``courses``; it's empty if there's no saved page.
+def last_pages(db, user_id, course):
+    flush_last_page(db, user_id, course.course_name)
+    result = db(
+        (db.user_state.user_id == user_id)
+        & (db.user_state.course_id == course.course_name)
+        & (db.chapters.course_id == course.base_course)
+        & (db.user_state.last_page_chapter == db.chapters.chapter_label)
+        & (db.sub_chapters.chapter_id == db.chapters.id)
+        & (db.user_state.last_page_subchapter == db.sub_chapters.sub_chapter_label)
+    ).select(
+        db.user_state.last_page_url,
+        db.user_state.last_page_hash,
+        db.chapters.chapter_name,
+        db.user_state.last_page_scroll_location,
+        db.sub_chapters.sub_chapter_name,
+    )
+    return [
+        {
+            "lastPageUrl": row.user_state.last_page_url,
+            "lastPageHash": row.user_state.last_page_hash,
+            "lastPageChapter": row.chapters.chapter_name,
+            "lastPageSubchapter": row.sub_chapters.sub_chapter_name,
+            "lastPageScrollLocation": row.user_state.last_page_scroll_location,
+        }
+        for row in result
+    ]
@@ -6,6 +6,7 @@
 # Standard library
 # ----------------
 import datetime
+import json
 import logging
 from math import ceil
 from decimal import Decimal, ROUND_HALF_UP
@@ -17,7 +18,10 @@ from gluon import current
 
 # Local imports
 # -------------
+from db_bulk import multirow_insert, multirow_update
 from outcome_request import OutcomeRequest
+from sid_alias import sid_and_aliases, unmerged_aliases
+from user_interactions import IGNORED_EVENTS, is_backfilled
 
 logger = logging.getLogger(current.settings.logger)
 logger.setLevel(current.settings.log_level)
@@ -176,7 +180,9 @@ def _scorable_useinfos(
     # sid matches auth_user.username, not auth_user.id
     # if question type is page we must do better with the div_id
 
-    query = (db.useinfo.course_id == course_name) & (db.useinfo.sid == sid)
+    query = (db.useinfo.course_id == course_name) & (
+        db.useinfo.sid.belongs(sid_and_aliases(db, sid))
+    )
 
     if question_type == "page":
         quest = db(db.questions.name == div_id).select().first()
@@ -544,34 +550,7 @@ def _autograde_one_q(
         return 0
 
     # use query results and the scoring function
-    if results:
-        print("WTG = ", which_to_grade)
-        if which_to_grade in ["first_answer", "last_answer", None, ""]:
-            # get single row
-            if which_to_grade == "first_answer":
-                row = results.first()
-            elif which_to_grade == "last_answer":
-                row = results.last()
-            else:
-                # default is last
-                row = results.last()
-            # extract its score and id
-            id = row.id
-            score = scoring_fn(row, points, autograde)
-        elif which_to_grade == "best_answer":
-            # score all rows and take the best one
-            best_row = max(results, key=lambda row: scoring_fn(row, points, autograde))
-            id = best_row.id
-            score = scoring_fn(best_row, points, autograde)
-            logger.debug("SCORE = %s by %s", score, scoring_fn)
-        else:
-            logger.error("Unknown Scoring Scheme %s ", which_to_grade)
-            id = 0
-            score = 0
-    else:
-        # no results found, score is 0, not attributed to any row
-        id = None
-        score = 0
+    id, score = _score_results(results, points, autograde, which_to_grade, scoring_fn)
 
     # Save the score
     if save_score:
@@ -591,6 +570,32 @@ def _autograde_one_q(
     return score
 
 
+# Return ``(id, score)`` for ``results``, the rows (ordered by time) holding one student's answers to a question, scored by ``scoring_fn``.
+def _score_results(results, points, autograde, which_to_grade, scoring_fn):
+    if not results:
+        # no results found, score is 0, not attributed to any row
+        return None, 0
+    logger.debug("WTG = %s", which_to_grade)
+    if which_to_grade in ["first_answer", "last_answer", None, ""]:
+        # get single row
+        if which_to_grade == "first_answer":
+            row = results[0]
+        else:
+            # default is last
+            row = results[-1]
+        # extract its score and id
+        return row.id, scoring_fn(row, points, autograde)
+    elif which_to_grade == "best_answer":
+        # score all rows and take the best one
+        best_row = max(results, key=lambda row: scoring_fn(row, points, autograde))
+        score = scoring_fn(best_row, points, autograde)
+        logger.debug("SCORE = %s by %s", score, scoring_fn)
+        return best_row.id, score
+    else:
+        logger.error("Unknown Scoring Scheme %s ", which_to_grade)
+        return 0, 0
+
+
 def _save_question_grade(
     sid, course_name, question_name, score, useinfo_id=None, deadline=None, db=None
 ):
@@ -613,6 +618,412 @@ def _save_question_grade(
         logger.error("IntegrityError {} {} {}".format(sid, course_name, question_name))
 
 
+# The answer table and scoring function for each question type graded from its own table.
+_ANSWER_TABLES = {
+    "mchoice": ("mchoice_answers", _score_one_mchoice),
+    "parsonsprob": ("parsons_answers", _score_one_parsons),
+    "fillintheblank": ("fitb_answers", _score_one_fitb),
+    "clickablearea": ("clickablearea_answers", _score_one_clickablearea),
+    "dragndrop": ("dragndrop_answers", _score_one_dragndrop),
+    "codelens": ("codelens_answers", _score_one_codelens),
+    "lp_build": ("lp_answers", _score_one_lp),
+}
+
+# Question types graded by whether the student interacted with them.
+_INTERACTION_TYPES = ["video", "showeval", "youtube", "shortanswer", "poll"]
+
+# The most rows written per statement when saving grades.
+_GRADE_CHUNK = 1000
+
+# How long an answer row may take to be committed after its timestamp; see ``_incremental_grading``.
+_WATERMARK_MARGIN = datetime.timedelta(minutes=5)
+
+
+# Return ``(table name, event filter, scoring function)`` for grading a question of ``question_type`` as ``_autograde_one_q`` does, or ``None`` if ``_bulk_autograde`` can't grade it.
+def _grading_source(question_type, autograde):
+    if question_type in ["activecode", "actex"]:
+        if autograde in ["pct_correct", "all_or_nothing", "unittest"]:
+            return "useinfo", "unittest", _score_one_code_run
+        return "useinfo", None, _score_one_code_run
+    if question_type == "codelens" and autograde == "interact":
+        return "useinfo", None, _score_one_interaction
+    if question_type in _ANSWER_TABLES:
+        return _ANSWER_TABLES[question_type] + (None,)
+    if question_type in _INTERACTION_TYPES:
+        return "useinfo", None, _score_one_interaction
+    return None
+
+
+# Return a dict mapping ``(sid, div_id)`` to the rows of ``tablename`` holding the answers of each of ``sids`` to ``div_ids`` before ``deadline``, ordered by time, using one query.
+def _answers_by_student(tablename, course_name, sids, div_ids, deadline, db):
+    table = db[tablename]
+    if tablename == "useinfo":
+        # Include rows logged under a student's unmerged aliases, as ``sid_and_aliases`` does.
+        owners = unmerged_aliases(db, sids)
+        query = (table.course_id == course_name) & (
+            table.sid.belongs(list(sids) + list(owners))
+        )
+        fields = [table.id, table.act, table.sid, table.div_id, table.event]
+    else:
+        owners = {}
+        query = (table.course_name == course_name) & (table.sid.belongs(sids))
+        fields = [table.ALL]
+    query &= table.div_id.belongs(div_ids)
+    if deadline:
+        query &= table.timestamp < deadline
+
+    answers = {}
+    for row in db(query).select(*fields, orderby=table.timestamp | table.id):
+        sid = owners.get(row.sid, row.sid)
+        answers.setdefault((sid, row.div_id), []).append(row)
+    return answers
+
+
+# Grade ``questions``, a list of ``(name, points, autograde, which_to_grade, question_type)``, for each of ``sids``, giving the same scores as calling ``_autograde_one_q`` for each question and student. Answers are read with one query per answer table and existing grades with one query; scores are saved with one ``UPDATE`` and one ``INSERT`` per ``_GRADE_CHUNK`` rows. Returns the number of (question, student) pairs graded.
+#
+# Given ``assignment_id``, ``sids`` must be every student in the course. Then each question's grading is recorded in ``autograde_watermarks``, and a question whose settings and deadline haven't changed since is only regraded for the students with answers logged since; ``force`` regrades everyone.
+def _bulk_autograde(
+    course_name, sids, questions, deadline, db, assignment_id=None, force=False
+):
+    # ``_autograde_one_q`` doesn't grade questions without an autograde setting.
+    questions = [q for q in questions if q[2]]
+    if not questions or not sids:
+        return 0
+    sources, by_table = _grading_sources(questions)
+
+    # Find the students to grade for each question; ``None`` means all of them.
+    if assignment_id:
+        to_grade, new_watermarks = _incremental_grading(
+            course_name, sids, questions, deadline, assignment_id, force, db
+        )
+    else:
+        to_grade = {q[0]: None for q in questions}
+
+    answers = {}
+    for tablename, div_ids in by_table.items():
+        students = set()
+        for div_id in div_ids:
+            if to_grade[div_id] is None:
+                students = sids
+                break
+            students |= to_grade[div_id]
+        answers[tablename] = (
+            _answers_by_student(
+                tablename, course_name, list(students), list(div_ids), deadline, db
+            )
+            if students
+            else {}
+        )
+
+    existing = _existing_grades(course_name, sids, [q[0] for q in questions], db)
+    scores = []
+    count = 0
+    for (name, points, autograde, which_to_grade, question_type) in questions:
+        source = sources.get(name)
+        for sid in sids if to_grade[name] is None else sorted(to_grade[name]):
+            count += 1
+            grades = existing.get((sid, name))
+            # If previously manually graded, don't overwrite.
+            if grades and grades[0].comment != "autograded":
+                continue
+            if not source:
+                # Only ``page`` questions, which need a query per student, get here.
+                _autograde_one_q(
+                    course_name,
+                    sid,
+                    name,
+                    points,
+                    question_type,
+                    deadline=deadline,
+                    autograde=autograde,
+                    which_to_grade=which_to_grade,
+                    db=db,
+                )
+                continue
+            tablename, event_filter, scoring_fn = source
+            results = answers[tablename].get((sid, name), [])
+            if event_filter:
+                results = [row for row in results if row.event == event_filter]
+            score = _score_results(
+                results, points, autograde, which_to_grade, scoring_fn
+            )[1]
+            scores.append((sid, name, score))
+    _save_question_grades(course_name, scores, existing, deadline, db)
+
+    if assignment_id:
+        _save_autograde_watermarks(assignment_id, new_watermarks, db)
+    return count
+
+
+# Return ``(sources, by_table)`` for ``questions``: a dict mapping the name of each question graded from its answer rows to its ``_grading_source``, and a dict mapping each answer table to the set of those names read from it.
+def _grading_sources(questions):
+    sources = {}
+    by_table = {}
+    for (name, points, autograde, which_to_grade, question_type) in questions:
+        source = _grading_source(question_type, autograde)
+        if source:
+            sources[name] = source
+            by_table.setdefault(source[0], set()).add(name)
+    return sources, by_table
+
+
+# For grading ``questions`` of the assignment ``assignment_id`` for ``sids``, every student in the course, return ``(to_grade, watermarks)``. ``to_grade`` maps each question's name to the set of students with answers logged since it was last graded, or ``None`` if everyone must be regraded: it hasn't been graded, or its settings changed, or ``force`` is set, or it's a question without answer rows. ``watermarks`` lists the ``(div_id, last id, grading settings)`` to save with ``_save_autograde_watermarks`` once those students are graded.
+#
+# An answer row's id is assigned when it's inserted, but it's only visible once committed, so a row with an id below the largest one read may still appear. The new watermark is therefore the last id of the rows logged more than ``_WATERMARK_MARGIN`` before grading started; the students with rows after it are checked again next time.
+def _incremental_grading(
+    course_name, sids, questions, deadline, assignment_id, force, db
+):
+    sources, by_table = _grading_sources(questions)
+    before = datetime.datetime.utcnow() - _WATERMARK_MARGIN
+    watermarks = _autograde_watermarks(assignment_id, questions, deadline, db)
+    last_ids = {
+        tablename: _last_id(db[tablename], before, db) for tablename in by_table
+    }
+    to_grade = {q[0]: None for q in questions}
+    for tablename, div_ids in by_table.items():
+        unchanged = {
+            div_id: watermarks[div_id][0]
+            for div_id in div_ids
+            if not force and watermarks[div_id][1]
+        }
+        to_grade.update(
+            _students_answering_since(tablename, course_name, sids, unchanged, db)
+        )
+    new_watermarks = [
+        (q[0], last_ids[sources[q[0]][0]], _grading_settings(q, deadline))
+        for q in questions
+        if q[0] in sources
+    ]
+    return to_grade, new_watermarks
+
+
+# Return the settings a question of an assignment is graded with, as stored in ``autograde_watermarks``; a change in any of them means every student must be regraded.
+def _grading_settings(question, deadline):
+    (name, points, autograde, which_to_grade, question_type) = question
+    return json.dumps(
+        [
+            points,
+            autograde,
+            which_to_grade,
+            question_type,
+            deadline.isoformat() if deadline else None,
+        ]
+    )
+
+
+# Return a dict mapping the name of each of ``questions`` to ``(last id, unchanged)``: the id of the last answer row seen when it was last graded for the whole course, and whether it's graded the same way now; ``(None, False)`` if it hasn't been.
+def _autograde_watermarks(assignment_id, questions, deadline, db):
+    wm = db.autograde_watermarks
+    saved = {
+        row.div_id: row
+        for row in db(wm.assignment_id == assignment_id).select(
+            wm.id, wm.div_id, wm.last_id, wm.grading_settings
+        )
+    }
+    watermarks = {}
+    for question in questions:
+        row = saved.get(question[0])
+        if row:
+            unchanged = row.grading_settings == _grading_settings(question, deadline)
+            watermarks[question[0]] = (row.last_id, unchanged, row.id)
+        else:
+            watermarks[question[0]] = (None, False, None)
+    return watermarks
+
+
+# Return the id of the last row of ``table`` logged before ``before``, or 0 if there's none.
+def _last_id(table, before, db):
+    last = table.id.max()
+    return db(table.timestamp < before).select(last).first()[last] or 0
+
+
+# Return a dict mapping each div_id in ``last_ids`` to the set of ``sids`` who answered it in ``tablename`` in a row after the one whose id ``last_ids`` gives.
+def _students_answering_since(tablename, course_name, sids, last_ids, db):
+    if not last_ids:
+        return {}
+    table = db[tablename]
+    if tablename == "useinfo":
+        owners = unmerged_aliases(db, sids)
+        query = table.course_id == course_name
+    else:
+        owners = {}
+        query = table.course_name == course_name
+    query &= (table.div_id.belongs(list(last_ids))) & (
+        table.id > min(last_ids.values())
+    )
+    students = {div_id: set() for div_id in last_ids}
+    sids = set(sids)
+    for row in db(query).select(table.id, table.sid, table.div_id):
+        sid = owners.get(row.sid, row.sid)
+        if row.id > last_ids[row.div_id] and sid in sids:
+            students[row.div_id].add(sid)
+    return students
+
+
+# Record in ``autograde_watermarks`` that questions of the assignment ``assignment_id`` were graded for the whole course. ``watermarks`` is a list of ``(div_id, last id, grading settings)`` from ``_incremental_grading``.
+def _save_autograde_watermarks(assignment_id, watermarks, db):
+    wm = db.autograde_watermarks
+    row_ids = {
+        row.div_id: row.id
+        for row in db(wm.assignment_id == assignment_id).select(wm.id, wm.div_id)
+    }
+    updates = []
+    inserts = []
+    now = datetime.datetime.utcnow()
+    for (div_id, last_id, grading_settings) in watermarks:
+        fields = dict(last_id=last_id, grading_settings=grading_settings, graded_at=now)
+        if div_id in row_ids:
+            updates.append(dict(fields, id=row_ids[div_id]))
+        else:
+            inserts.append(dict(fields, assignment_id=assignment_id, div_id=div_id))
+    multirow_update(db, db.autograde_watermarks, updates)
+    multirow_insert(db, db.autograde_watermarks, inserts)
+
+
+# Autograde settings under which any interaction with a question earns its points.
+_INTERACTION_AUTOGRADES = ["interact", "visited"]
+
+
+# Grade ``readings``, a list of ``(name, chapter, subchapter, points, activities_required, autograde, which_to_grade)``, for each of ``sids``. A student earns a reading's points by completing at least ``activities_required`` of the questions in its subchapter before ``deadline``. The questions of every subchapter are read with one query. For readings graded by interaction, which is usual, completion comes from ``_interactions`` for all readings and students with one query, plus one ``useinfo`` query per subchapter for its ``page`` questions; other readings are graded with ``_autograde_one_q``.
+def _grade_readings(course_name, base_course, sids, readings, deadline, db):
+    if not readings or not sids:
+        return
+    subchapters = {}
+    for row in db(
+        (db.questions.chapter.belongs(list({r[1] for r in readings})))
+        & (db.questions.subchapter.belongs(list({r[2] for r in readings})))
+        & (db.questions.base_course == base_course)
+    ).select(
+        db.questions.name,
+        db.questions.chapter,
+        db.questions.subchapter,
+        db.questions.question_type,
+    ):
+        subchapters.setdefault((row.chapter, row.subchapter), []).append(row)
+
+    # Find the questions each student completed in the subchapters of readings graded by interaction.
+    owners = unmerged_aliases(db, sids)
+    all_sids = list(sids) + list(owners)
+    completed = {}
+    div_ids = set()
+    for (name, chapter, subchapter, points, ar, ag, wtg) in readings:
+        if ag not in _INTERACTION_AUTOGRADES:
+            continue
+        for row in subchapters.get((chapter, subchapter), []):
+            if row.question_type == "page":
+                # Like ``_scorable_useinfos``, look for a view of the page.
+                query = (
+                    (db.useinfo.course_id == course_name)
+                    & (db.useinfo.sid.belongs(all_sids))
+                    & (
+                        db.useinfo.div_id.endswith(
+                            u"{}/{}.html".format(chapter, subchapter)
+                        )
+                    )
+                )
+                if deadline:
+                    query &= db.useinfo.timestamp < deadline
+                for visit in db(query).select(db.useinfo.sid, distinct=True):
+                    completed.setdefault(owners.get(visit.sid, visit.sid), set()).add(
+                        row.name
+                    )
+            elif _grading_source(row.question_type, ag):
+                div_ids.add(row.name)
+    if div_ids:
+        for row in _interactions(course_name, all_sids, list(div_ids), deadline, db):
+            completed.setdefault(owners.get(row.sid, row.sid), set()).add(row.div_id)
+
+    scores = []
+    for (name, chapter, subchapter, points, ar, ag, wtg) in readings:
+        rows = subchapters.get((chapter, subchapter), [])
+        for s in sids:
+            if ag in _INTERACTION_AUTOGRADES:
+                done = completed.get(s, set())
+                score = len([row for row in rows if row.name in done])
+            else:
+                score = 0
+                for row in rows:
+                    score += _autograde_one_q(
+                        course_name,
+                        s,
+                        row.name,
+                        1,
+                        row.question_type,
+                        deadline=deadline,
+                        autograde=ag,
+                        which_to_grade=wtg,
+                        save_score=False,
+                        db=db,
+                    )
+            logger.debug("Score is %s for %s on %s", score, s, name)
+            scores.append((s, name, points if score >= ar else 0))
+    # Unlike other questions, readings are regraded even if graded manually.
+    existing = _existing_grades(course_name, sids, [r[0] for r in readings], db)
+    _save_question_grades(course_name, scores, existing, deadline, db)
+
+
+# Return the distinct ``(sid, div_id)`` rows for each of ``div_ids`` which any of ``sids`` interacted with in ``course_name`` before ``deadline``. These come from ``user_interactions`` once the course is backfilled; until then, such as for a course which predates the table and hasn't been rebuilt by ``rsmanage rebuildstats``, they're read from ``useinfo``.
+def _interactions(course_name, sids, div_ids, deadline, db):
+    table = db.user_interactions
+    if is_backfilled(db, course_name):
+        query = (
+            (table.course_name == course_name)
+            & (table.sid.belongs(sids))
+            & (table.div_id.belongs(div_ids))
+        )
+        if deadline:
+            query &= table.first_seen < deadline
+        return db(query).select(table.sid, table.div_id, distinct=True)
+
+    query = (
+        (db.useinfo.course_id == course_name)
+        & (db.useinfo.sid.belongs(sids))
+        & (db.useinfo.div_id.belongs(div_ids))
+        & (
+            (db.useinfo.event == None)  # noqa: E711
+            | (~db.useinfo.event.belongs(IGNORED_EVENTS))
+        )
+    )
+    if deadline:
+        query &= db.useinfo.timestamp < deadline
+    return db(query).select(db.useinfo.sid, db.useinfo.div_id, distinct=True)
+
+
+# Return a dict mapping ``(sid, div_id)`` to the ``question_grades`` rows of each of ``sids`` for ``div_ids``, oldest first, using one query.
+def _existing_grades(course_name, sids, div_ids, db):
+    qg = db.question_grades
+    existing = {}
+    for row in db(
+        (qg.course_name == course_name)
+        & (qg.div_id.belongs(div_ids))
+        & (qg.sid.belongs(sids))
+    ).select(qg.id, qg.sid, qg.div_id, qg.comment, orderby=qg.id):
+        existing.setdefault((row.sid, row.div_id), []).append(row)
+    return existing
+
+
+# Save ``scores``, a list of ``(sid, div_id, score)``, as autograded, like ``_save_question_grade``. The rows in ``existing``, from ``_existing_grades``, are updated and the others inserted, with one statement per ``_GRADE_CHUNK`` rows.
+def _save_question_grades(course_name, scores, existing, deadline, db):
+    updates = []
+    inserts = []
+    for (sid, div_id, score) in scores:
+        fields = dict(score=score, comment="autograded", useinfo_id=None)
+        fields["deadline"] = deadline
+        grades = existing.get((sid, div_id))
+        if grades:
+            updates.extend(dict(fields, id=row.id) for row in grades)
+        else:
+            inserts.append(
+                dict(fields, sid=sid, course_name=course_name, div_id=div_id)
+            )
+
+    qg = db.question_grades
+    for i in range(0, len(updates), _GRADE_CHUNK):
+        multirow_update(db, qg, updates[i : i + _GRADE_CHUNK])
+    for i in range(0, len(inserts), _GRADE_CHUNK):
+        multirow_insert(db, qg, inserts[i : i + _GRADE_CHUNK])
+
+
 def _compute_assignment_total(student, assignment, course_name, db=None):
     # return the computed score and the manual score if there is one; if no manual score, save computed score
     # student is a row, containing id and username
@@ -671,9 +1082,70 @@ def _compute_assignment_total(student, assignment, course_name, db=None):
         return score, None
 
 
-def _get_students(course_id=None, sid=None, student_rownum=None, db=None):
+# Compute the total of each of ``student_rows`` (rows holding id and username) on ``assignment``, as ``_compute_assignment_total`` does, and save those without a manual total. Scores are summed with one grouped query and saved with one ``UPDATE`` and one ``INSERT`` per ``_GRADE_CHUNK`` rows. Returns the computed totals, in the order of ``student_rows``.
+def _compute_assignment_totals(student_rows, assignment, course_name, db):
+    sids = [student.username for student in student_rows]
+    total = db.question_grades.score.sum()
+    sums = {
+        row.question_grades.sid: row[total]
+        for row in db(
+            (db.question_grades.sid.belongs(sids))
+            & (db.question_grades.div_id == db.questions.name)
+            & (db.questions.id == db.assignment_questions.question_id)
+            & (db.assignment_questions.assignment_id == assignment.id)
+            & (db.question_grades.course_name == course_name)
+        ).select(db.question_grades.sid, total, groupby=db.question_grades.sid)
+    }
+    # check for threshold scoring for the assignment
+    record = db.assignments(assignment.id)
+
+    grades = {}
+    for row in db(
+        (db.grades.assignment == assignment.id)
+        & (db.grades.auth_user.belongs([student.id for student in student_rows]))
+    ).select(
+        db.grades.id, db.grades.auth_user, db.grades.manual_total, orderby=db.grades.id
+    ):
+        grades.setdefault(row.auth_user, []).append(row)
+
+    scores = []
+    updates = []
+    inserts = []
+    for student in student_rows:
+        score = sums.get(student.username) or 0
+        if (
+            record
+            and record.threshold_pct
+            and score / record.points > record.threshold_pct
+        ):
+            score = record.points
+        scores.append(score)
+        rows = grades.get(student.id)
+        if rows and rows[0].manual_total:
+            # don't save it
+            continue
+        if rows:
+            updates.extend(dict(id=row.id, score=score) for row in rows)
+        else:
+            inserts.append(
+                dict(auth_user=student.id, assignment=assignment.id, score=score)
+            )
+
+    for i in range(0, len(updates), _GRADE_CHUNK):
+        multirow_update(db, db.grades, updates[i : i + _GRADE_CHUNK])
+    for i in range(0, len(inserts), _GRADE_CHUNK):
+        multirow_insert(db, db.grades, inserts[i : i + _GRADE_CHUNK])
+    return scores
+
+
+def _get_students(course_id=None, sid=None, student_rownum=None, db=None, sids=None):
     print("_get_students", course_id, sid, student_rownum)
-    if student_rownum:
+    if sids is not None:
+        # fetch a subset of the course's students, such as a shard graded by ``rsmanage grade --parallel``
+        student_rows = db((db.auth_user.username.belongs(sids))).select(
+            db.auth_user.username, db.auth_user.id
+        )
+    elif student_rownum:
         # get the student id as well as username
         student_rows = db((db.auth_user.id == student_rownum)).select(
             db.auth_user.username, db.auth_user.id
@@ -799,10 +1271,10 @@ def send_lti_grades(assignment_id, assignment_points, course_id, lti_record, db)
 
 
 def do_calculate_totals(
-    assignment, course_id, course_name, sid, student_rownum, db, settings
+    assignment, course_id, course_name, sid, student_rownum, db, settings, sids=None
 ):
     student_rows = _get_students(
-        course_id=course_id, sid=sid, student_rownum=student_rownum, db=db
+        course_id=course_id, sid=sid, student_rownum=student_rownum, db=db, sids=sids
     )
 
     results = {"success": True}
@@ -815,10 +1287,7 @@ def do_calculate_totals(
         results["manual_score"] = manual_score
     else:
         # compute total score for the assignment for each sid; also saves in DB unless manual value saved
-        scores = [
-            _compute_assignment_total(student, assignment, course_name, db)[0]
-            for student in student_rows
-        ]
+        scores = _compute_assignment_totals(student_rows, assignment, course_name, db)
         results[
             "message"
         ] = "Calculated totals for {} students\n\tmax: {}\n\tmin: {}\n\tmean: {}".format(
@@ -839,8 +1308,51 @@ def do_autograde(
     timezoneoffset,
     db,
     settings,
+    sids=None,
+    force=False,
 ):
     start = datetime.datetime.now()
+    deadline = _grading_deadline(assignment, enforce_deadline, timezoneoffset)
+
+    student_rows = _get_students(
+        course_id=course_id, sid=sid, student_rownum=student_rownum, db=db, sids=sids
+    )
+    # When grading the whole course, only regrade the answers which changed, unless forced.
+    whole_course = not (sid or student_rownum or sids is not None)
+    sids = [row.username for row in student_rows]
+
+    readings, questions = _assignment_questions(assignment, question_name, db)
+    logger.debug("GRADING READINGS")
+    base_course = (
+        db(db.courses.id == course_id)
+        .select(db.courses.base_course)
+        .first()
+        .base_course
+    )
+    # _profile(start, "after readings fetched")
+    _grade_readings(course_name, base_course, sids, readings, deadline, db)
+    count = len(readings)
+
+    # _profile(start, "after readings graded")
+
+    logger.debug("GRADING QUESTIONS")
+    # _profile(start, "after questions fetched")
+    logger.debug("questions to grade = %s", questions)
+    count += _bulk_autograde(
+        course_name,
+        sids,
+        questions,
+        deadline,
+        db,
+        assignment_id=assignment.id if whole_course else None,
+        force=force,
+    )
+    # _profile(start, "after questions graded")
+    return count
+
+
+# Return the deadline ``assignment`` is graded against, or ``None`` unless ``enforce_deadline`` is ``"true"``.
+def _grading_deadline(assignment, enforce_deadline, timezoneoffset):
     if enforce_deadline == "true":
         # get the deadline associated with the assignment
         deadline = assignment.duedate
@@ -850,12 +1362,11 @@ def do_autograde(
     if timezoneoffset and deadline:
         deadline = deadline + datetime.timedelta(hours=float(timezoneoffset))
         logger.debug("ASSIGNMENT DEADLINE OFFSET %s", deadline)
+    return deadline
 
-    student_rows = _get_students(
-        course_id=course_id, sid=sid, student_rownum=student_rownum, db=db
-    )
-    sids = [row.username for row in student_rows]
 
+# Return ``(readings, questions)``, the autograded questions of ``assignment`` (only ``question_name``, if given) in the forms ``_grade_readings`` and ``_bulk_autograde`` take.
+def _assignment_questions(assignment, question_name, db):
     if question_name:
         questions_query = db(
             (db.assignment_questions.assignment_id == assignment.id)
@@ -868,7 +1379,6 @@ def do_autograde(
             (db.assignment_questions.assignment_id == assignment.id)
             & (db.assignment_questions.question_id == db.questions.id)
         ).select()
-    # _profile(start, "after questions fetched")
 
     readings = [
         (
@@ -883,65 +1393,6 @@ def do_autograde(
         for row in questions_query
         if row.assignment_questions.reading_assignment == True
     ]
-    logger.debug("GRADING READINGS")
-    # Now for each reading, get all of the questions in that subsection
-    # call _autograde_one_q using the autograde and which to grade for that section. likely interact
-    #
-    base_course = (
-        db(db.courses.id == course_id)
-        .select(db.courses.base_course)
-        .first()
-        .base_course
-    )
-    count = 0
-    # _profile(start, "after readings fetched")
-    for (name, chapter, subchapter, points, ar, ag, wtg) in readings:
-        # print("\nGrading all students for {}/{}".format(chapter, subchapter))
-        count += 1
-        for s in sids:
-            # print("."),
-            score = 0
-            rows = db(
-                (db.questions.chapter == chapter)
-                & (db.questions.subchapter == subchapter)
-                & (db.questions.base_course == base_course)
-            ).select()
-            # _profile(start, "\t{}. rows fetched for {}/{}".format(count, chapter, subchapter))
-            for row in rows:
-                score += _autograde_one_q(
-                    course_name,
-                    s,
-                    row.name,
-                    1,
-                    row.question_type,
-                    deadline=deadline,
-                    autograde=ag,
-                    which_to_grade=wtg,
-                    save_score=False,
-                    db=db,
-                )
-                logger.debug("Score is now %s for %s for %s", score, row.name, sid)
-            if score >= ar:
-                save_points = points
-                logger.debug("full points for %s on %s", sid, name)
-            else:
-                save_points = 0
-                logger.debug("no points for %s on %s", sid, name)
-            # _profile(start, "\t\tgraded")
-            _save_question_grade(
-                s,
-                course_name,
-                name,
-                save_points,
-                useinfo_id=None,
-                deadline=deadline,
-                db=db,
-            )
-            # _profile(start, "\t\tsaved")
-
-    # _profile(start, "after readings graded")
-
-    logger.debug("GRADING QUESTIONS")
     questions = [
         (
             row.questions.name,
@@ -954,26 +1405,39 @@ def do_autograde(
         if row.assignment_questions.reading_assignment == False
         or row.assignment_questions.reading_assignment == None
     ]
+    return readings, [q for q in questions if q[2] != "manual"]
 
-    # _profile(start, "after questions fetched")
-    logger.debug("questions to grade = %s", questions)
-    for (qdiv, points, autograde, which_to_grade, question_type) in questions:
-        for s in sids:
-            if autograde != "manual":
-                _autograde_one_q(
-                    course_name,
-                    s,
-                    qdiv,
-                    points,
-                    question_type,
-                    deadline=deadline,
-                    autograde=autograde,
-                    which_to_grade=which_to_grade,
-                    db=db,
-                )
-                count += 1
-    # _profile(start, "after calls to _autograde_one_q")
-    return count
+
+# Plan autograding ``assignment`` for the whole course a few students per request, so no request grades everyone. Returns ``(sids, watermarks)``: the students to grade with ``do_autograde(..., sids=...)`` (only those with answers logged since the assignment was last graded, unless ``force`` is set or it has readings or questions needing a full regrade), and the watermarks to pass to ``save_autograde_plan`` once they all are.
+def plan_autograde(
+    assignment,
+    course_id,
+    course_name,
+    enforce_deadline,
+    timezoneoffset,
+    db,
+    force=False,
+):
+    deadline = _grading_deadline(assignment, enforce_deadline, timezoneoffset)
+    sids = [row.username for row in _get_students(course_id=course_id, db=db)]
+    readings, questions = _assignment_questions(assignment, None, db)
+    # ``_bulk_autograde`` doesn't grade questions without an autograde setting.
+    questions = [q for q in questions if q[2]]
+    to_grade, watermarks = _incremental_grading(
+        course_name, sids, questions, deadline, assignment.id, force, db
+    )
+    if readings or None in to_grade.values():
+        students = sids
+    else:
+        students = set()
+        for graded in to_grade.values():
+            students |= graded
+    return sorted(students), watermarks
+
+
+# Record that ``assignment`` was graded for the whole course as planned by ``plan_autograde``, which returned ``watermarks``.
+def save_autograde_plan(assignment, watermarks, db):
+    _save_autograde_watermarks(assignment.id, watermarks, db)
 
 
 #### stuff for the practice feature
@@ -1095,7 +1559,7 @@ def _score_practice_quality(
 ):
     page_visits = db(
         (db.useinfo.course_id == course_name)
-        & (db.useinfo.sid == sid)
+        & (db.useinfo.sid.belongs(sid_and_aliases(db, sid)))
         & (db.useinfo.event == "page")
         & (db.useinfo.timestamp >= practice_start_time)
         & (db.useinfo.timestamp <= now)
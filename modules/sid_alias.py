@@ -0,0 +1,173 @@
+# ***************************************************************
+# |docname| - Merge the history of anonymous users who log in
+# ***************************************************************
+# Before logging in, a reader is identified by an ``ipuser`` cookie of the form
+# ``<uuid>@<ip address>``. When that reader logs in, the ``useinfo`` rows logged
+# under the cookie belong to their username. Rewriting those rows while
+# handling ``hsblog`` put a query against the largest table on the busiest
+# endpoint, so instead:
+#
+# - :func:`record_sid_alias` notes the mapping in the ``sid_alias`` table, once
+#   per ``(alias, sid)`` pair. If rows are logged under an alias after it was
+#   merged, the next call marks it unmerged again. Each process remembers the
+#   pairs it has recorded for a minute, so repeat calls cost a dictionary
+#   lookup.
+# - :func:`merge_sid_aliases`, run by ``rsmanage mergesids`` or the scheduler,
+#   rewrites the ``useinfo`` rows in chunks, moves the alias's
+#   ``user_interactions`` rows and poll votes to the sid, and marks the alias
+#   as merged.
+# - Until then, reads for one user use :func:`sid_and_aliases` to include the
+#   rows logged under that user's unmerged aliases.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+from answer_stats import increment
+
+# The most aliases (and lookups) each process remembers.
+_MAX_CACHED = 10000
+# Seconds to reuse the result of :func:`sid_and_aliases`.
+_ALIAS_TTL = 60
+
+_lock = threading.Lock()
+# Maps ``(alias, sid)`` to the time this process should next record it.
+_recorded = OrderedDict()
+# Maps a sid to ``(expiration time, [sid, alias, ...])``.
+_lookups = OrderedDict()
+
+
+def _remember(cache, key, value):
+    with _lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > _MAX_CACHED:
+            cache.popitem(last=False)
+
+
+# Note that the anonymous identifier ``alias`` belongs to ``sid``. If that pair was already merged but ``useinfo`` has rows logged under ``alias`` since, mark it unmerged so they're merged too.
+def record_sid_alias(db, alias, sid):
+    key = (alias, sid)
+    if _recorded.get(key, 0) > time.time():
+        return
+    table = db.sid_alias
+    names = dict(
+        table=table._rname,
+        alias=table.alias._rname,
+        sid=table.sid._rname,
+        created=table.created._rname,
+        merged=table.merged._rname,
+        useinfo=db.useinfo._rname,
+        useinfo_sid=db.useinfo.sid._rname,
+        a=db._adapter.represent(alias, "string"),
+        s=db._adapter.represent(sid, "string"),
+        c=db._adapter.represent(datetime.datetime.utcnow(), "datetime"),
+    )
+    db.executesql(
+        "INSERT INTO {table} ({alias}, {sid}, {created}) SELECT {a}, {s}, {c} "
+        "WHERE NOT EXISTS (SELECT 1 FROM {table} "
+        "WHERE {alias} = {a} AND {sid} = {s});".format(**names)
+    )
+    db.executesql(
+        "UPDATE {table} SET {merged} = NULL "
+        "WHERE {alias} = {a} AND {sid} = {s} AND {merged} IS NOT NULL "
+        "AND EXISTS (SELECT 1 FROM {useinfo} WHERE {useinfo_sid} = {a});".format(
+            **names
+        )
+    )
+    _remember(_recorded, key, time.time() + _ALIAS_TTL)
+    with _lock:
+        _lookups.pop(sid, None)
+
+
+# Return a list of ``sid`` followed by its aliases which haven't been merged yet, for use in a ``belongs`` query.
+def sid_and_aliases(db, sid):
+    entry = _lookups.get(sid)
+    if entry and entry[0] > time.time():
+        return entry[1]
+    table = db.sid_alias
+    sids = [sid] + [
+        row.alias
+        for row in db((table.sid == sid) & (table.merged == None)).select(  # noqa: E711
+            table.alias
+        )
+    ]
+    _remember(_lookups, sid, (time.time() + _ALIAS_TTL, sids))
+    return sids
+
+
+# Return a dict mapping each unmerged alias of any of ``sids`` to its sid, for reads covering many users.
+def unmerged_aliases(db, sids):
+    table = db.sid_alias
+    return {
+        row.alias: row.sid
+        for row in db(
+            (table.sid.belongs(sids)) & (table.merged == None)  # noqa: E711
+        ).select(table.alias, table.sid)
+    }
+
+
+# Rewrite the ``useinfo``, ``user_interactions`` and ``poll_votes`` rows of every unmerged alias to its sid, ``batch_size`` rows per transaction. ``progress``, if given, is called with the alias, its sid and the number of rows rewritten so far. Returns the number of aliases merged.
+def merge_sid_aliases(db, batch_size=5000, progress=None):
+    table = db.sid_alias
+    aliases = db(table.merged == None).select(  # noqa: E711
+        table.id, table.alias, table.sid, orderby=table.id
+    )
+    for row in aliases:
+        rewritten = 0
+        while True:
+            chunk = db(db.useinfo.sid == row.alias)._select(
+                db.useinfo.id, limitby=(0, batch_size)
+            )
+            count = db(db.useinfo.id.belongs(chunk)).update(sid=row.sid)
+            db.commit()
+            if not count:
+                break
+            rewritten += count
+            if progress:
+                progress(row.alias, row.sid, rewritten)
+        db(db.user_interactions.sid == row.alias).update(sid=row.sid)
+        _merge_poll_votes(db, row.alias, row.sid)
+        db(table.id == row.id).update(merged=datetime.datetime.utcnow())
+        db.commit()
+    return len(aliases)
+
+
+# Move the poll votes of ``alias`` to ``sid``. Where both voted in the same poll, only the latest vote is kept, and ``poll_option_counts`` no longer counts the others.
+def _merge_poll_votes(db, alias, sid):
+    votes = db.poll_votes
+    for poll in db(votes.sid == alias).select(
+        votes.course_name, votes.div_id, distinct=True
+    ):
+        rows = db(
+            (votes.course_name == poll.course_name)
+            & (votes.div_id == poll.div_id)
+            & (votes.sid.belongs([alias, sid]))
+        ).select(votes.id, votes.vote, orderby=votes.timestamp | votes.id)
+        for superseded in rows[:-1]:
+            increment(
+                db,
+                db.poll_option_counts,
+                dict(
+                    course_name=poll.course_name,
+                    div_id=poll.div_id,
+                    vote=superseded.vote,
+                ),
+                {"vote_count": -1},
+            )
+            db(votes.id == superseded.id).delete()
+        db(votes.id == rows.last().id).update(sid=sid)
@@ -0,0 +1,77 @@
+# **********************************************************
+# |docname| - Cache the source of activecodes and data files
+# **********************************************************
+# ``source_code`` holds the source of activecodes and data files, written when
+# a book is built. ``ajax.get_datafile`` and ``assignments.get_problem``, which
+# the grading interface calls once per student, read the same few rows over
+# and over. Each process caches them here for ``_SOURCE_TTL`` seconds, along
+# with a hash of their contents for use as an ``ETag``, so a rebuilt book is
+# picked up within a few minutes.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+# None.
+
+# Seconds to reuse a row read from ``source_code``.
+_SOURCE_TTL = 300
+# The most rows each process remembers.
+_MAX_CACHED = 10000
+
+_lock = threading.Lock()
+# Maps ``(course names, acid)`` to ``(expiration time, main_code, hash)``; ``main_code`` and ``hash`` are ``None`` if there's no such row.
+_sources = OrderedDict()
+
+
+# Return a hash of ``text`` suitable for an ``ETag``.
+def content_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+# Return a dict mapping each of ``acids`` to ``(main_code, hash)`` from ``source_code``, or to ``(None, None)`` if it's not there. If ``course_names`` is given, only rows for those courses are used. Rows not cached are read with one query.
+def get_sources(db, acids, course_names=None):
+    scope = tuple(course_names) if course_names else None
+    now = time.time()
+    res = {}
+    with _lock:
+        for acid in acids:
+            entry = _sources.get((scope, acid))
+            if entry and entry[0] > now:
+                res[acid] = entry[1:]
+    missing = [acid for acid in acids if acid not in res]
+    if not missing:
+        return res
+
+    query = db.source_code.acid.belongs(missing)
+    if scope:
+        query &= db.source_code.course_id.belongs(scope)
+    found = {}
+    for row in db(query).select(
+        db.source_code.acid, db.source_code.main_code, orderby=db.source_code.id
+    ):
+        # Like ``.first()``, use the first row for each acid.
+        if row.acid not in found:
+            found[row.acid] = (row.main_code, content_hash(row.main_code))
+    with _lock:
+        for acid in missing:
+            res[acid] = found.get(acid, (None, None))
+            _sources[(scope, acid)] = (now + _SOURCE_TTL,) + res[acid]
+            _sources.move_to_end((scope, acid))
+        while len(_sources) > _MAX_CACHED:
+            _sources.popitem(last=False)
+    return res
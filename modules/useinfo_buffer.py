@@ -0,0 +1,323 @@
+# *************************************************
+# |docname| - Write-behind buffer for ``useinfo``
+# *************************************************
+# During lecture spikes every ``hsblog``, ``runlog`` and page view performs its
+# own ``INSERT`` into ``useinfo`` and its own commit. When
+# ``settings.useinfo_write_behind`` is enabled, :func:`log_useinfo` in
+# ``models/db_ebook.py`` queues those rows here instead. A background thread
+# writes the queue to the database with one multi-row ``INSERT`` every
+# ``settings.useinfo_flush_interval`` seconds, or sooner once
+# ``settings.useinfo_flush_rows`` rows are waiting. The tables derived from
+# logged rows (``presence``, the answer stats and ``user_interactions``) are
+# updated by the flusher in the same transaction, so a request which logs an
+# event doesn't write to the database at all.
+#
+# Durability:
+#
+# - The queue is bounded by ``settings.useinfo_max_queue``. When it is full,
+#   :meth:`UseinfoBuffer.put` refuses the rows and the caller inserts them
+#   synchronously, so events are never silently dropped.
+# - Rows which can't be written (for example, the database is down) are
+#   appended to a spill file next to the migration files. The spill files of
+#   every process are replayed after the next successful flush.
+# - The queue is flushed when the process exits.
+#
+# Every ``settings.useinfo_stats_interval`` seconds in which rows were queued,
+# the flusher logs its counters: rows queued, rejected, flushed, spilled and
+# replayed, the queue depth, and the latency of the last and slowest flush.
+#
+# Under uwsgi, this requires ``enable-threads`` (or ``threads`` > 1) so the
+# flusher thread runs.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import atexit
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# Third-party imports
+# -------------------
+from gluon import current
+from gluon.dal import DAL, Field
+
+# Local imports
+# -------------
+from db_bulk import multirow_insert
+
+logger = logging.getLogger(current.settings.logger)
+logger.setLevel(current.settings.log_level)
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+class UseinfoBuffer(object):
+    def __init__(
+        self,
+        # The URI of the database to write to. The flusher uses its own connection.
+        database_uri,
+        # Maps the name of ``useinfo`` and of each table ``on_write`` writes to its field names and types, so the flusher can define them on its connection.
+        tables,
+        # The directory which holds spill files.
+        spill_dir,
+        # Seconds between flushes.
+        flush_interval=0.5,
+        # Flush as soon as this many rows are queued; also the maximum rows per ``INSERT``.
+        flush_rows=500,
+        # The maximum number of rows held in memory.
+        max_queue=20000,
+        # Seconds between logging the counters.
+        stats_interval=60,
+        # Called as ``on_write(db, batch)`` after each batch is inserted, before it's committed, to update the tables derived from ``useinfo``.
+        on_write=None,
+    ):
+        self.database_uri = database_uri
+        self.tables = tables
+        self.on_write = on_write
+        self.spill_path = os.path.join(
+            spill_dir, "useinfo_spill.{}.jsonl".format(os.getpid())
+        )
+        self.spill_glob = os.path.join(spill_dir, "useinfo_spill.*.jsonl")
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.max_queue = max_queue
+        self.stats_interval = stats_interval
+
+        self._rows = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._db = None
+        self._counters = dict(
+            queued=0,
+            rejected=0,
+            flushed=0,
+            flushes=0,
+            failures=0,
+            spilled=0,
+            replayed=0,
+            last_flush_ms=0.0,
+            max_flush_ms=0.0,
+        )
+
+        self._thread = threading.Thread(target=self._run, name="useinfo-flusher")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    # Queue a list of ``useinfo`` rows (dicts). Returns ``False`` if the queue is full or closed; the caller must then write the rows itself.
+    def put(self, rows):
+        with self._lock:
+            if self._stopped or len(self._rows) + len(rows) > self.max_queue:
+                self._counters["rejected"] += len(rows)
+                return False
+            self._rows.extend(rows)
+            self._counters["queued"] += len(rows)
+            depth = len(self._rows)
+        if depth >= self.flush_rows:
+            self._wakeup.set()
+        return True
+
+    # Return a snapshot of the counters, including the current queue depth.
+    def counters(self):
+        with self._lock:
+            res = dict(self._counters)
+            res["queue_depth"] = len(self._rows)
+        return res
+
+    # Write everything queued so far.
+    def flush(self):
+        with self._flush_lock:
+            wrote = False
+            while True:
+                with self._lock:
+                    batch = [
+                        self._rows.popleft()
+                        for i in range(min(len(self._rows), self.flush_rows))
+                    ]
+                if not batch:
+                    break
+                if not self._write(batch):
+                    self._spill(batch)
+                    return
+                wrote = True
+            if wrote:
+                self._replay_spills()
+
+    # Stop the flusher thread and write whatever is left.
+    def close(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._wakeup.set()
+        self._thread.join(self.flush_interval * 4)
+        # The flusher's connection belongs to its thread; open a new one here.
+        self._db = None
+        self.flush()
+
+    def _run(self):
+        next_stats = time.time() + self.stats_interval
+        last_queued = 0
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with self._lock:
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("useinfo flusher failed: {}".format(e))
+            if time.time() >= next_stats:
+                next_stats = time.time() + self.stats_interval
+                last_queued = self._log_counters(last_queued)
+
+    # Log the counters if any rows were queued since they were last logged, when ``last_queued`` rows had been. Returns the number queued now.
+    def _log_counters(self, last_queued):
+        counters = self.counters()
+        if counters["queued"] != last_queued:
+            logger.info(
+                "useinfo buffer {}: {}".format(
+                    os.getpid(),
+                    ", ".join(
+                        "{} {}".format(name, counters[name])
+                        for name in sorted(counters)
+                    ),
+                )
+            )
+        return counters["queued"]
+
+    def _connect(self):
+        if self._db is None:
+            # DAL instances are per-thread singletons keyed by ``db_uid``; use our own so this never picks up the request's ``db``.
+            db = DAL(
+                self.database_uri, pool_size=0, migrate=False, db_uid="useinfo_buffer"
+            )
+            for tablename, fields in self.tables.items():
+                db.define_table(
+                    tablename,
+                    *[Field(name, type) for (name, type) in fields],
+                    migrate=False
+                )
+            self._db = db
+        return self._db
+
+    def _disconnect(self):
+        if self._db is not None:
+            try:
+                self._db.close()
+            except Exception:
+                pass
+            self._db = None
+
+    # Write ``batch`` in one statement, update the derived tables and commit. Returns ``False`` on failure.
+    def _write(self, batch):
+        start = time.time()
+        try:
+            db = self._connect()
+            multirow_insert(db, db.useinfo, batch)
+            if self.on_write:
+                self.on_write(db, batch)
+            db.commit()
+        except Exception as e:
+            logger.error("failed to flush {} useinfo rows -- {}".format(len(batch), e))
+            with self._lock:
+                self._counters["failures"] += 1
+            self._disconnect()
+            return False
+
+        elapsed = (time.time() - start) * 1000
+        with self._lock:
+            self._counters["flushed"] += len(batch)
+            self._counters["flushes"] += 1
+            self._counters["last_flush_ms"] = elapsed
+            self._counters["max_flush_ms"] = max(
+                self._counters["max_flush_ms"], elapsed
+            )
+            depth = len(self._rows)
+        logger.debug(
+            "flushed %s useinfo rows in %.1f ms; queue depth %s",
+            len(batch),
+            elapsed,
+            depth,
+        )
+        return True
+
+    def _spill(self, batch):
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for row in batch:
+                    row = dict(row)
+                    if row.get("timestamp"):
+                        row["timestamp"] = row["timestamp"].isoformat()
+                    f.write(json.dumps(row) + "\n")
+        except Exception as e:
+            logger.error(
+                "failed to spill {} useinfo rows to {} -- {}".format(
+                    len(batch), self.spill_path, e
+                )
+            )
+            return
+        with self._lock:
+            self._counters["spilled"] += len(batch)
+
+    # Replay the spill files of every process. Renaming a file first claims it, so only one process replays it.
+    def _replay_spills(self):
+        for path in glob.glob(self.spill_glob):
+            claimed = path + ".replay"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            with open(claimed, encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            for row in rows:
+                if row.get("timestamp"):
+                    row["timestamp"] = datetime.datetime.fromisoformat(row["timestamp"])
+            for i in range(0, len(rows), self.flush_rows):
+                batch = rows[i : i + self.flush_rows]
+                if not self._write(batch):
+                    self._spill(rows[i:])
+                    break
+                with self._lock:
+                    self._counters["replayed"] += len(batch)
+            os.unlink(claimed)
+
+
+# Return this process's buffer, creating it on first use. See ``UseinfoBuffer`` for ``on_write``, which writes ``derived_tables``.
+def get_buffer(db, settings, on_write=None, derived_tables=()):
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = UseinfoBuffer(
+                    settings.database_uri,
+                    {
+                        tablename: [
+                            (field.name, field.type)
+                            for field in db[tablename]
+                            if field.name != "id"
+                        ]
+                        for tablename in ("useinfo",) + tuple(derived_tables)
+                    },
+                    settings.useinfo_spill_dir,
+                    flush_interval=settings.useinfo_flush_interval,
+                    flush_rows=settings.useinfo_flush_rows,
+                    max_queue=settings.useinfo_max_queue,
+                    stats_interval=settings.useinfo_stats_interval,
+                    on_write=on_write,
+                )
+    return _buffer
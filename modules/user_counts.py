@@ -0,0 +1,125 @@
+# *******************************************
+# |docname| - Count distinct readers quickly
+# *******************************************
+# Counting the distinct sids in ``useinfo`` takes too long to do on request.
+# Instead, :func:`rollup_first_seen` records in ``user_first_seen`` when each
+# sid was first seen in each course, plus one row per sid (with no course) for
+# when it was first seen anywhere. It works through ``useinfo`` in id order,
+# starting after the high-water mark saved in ``rollup_watermarks``, so each
+# run only reads the rows logged since the last one. ``rsmanage rollupusers``
+# runs it, or queues it as a repeating scheduler task.
+#
+# Counts then come from ``user_first_seen``: globally, per course, or for the
+# readers first seen in a course after a date (such as the start of a term).
+# Until the rollup has run once, they're counted from ``useinfo`` instead.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+# None.
+#
+# Third-party imports
+# -------------------
+# None.
+#
+# Local imports
+# -------------
+# None.
+
+_WATERMARK = "user_first_seen"
+
+
+# Add the sids first seen in ``useinfo`` since the last run to ``user_first_seen``, ``batch_size`` ids per transaction. ``progress``, if given, is called with the last ``useinfo`` id processed. Returns that id.
+def rollup_first_seen(db, batch_size=100000, progress=None):
+    marks = db.rollup_watermarks
+    mark = db(marks.name == _WATERMARK).select().first()
+    if not mark:
+        marks.insert(name=_WATERMARK, last_id=0)
+        mark = db(marks.name == _WATERMARK).select().first()
+    last_id = mark.last_id
+    max_id = db.executesql("SELECT max(id) FROM {};".format(db.useinfo._rname))[0][0]
+
+    seen = db.user_first_seen._rname
+    useinfo = db.useinfo._rname
+    while max_id and last_id < max_id:
+        high = min(last_id + batch_size, max_id)
+        # One row per sid and course, skipping those already recorded...
+        db.executesql(
+            """INSERT INTO {seen} (sid, course_name, first_seen)
+            SELECT n.sid, n.course_id, n.first_seen FROM (
+                SELECT sid, COALESCE(course_id, '') AS course_id, min("timestamp") AS first_seen
+                FROM {useinfo} WHERE id > {low} AND id <= {high} AND sid IS NOT NULL
+                GROUP BY sid, COALESCE(course_id, '')
+            ) AS n
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {seen} AS f WHERE f.sid = n.sid AND f.course_name = n.course_id
+            );""".format(
+                seen=seen, useinfo=useinfo, low=int(last_id), high=int(high)
+            )
+        )
+        # ...and one row per sid across all courses.
+        db.executesql(
+            """INSERT INTO {seen} (sid, course_name, first_seen)
+            SELECT n.sid, NULL, n.first_seen FROM (
+                SELECT sid, min("timestamp") AS first_seen
+                FROM {useinfo} WHERE id > {low} AND id <= {high} AND sid IS NOT NULL
+                GROUP BY sid
+            ) AS n
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {seen} AS f WHERE f.sid = n.sid AND f.course_name IS NULL
+            );""".format(
+                seen=seen, useinfo=useinfo, low=int(last_id), high=int(high)
+            )
+        )
+        last_id = high
+        db(marks.name == _WATERMARK).update(last_id=last_id)
+        db.commit()
+        if progress:
+            progress(last_id)
+    return last_id
+
+
+# Return the number of distinct readers seen anywhere; or, given ``course_name``, in that course; and if ``since`` is given, only those first seen at or after it.
+def count_users(db, course_name=None, since=None, cache=None):
+    if db(db.rollup_watermarks.name == _WATERMARK).isempty():
+        if cache:
+            return cache[0](
+                "count_users:{}:{}".format(course_name, since),
+                lambda: _count_useinfo_users(db, course_name, since),
+                time_expire=cache[1],
+            )
+        return _count_useinfo_users(db, course_name, since)
+    table = db.user_first_seen
+    if course_name:
+        query = table.course_name == course_name
+    else:
+        query = table.course_name == None  # noqa: E711
+    if since:
+        query &= table.first_seen >= since
+    return db(query).count(cache=cache)
+
+
+# Return what ``count_users`` does, counted from ``useinfo``, for use before ``rollup_first_seen`` has run. This reads every row it counts, so it's slow on a large table.
+def _count_useinfo_users(db, course_name, since):
+    useinfo = db.useinfo
+    rep = db._adapter.represent
+    where = "{} IS NOT NULL".format(useinfo.sid._rname)
+    if course_name:
+        where += " AND {} = {}".format(
+            useinfo.course_id._rname, rep(course_name, "string")
+        )
+    having = ""
+    if since:
+        having = " HAVING min({}) >= {}".format(
+            useinfo.timestamp._rname, rep(since, "datetime")
+        )
+    return db.executesql(
+        "SELECT count(*) FROM (SELECT {sid} FROM {useinfo} WHERE {where} "
+        "GROUP BY {sid}{having}) AS X;".format(
+            sid=useinfo.sid._rname, useinfo=useinfo._rname, where=where, having=having
+        )
+    )[0][0]
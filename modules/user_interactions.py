@@ -0,0 +1,187 @@
+# ***********************************************************
+# |docname| - Which questions each reader has interacted with
+# ***********************************************************
+# Each view of a book page showed which of its questions the reader had
+# already tried by finding the distinct ``div_id`` values in ``useinfo`` for
+# that reader, which is slow on a table of tens of millions of rows. Instead,
+# ``user_interactions`` holds one row per reader and question, recording when
+# the reader first interacted with it. :func:`record_interactions`, which
+# ``log_useinfo_rows`` calls, adds rows as events are logged, so every
+# ``hsblog`` and ``runlog`` keeps it up to date; page views aren't recorded.
+# Each process remembers the rows it has added, so repeat interactions cost a
+# dictionary lookup.
+#
+# Like ``record_sid_alias`` in ``modules/sid_alias.py``, rows are added with
+# ``INSERT ... WHERE NOT EXISTS``. Two processes may both add the same row;
+# readers only ask whether a row exists, or for the earliest time, so that's
+# harmless. ``rsmanage rebuildstats`` rebuilds the table from ``useinfo``.
+#
+# A course's interactions logged before the table existed are only in
+# ``useinfo``. Once :func:`rebuild_user_interactions` has copied them, it marks
+# the course as backfilled with a ``rollup_watermarks`` row; courses created
+# since are marked when they're created. Until a course is marked, readers use
+# ``useinfo`` for it, as :func:`interacted_div_ids` does.
+#
+# Imports
+# =======
+# These are listed in the order prescribed by `PEP 8
+# <http://www.python.org/dev/peps/pep-0008/#imports>`_.
+#
+# Standard library
+# ----------------
+import datetime
+import logging
+import threading
+from collections import OrderedDict
+
+# Third-party imports
+# -------------------
+from gluon import current
+
+# Local imports
+# -------------
+from db_bulk import savepoint
+
+logger = logging.getLogger(current.settings.logger)
+logger.setLevel(current.settings.log_level)
+
+# Events which aren't an interaction with a question.
+IGNORED_EVENTS = ("page",)
+
+# The most rows each process remembers adding.
+_MAX_CACHED = 50000
+
+_lock = threading.Lock()
+# Holds ``(course_name, sid, div_id)`` for rows this process has added.
+_recorded = OrderedDict()
+# The courses this process knows are backfilled.
+_backfilled = set()
+
+
+def _backfill_mark(course_name):
+    return "user_interactions:{}".format(course_name)
+
+
+# Return True if ``user_interactions`` holds every interaction in ``course_name``, including those logged before the table existed.
+def is_backfilled(db, course_name):
+    if course_name in _backfilled:
+        return True
+    marks = db.rollup_watermarks
+    if db(marks.name == _backfill_mark(course_name)).isempty():
+        return False
+    with _lock:
+        _backfilled.add(course_name)
+    return True
+
+
+# Note that ``user_interactions`` holds every interaction in ``course_name``: it was rebuilt, or the course is new.
+def mark_backfilled(db, course_name):
+    marks = db.rollup_watermarks
+    if db(marks.name == _backfill_mark(course_name)).isempty():
+        marks.insert(name=_backfill_mark(course_name))
+
+
+# Add a row to ``user_interactions`` for each of ``rows``, a list of ``useinfo`` rows (dicts) which were just logged, unless the reader already has one for that question. Errors are logged, never raised, since this is a side effect of logging.
+def record_interactions(db, rows):
+    table = db.user_interactions
+    rep = db._adapter.represent
+    for row in rows:
+        key = (row.get("course_id"), row.get("sid"), row.get("div_id"))
+        if not all(key) or row.get("event") in IGNORED_EVENTS or key in _recorded:
+            continue
+        # A failed statement would abort the caller's transaction on PostgreSQL, so each insert is undone on its own.
+        try:
+            with savepoint(db):
+                db.executesql(
+                    "INSERT INTO {table} ({course_name}, {sid}, {div_id}, {first_seen}) "
+                    "SELECT {c}, {s}, {d}, {t} WHERE NOT EXISTS (SELECT 1 FROM {table} "
+                    "WHERE {course_name} = {c} AND {sid} = {s} AND {div_id} = {d});".format(
+                        table=table._rname,
+                        course_name=table.course_name._rname,
+                        sid=table.sid._rname,
+                        div_id=table.div_id._rname,
+                        first_seen=table.first_seen._rname,
+                        c=rep(key[0], "string"),
+                        s=rep(key[1], "string"),
+                        d=rep(key[2], "string"),
+                        t=rep(
+                            row.get("timestamp") or datetime.datetime.utcnow(),
+                            "datetime",
+                        ),
+                    )
+                )
+        except Exception as e:
+            logger.error(
+                "failed to record the interaction of {} with {} -- {}".format(
+                    key[1], key[2], e
+                )
+            )
+            continue
+        with _lock:
+            _recorded[key] = True
+            _recorded.move_to_end(key)
+            while len(_recorded) > _MAX_CACHED:
+                _recorded.popitem(last=False)
+
+
+# Return the set of ``div_ids`` which any of ``sids`` (a reader and their aliases) interacted with in ``course_name``; if ``before`` is given, only those first interacted with before it. A course which isn't backfilled is read from ``useinfo``.
+def interacted_div_ids(db, course_name, sids, div_ids, before=None):
+    if not div_ids:
+        return set()
+    if not is_backfilled(db, course_name):
+        useinfo = db.useinfo
+        query = (
+            (useinfo.course_id == course_name)
+            & (useinfo.sid.belongs(sids))
+            & (useinfo.div_id.belongs(div_ids))
+            & (
+                (useinfo.event == None)  # noqa: E711
+                | (~useinfo.event.belongs(IGNORED_EVENTS))
+            )
+        )
+        if before:
+            query &= useinfo.timestamp < before
+        return {row.div_id for row in db(query).select(useinfo.div_id, distinct=True)}
+    table = db.user_interactions
+    query = (
+        (table.course_name == course_name)
+        & (table.sid.belongs(sids))
+        & (table.div_id.belongs(div_ids))
+    )
+    if before:
+        query &= table.first_seen < before
+    return {row.div_id for row in db(query).select(table.div_id, distinct=True)}
+
+
+# Recompute ``user_interactions`` from ``useinfo`` for ``course_name``. Returns the number of rows written.
+def rebuild_user_interactions(db, course_name):
+    table = db.user_interactions
+    db(table.course_name == course_name).delete()
+    useinfo = db.useinfo
+    rep = db._adapter.represent
+    db.executesql(
+        "INSERT INTO {table} ({course_name}, {sid}, {div_id}, {first_seen}) "
+        "SELECT {u_course}, {u_sid}, {u_div_id}, MIN({u_timestamp}) FROM {useinfo} "
+        "WHERE {u_course} = {c} AND {u_sid} IS NOT NULL AND {u_div_id} IS NOT NULL "
+        "AND ({u_event} IS NULL OR {u_event} NOT IN ({ignored})) "
+        "GROUP BY {u_course}, {u_sid}, {u_div_id};".format(
+            table=table._rname,
+            course_name=table.course_name._rname,
+            sid=table.sid._rname,
+            div_id=table.div_id._rname,
+            first_seen=table.first_seen._rname,
+            useinfo=useinfo._rname,
+            u_course=useinfo.course_id._rname,
+            u_sid=useinfo.sid._rname,
+            u_div_id=useinfo.div_id._rname,
+            u_timestamp=useinfo.timestamp._rname,
+            u_event=useinfo.event._rname,
+            c=rep(course_name, "string"),
+            ignored=", ".join(rep(event, "string") for event in IGNORED_EVENTS),
+        )
+    )
+    mark_backfilled(db, course_name)
+    db.commit()
+    with _lock:
+        _recorded.clear()
+    return db(table.course_name == course_name).count()
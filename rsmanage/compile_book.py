@@ -0,0 +1,12 @@
+from book_templates import compile_book
+import json
+
+userinfo = json.loads(os.environ["RSM_USERINFO"])
+
+base_course = userinfo["course"]
+count = compile_book(
+    os.path.join(request.folder, "books", base_course, "published", base_course),
+    os.path.join(request.folder, "views"),
+    os.path.join(request.folder, "build", "compiled_books"),
+)
+print("Compiled {} pages of {}".format(count, base_course))
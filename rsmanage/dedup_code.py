@@ -0,0 +1,17 @@
+from code_store import dedup_code, ensure_blob_index, prune_code_blobs
+import json
+
+userinfo = json.loads(os.environ["RSM_USERINFO"])
+
+# Blobs are looked up by hash, so make sure that lookup is indexed. Databases created by ``rsmanage initdb`` already have this index.
+ensure_blob_index(db)
+
+moved = dedup_code(
+    db,
+    batch_size=userinfo["batch_size"],
+    progress=lambda count: print("Moved {} rows".format(count)),
+)
+print("Done: moved the text of {} code rows into code_blobs".format(moved))
+pruned = prune_code_blobs(db)
+db.commit()
+print("Deleted {} code_blobs rows which no code references".format(pruned))
@@ -1,29 +1,218 @@
 from rs_grading import do_autograde, do_calculate_totals
 import json
+import math
+import queue
+import subprocess
+import sys
+import threading
+import time
 
 userinfo = json.loads(os.environ["RSM_USERINFO"])
 # print(userinfo['course'], userinfo['pset'])
 # # print(db.keys())
 # print(settings)
 
-assignmentid = userinfo["pset"]
-assignment = db(db.assignments.id == assignmentid).select().first()
+# A worker prints this before the JSON result of each unit it grades, since grading prints other output.
+RESULT_PREFIX = "RSM_GRADED "
+# The most students in one unit of work.
+SHARD_SIZE = 25
+
 course = db(db.courses.course_name == userinfo["course"]).select().first()
-do_autograde(
-    assignment,
-    course.id,
-    course.course_name,
-    sid=None,
-    student_rownum=None,
-    question_name=None,
-    enforce_deadline=userinfo["enforce_deadline"],
-    # I don't know what this is for, but if you want to set this to Michigan timezone offset, it should be 4
-    # not 5.
-    timezoneoffset=240,
-    db=db,
-    settings=settings,
-)
-
-do_calculate_totals(
-    assignment, course.id, course.course_name, sid=None, db=db, settings=settings
-)
+enforce_deadline = "true" if userinfo["enforce_deadline"] else "false"
+
+
+# Grade ``sids`` on the assignment with id ``assignment_id``, then compute their totals.
+def grade_unit(assignment_id, sids):
+    assignment = db(db.assignments.id == assignment_id).select().first()
+    do_autograde(
+        assignment,
+        course.id,
+        course.course_name,
+        sid=None,
+        student_rownum=None,
+        question_name=None,
+        enforce_deadline=enforce_deadline,
+        # I don't know what this is for, but if you want to set this to Michigan timezone offset, it should be 4
+        # not 5.
+        timezoneoffset=240,
+        db=db,
+        settings=settings,
+        sids=sids,
+    )
+    do_calculate_totals(
+        assignment,
+        course.id,
+        course.course_name,
+        sid=None,
+        student_rownum=None,
+        db=db,
+        settings=settings,
+        sids=sids,
+    )
+    db.commit()
+
+
+# Run in a worker started by ``run_parallel``: grade each unit, a JSON list of ``[assignment id, sids]``, read from stdin.
+def run_worker():
+    for line in sys.stdin:
+        assignment_id, sids = json.loads(line)
+        try:
+            grade_unit(assignment_id, sids)
+            result = dict(assignment=assignment_id, sids=sids)
+        except Exception as e:
+            db.rollback()
+            result = dict(assignment=assignment_id, sids=sids, error=str(e))
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+# Grade ``units`` with ``workers`` processes, each with its own database connection, calling ``done`` with the result of each unit.
+def run_parallel(units, workers, done):
+    todo = queue.Queue()
+    for unit in units:
+        todo.put(unit)
+    results = queue.Queue()
+    env = dict(os.environ)
+    env["RSM_USERINFO"] = json.dumps(dict(userinfo, worker=True))
+
+    def feed():
+        worker = subprocess.Popen(
+            [
+                sys.executable,
+                "web2py.py",
+                "-S",
+                "runestone",
+                "-M",
+                "-R",
+                "applications/runestone/rsmanage/grade.py",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            env=env,
+        )
+        try:
+            while True:
+                try:
+                    assignment_id, sids = todo.get_nowait()
+                except queue.Empty:
+                    break
+                worker.stdin.write(json.dumps([assignment_id, sids]) + "\n")
+                worker.stdin.flush()
+                for line in worker.stdout:
+                    if line.startswith(RESULT_PREFIX):
+                        results.put(json.loads(line[len(RESULT_PREFIX) :]))
+                        break
+                else:
+                    results.put(
+                        dict(
+                            assignment=assignment_id,
+                            sids=sids,
+                            error="the worker stopped",
+                        )
+                    )
+                    break
+        finally:
+            worker.stdin.close()
+            worker.wait()
+
+    threads = [threading.Thread(target=feed, daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for i in range(len(units)):
+        while True:
+            try:
+                done(results.get(timeout=1))
+                break
+            except queue.Empty:
+                if not any(t.is_alive() for t in threads) and results.empty():
+                    return
+
+
+if userinfo.get("worker"):
+    run_worker()
+else:
+    if userinfo["pset"] == "all":
+        assignment_ids = [
+            row.id
+            for row in db(db.assignments.course == course.id).select(
+                db.assignments.id, orderby=db.assignments.id
+            )
+        ]
+    else:
+        assignment_ids = [int(userinfo["pset"])]
+    students = [
+        row.username
+        for row in db(
+            (db.user_courses.course_id == course.id)
+            & (db.user_courses.user_id == db.auth_user.id)
+        ).select(db.auth_user.username, orderby=db.auth_user.username)
+    ]
+
+    # The (assignment, student) pairs already graded are listed here, so an interrupted run can be resumed.
+    state_path = os.path.join(
+        request.folder, "build", "grading", "{}.done".format(course.course_name)
+    )
+    graded = set()
+    if userinfo.get("resume") and os.path.exists(state_path):
+        with open(state_path) as f:
+            graded = {tuple(line.split()) for line in f}
+    else:
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        open(state_path, "w").close()
+
+    units = []
+    for assignment_id in assignment_ids:
+        sids = [sid for sid in students if (str(assignment_id), sid) not in graded]
+        shard_size = min(
+            SHARD_SIZE, max(1, math.ceil(len(sids) / userinfo.get("parallel", 1)))
+        )
+        units.extend(
+            (assignment_id, sids[i : i + shard_size])
+            for i in range(0, len(sids), shard_size)
+        )
+    total = sum(len(sids) for assignment_id, sids in units)
+    print(
+        "Grading {} students on {} assignments; {} already graded".format(
+            len(students), len(assignment_ids), len(graded)
+        )
+    )
+
+    start = time.time()
+    progress = dict(count=0, failed=0)
+
+    def done(result):
+        if "error" in result:
+            progress["failed"] += len(result["sids"])
+            print(
+                "Failed to grade assignment {} for {}: {}".format(
+                    result["assignment"], ", ".join(result["sids"]), result["error"]
+                )
+            )
+        else:
+            with open(state_path, "a") as f:
+                f.writelines(
+                    "{} {}\n".format(result["assignment"], sid)
+                    for sid in result["sids"]
+                )
+        progress["count"] += len(result["sids"])
+        elapsed = time.time() - start
+        eta = elapsed / progress["count"] * (total - progress["count"])
+        print(
+            "{}/{} graded, {:.0f}s elapsed, about {:.0f}s left".format(
+                progress["count"], total, elapsed, eta
+            ),
+            flush=True,
+        )
+
+    if userinfo.get("parallel", 1) > 1:
+        run_parallel(units, userinfo["parallel"], done)
+    else:
+        for assignment_id, sids in units:
+            grade_unit(assignment_id, sids)
+            done(dict(assignment=assignment_id, sids=sids))
+
+    if progress["count"] < total or progress["failed"]:
+        print("Not every student was graded; rerun with --resume to finish.")
+    else:
+        os.remove(state_path)
+        print("Done.")
@@ -151,6 +151,48 @@ if environ.get("WEB2PY_MIGRATE", "") != "fake":
         db.executesql(
             """create index code_timestamp_idx on code using btree(timestamp)"""
         )
+        db.executesql(
+            """create index code_blobs_hash_idx on code_blobs using btree(hash)"""
+        )
+        db.executesql(
+            """create index code_latest_idx on code_latest using btree(sid, acid)"""
+        )
+        db.executesql(
+            """create index sid_alias_alias_idx on sid_alias using btree(alias)"""
+        )
+        db.executesql(
+            """create index sid_alias_sid_idx on sid_alias using btree(sid)"""
+        )
+        db.executesql(
+            """create index presence_minute_idx on presence using btree(minute)"""
+        )
+        db.executesql(
+            """create index user_first_seen_sid_course_idx on user_first_seen using btree(sid, course_name)"""
+        )
+        db.executesql(
+            """create index user_first_seen_course_idx on user_first_seen using btree(course_name, first_seen)"""
+        )
+        db.executesql(
+            """create index question_answer_stats_idx on question_answer_stats using btree(course_name, div_id, day)"""
+        )
+        db.executesql(
+            """create index poll_votes_idx on poll_votes using btree(course_name, div_id, sid)"""
+        )
+        db.executesql(
+            """create index poll_option_counts_idx on poll_option_counts using btree(course_name, div_id)"""
+        )
+        db.executesql(
+            """create index fitb_answer_counts_idx on fitb_answer_counts using btree(course_name, div_id, day)"""
+        )
+        db.executesql(
+            """create index autograde_watermarks_idx on autograde_watermarks using btree(assignment_id, div_id)"""
+        )
+        db.executesql(
+            """create index user_answer_counters_idx on user_answer_counters using btree(course_name, sid, event)"""
+        )
+        db.executesql(
+            """create index user_interactions_idx on user_interactions using btree(course_name, sid, div_id)"""
+        )
         db.executesql(
             """create index mult_scd_idx on mchoice_answers (div_id, course_name, sid)"""
         )
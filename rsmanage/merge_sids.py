@@ -0,0 +1,27 @@
+import json
+
+userinfo = json.loads(os.environ["RSM_USERINFO"])
+
+if userinfo["every"]:
+    if not settings.academy_mode:
+        print("The scheduler only runs in academy mode; run mergesids without --every")
+        exit(1)
+    db(db.scheduler_task.task_name == "merge_sid_aliases").delete()
+    scheduler.queue_task(
+        merge_sid_aliases_task,
+        task_name="merge_sid_aliases",
+        period=userinfo["every"] * 60,
+        repeats=0,
+        timeout=3600,
+    )
+    db.commit()
+    print("Queued merge_sid_aliases every {} minutes".format(userinfo["every"]))
+else:
+    count = merge_sid_aliases(
+        db,
+        batch_size=userinfo["batch_size"],
+        progress=lambda alias, sid, rows: print(
+            "{} -> {}: {} rows".format(alias, sid, rows)
+        ),
+    )
+    print("Done: merged {} aliases".format(count))
@@ -0,0 +1,27 @@
+from answer_stats import (
+    rebuild_fitb_answer_counts,
+    rebuild_poll_tallies,
+    rebuild_question_answer_stats,
+    rebuild_user_answer_counters,
+)
+from user_interactions import rebuild_user_interactions
+import json
+
+userinfo = json.loads(os.environ["RSM_USERINFO"])
+
+if userinfo["course"]:
+    courses = [userinfo["course"]]
+else:
+    courses = [row.course_name for row in db(db.courses).select(db.courses.course_name)]
+
+for course_name in courses:
+    rows = rebuild_question_answer_stats(db, course_name)
+    print("{}: {} question_answer_stats rows".format(course_name, rows))
+    votes = rebuild_poll_tallies(db, course_name)
+    print("{}: {} poll votes".format(course_name, votes))
+    rows = rebuild_fitb_answer_counts(db, course_name)
+    print("{}: {} fitb_answer_counts rows".format(course_name, rows))
+    rows = rebuild_user_answer_counters(db, course_name)
+    print("{}: {} user_answer_counters rows".format(course_name, rows))
+    rows = rebuild_user_interactions(db, course_name)
+    print("{}: {} user_interactions rows".format(course_name, rows))
@@ -0,0 +1,29 @@
+import json
+
+userinfo = json.loads(os.environ["RSM_USERINFO"])
+
+if userinfo["every"]:
+    if not settings.academy_mode:
+        print(
+            "The scheduler only runs in academy mode; run rollupusers without --every"
+        )
+        exit(1)
+    db(db.scheduler_task.task_name == "rollup_first_seen").delete()
+    scheduler.queue_task(
+        rollup_first_seen_task,
+        task_name="rollup_first_seen",
+        period=userinfo["every"] * 60,
+        repeats=0,
+        timeout=3600,
+    )
+    db.commit()
+    print("Queued rollup_first_seen every {} minutes".format(userinfo["every"]))
+else:
+    last_id = rollup_first_seen(
+        db,
+        batch_size=userinfo["batch_size"],
+        progress=lambda last_id: print(
+            "Processed useinfo through id {}".format(last_id)
+        ),
+    )
+    print("Done: processed useinfo through id {}".format(last_id))
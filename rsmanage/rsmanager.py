@@ -428,6 +428,26 @@ def build(config, course, repo, skipclone):
     subprocess.call("rm -rf {}".format(proj_dir), shell=True)
 
 
+#
+#    compilebook
+#
+
+
+@cli.command()
+@click.option("--course", help="The base course (book) to compile")
+@pass_config
+def compilebook(config, course):
+    """Compile the pages of a deployed book, so the server doesn't parse them on first view"""
+    os.chdir(findProjectRoot())
+
+    os.environ["RSM_USERINFO"] = json.dumps(dict(course=course))
+
+    subprocess.call(
+        "python web2py.py -S runestone -M -R applications/runestone/rsmanage/compile_book.py",
+        shell=True,
+    )
+
+
 #
 #    inituser
 #
@@ -772,9 +792,25 @@ def instructors(config, course):
 @click.option(
     "--course", help="The name of a course that should already exist in the DB"
 )
-@click.option("--pset", help="Database ID of the Problem Set")
+@click.option(
+    "--pset",
+    "--assignment",
+    "pset",
+    help="Database ID of the Problem Set, or all to grade every assignment in the course",
+)
+@click.option(
+    "--parallel",
+    default=1,
+    type=click.IntRange(1, None),
+    help="Number of worker processes to grade with",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Skip the students already graded by an interrupted run",
+)
 @pass_config
-def grade(config, course, pset, enforce):
+def grade(config, course, pset, enforce, parallel, resume):
     """Grade a problem set; hack for long-running grading processes"""
     os.chdir(findProjectRoot())
 
@@ -784,6 +820,8 @@ def grade(config, course, pset, enforce):
     userinfo["enforce_deadline"] = (
         enforce if enforce else click.confirm("Enforce deadline?", default=True)
     )
+    userinfo["parallel"] = parallel
+    userinfo["resume"] = resume
     os.environ["RSM_USERINFO"] = json.dumps(userinfo)
 
     subprocess.call(
@@ -792,6 +830,106 @@ def grade(config, course, pset, enforce):
     )
 
 
+#
+#    rebuildstats
+#
+
+
+@cli.command()
+@click.option("--course", help="Rebuild only this course; default is every course")
+@pass_config
+def rebuildstats(config, course):
+    """Recompute the answer stats, poll tally, answer count and interaction tables"""
+    os.chdir(findProjectRoot())
+
+    os.environ["RSM_USERINFO"] = json.dumps(dict(course=course))
+
+    subprocess.call(
+        "python web2py.py -S runestone -M -R applications/runestone/rsmanage/rebuild_stats.py",
+        shell=True,
+    )
+
+
+#
+#    rollupusers
+#
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=100000,
+    help="Number of useinfo ids to process per transaction",
+)
+@click.option(
+    "--every",
+    default=0,
+    help="Instead of running now, have the scheduler run every EVERY minutes",
+)
+@pass_config
+def rollupusers(config, batch_size, every):
+    """Update the first-seen table behind the reader counts"""
+    os.chdir(findProjectRoot())
+
+    os.environ["RSM_USERINFO"] = json.dumps(dict(batch_size=batch_size, every=every))
+
+    subprocess.call(
+        "python web2py.py -S runestone -M -R applications/runestone/rsmanage/rollup_users.py",
+        shell=True,
+    )
+
+
+#
+#    mergesids
+#
+
+
+@cli.command()
+@click.option(
+    "--batch-size",
+    default=5000,
+    help="Number of useinfo rows to rewrite per transaction",
+)
+@click.option(
+    "--every",
+    default=0,
+    help="Instead of merging now, have the scheduler merge every EVERY minutes",
+)
+@pass_config
+def mergesids(config, batch_size, every):
+    """Move the history of anonymous readers to the username they logged in with"""
+    os.chdir(findProjectRoot())
+
+    os.environ["RSM_USERINFO"] = json.dumps(dict(batch_size=batch_size, every=every))
+
+    subprocess.call(
+        "python web2py.py -S runestone -M -R applications/runestone/rsmanage/merge_sids.py",
+        shell=True,
+    )
+
+
+#
+#    dedupcode
+#
+
+
+@cli.command()
+@click.option(
+    "--batch-size", default=1000, help="Number of code rows to move per transaction"
+)
+@pass_config
+def dedupcode(config, batch_size):
+    """Move saved code into the content-addressed code_blobs table, then delete unreferenced blobs; safe to interrupt and rerun"""
+    os.chdir(findProjectRoot())
+
+    os.environ["RSM_USERINFO"] = json.dumps(dict(batch_size=batch_size))
+
+    subprocess.call(
+        "python web2py.py -S runestone -M -R applications/runestone/rsmanage/dedup_code.py",
+        shell=True,
+    )
+
+
 @cli.command()
 @click.option("--course", help="name of course")
 @pass_config
@@ -131,11 +131,15 @@ function getSelectedItem(type) {
     }
 }
 
+// The most students graded in one autograding request.
+var autoGradeChunkSize = 25;
+
 function autoGrade() {
     var assignment = getSelectedItem("assignment")
     var question = getSelectedItem("question")
     var studentID = getSelectedItem("student")
     var enforceDeadline = $('#enforceDeadline').is(':checked')
+    var forceRegrade = $('#forceRegrade').is(':checked')
     var params = {
         url: eBookConfig.autogradingURL,
         type: "POST",
@@ -144,7 +148,8 @@ function autoGrade() {
             assignment: assignment,
             question: question,
             sid: studentID,
-            enforceDeadline: enforceDeadline
+            enforceDeadline: enforceDeadline,
+            force: forceRegrade
         },
         success: function (retdata) {
             $('#assignmentTotalform').css('visibility', 'hidden');
@@ -153,20 +158,30 @@ function autoGrade() {
     }
 
     if (assignment != null && question === null && studentID == null) {
-        (async function (students, ajax_params) {
-            // Grade each student provided.
-            let student_array = Object.keys(students);
-            for (let index = 0; index < student_array.length; ++index) {
-                let student = student_array[index];
-                ajax_params.data.sid = student;
-                res = await jQuery.ajax(ajax_params);
-                $("#autogradingprogress").html(`Student ${index + 1} of ${student_array.length}: ${res.message} for ${student}`);
+        (async function (ajax_params) {
+            try {
+                // Ask which students to grade; unless forced, only the students with new answers are regraded.
+                let plan = await jQuery.ajax($.extend(true, {}, ajax_params, { data: { plan: true } }));
+                if (!plan.success) {
+                    throw plan.message;
+                }
+                let student_array = plan.students;
+                // Grade a few students per request, so no request takes too long.
+                for (let index = 0; index < student_array.length; index += autoGradeChunkSize) {
+                    let chunk = student_array.slice(index, index + autoGradeChunkSize);
+                    let res = await jQuery.ajax($.extend(true, {}, ajax_params, { data: { sids: JSON.stringify(chunk) } }));
+                    $("#autogradingprogress").html(`Students ${index + 1} to ${index + chunk.length} of ${student_array.length}: ${res.message}`);
+                }
+                // Record that every student was graded, so the next run only regrades new answers.
+                await jQuery.ajax($.extend(true, {}, ajax_params, { data: { finish: true } }));
+                // Clear the graing progress.
+                $("#autogradingprogress").html('');
+            } catch (e) {
+                $("#autogradingprogress").html('Grading failed; grade again to finish.');
             }
-            // Clear the graing progress.
-            $("#autogradingprogress").html('');
             calculateTotals();
             $("#autogradesubmit").prop("disabled", false);
-        })(students, params);
+        })(params);
     } else {
         jQuery.ajax(params).always(function () {
             calculateTotals();
@@ -337,14 +337,18 @@ def runestone_db(runestone_controller):
  public.auth_membership,
  public.auth_permission,
  public.auth_user,
+ public.autograde_watermarks,
  public.clickablearea_answers,
  public.coach_hints,
  public.code,
+ public.code_blobs,
+ public.code_latest,
  public.codelens_answers,
  public.course_instructor,
  public.course_practice,
  public.courses,
  public.dragndrop_answers,
+ public.fitb_answer_counts,
  public.fitb_answers,
  public.grades,
  public.lp_answers,
@@ -352,19 +356,28 @@ def runestone_db(runestone_controller):
  public.mchoice_answers,
  public.parsons_answers,
  public.payments,
+ public.poll_option_counts,
+ public.poll_votes,
+ public.presence,
  public.practice_grades,
+ public.question_answer_stats,
  public.question_grades,
  public.question_tags,
+ public.rollup_watermarks,
  public.section_users,
  public.sections,
  public.shortanswer_answers,
+ public.sid_alias,
  public.sub_chapter_taught,
  public.tags,
  public.timed_exam,
  public.useinfo,
+ public.user_answer_counters,
  public.user_biography,
  public.user_chapter_progress,
  public.user_courses,
+ public.user_first_seen,
+ public.user_interactions,
  public.user_state,
  public.user_sub_chapter_progress,
  public.user_topic_practice,
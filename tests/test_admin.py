@@ -1,3 +1,4 @@
+import datetime
 import json
 import pytest
 
@@ -81,15 +82,27 @@ def test_removestudents(test_user, test_client, test_user_1, runestone_db_tools)
     my_inst = test_user("new_instructor", "password", test_user_1.course)
     my_inst.make_instructor()
     my_inst.login()
+    db = runestone_db_tools.db
+    db.code_latest.insert(
+        sid=test_user_1.username,
+        acid="removed_acid",
+        course_id=test_user_1.course.course_id,
+        timestamp=datetime.datetime.utcnow(),
+    )
+    db.commit()
     res = test_client.validate(
         "admin/removeStudents",
         "Assignments",
         data=dict(studentList=test_user_1.user_id),
     )
 
-    db = runestone_db_tools.db
     res = db(db.auth_user.id == test_user_1.user_id).select().first()
     assert res.active == False
+    # The student's latest code moves to the base course with the rest of their code.
+    base_course_id = res.course_id
+    assert db(db.code_latest.acid == "removed_acid").select().first().course_id == (
+        base_course_id
+    )
 
 
 def test_htmlsrc(test_client, test_user_1):
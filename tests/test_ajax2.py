@@ -1,4 +1,5 @@
 import datetime
+import importlib
 import json
 import pytest
 
@@ -98,6 +99,156 @@ def test_hsblog(test_client, test_user_1, test_user, runestone_db_tools):
     assert dbres[0].course_id == test_user_1.course.course_name
 
 
+def test_hsblog_batch(test_client, test_user_1, runestone_db_tools):
+    test_user_1.login()
+    course = test_user_1.course.course_name
+    events = [
+        dict(event="page", act="view", div_id="batch_page", course=course),
+        dict(
+            event="mChoice",
+            act="answer:1:correct",
+            answer="1",
+            correct="T",
+            div_id="batch_mc",
+            course=course,
+        ),
+        dict(
+            event="mChoice",
+            act="answer:0:no",
+            answer="0",
+            correct="F",
+            div_id="batch_mc",
+            course=course,
+        ),
+        dict(
+            event="timedExam",
+            act="finish",
+            correct="1",
+            incorrect="2",
+            skipped="3",
+            time="40",
+            div_id="batch_exam",
+            course=course,
+        ),
+    ]
+    res = ajaxCall(test_client, "hsblog_batch", events=json.dumps(events))
+    assert len(res) == 4
+    assert all(r["log"] for r in res)
+
+    db = runestone_db_tools.db
+    assert db(db.useinfo.div_id.startswith("batch_")).count() == 4
+    mc = db(db.mchoice_answers.div_id == "batch_mc").select(
+        orderby=db.mchoice_answers.id
+    )
+    assert [row.answer for row in mc] == ["1", "0"]
+    assert [row.correct for row in mc] == [True, False]
+    # Answers to the same question keep their order by time.
+    assert mc[0].timestamp < mc[1].timestamp
+    exam = db(db.timed_exam.div_id == "batch_exam").select().first()
+    assert exam.incorrect == 2
+    # Page views aren't interactions, and each question is recorded once.
+    interactions = db(db.user_interactions.div_id.startswith("batch_")).select(
+        orderby=db.user_interactions.div_id
+    )
+    assert [row.div_id for row in interactions] == ["batch_exam", "batch_mc"]
+
+    res = ajaxCall(test_client, "hsblog_batch", events="not json")
+    assert not res["log"]
+
+    # A bad event is reported in its place; the others are still saved.
+    events = [
+        dict(event="mChoice", act=["bad"], div_id="batch_bad", course=course),
+        dict(event="page", div_id="batch_page", course=course),
+        dict(
+            event="mChoice",
+            act="answer:1",
+            answer=1,
+            correct="T",
+            div_id="batch_num",
+            course=course,
+        ),
+    ]
+    res = ajaxCall(test_client, "hsblog_batch", events=json.dumps(events))
+    assert not res[0]["log"]
+    assert res[0]["errors"] == ["act must be a string"]
+    assert res[1]["log"] and res[2]["log"]
+    assert db(db.useinfo.div_id == "batch_bad").count() == 0
+    assert db(db.useinfo.div_id == "batch_page").count() == 2
+    assert db(db.mchoice_answers.div_id == "batch_num").select().first().answer == "1"
+
+
+def test_sid_alias(test_client, test_user_1, runestone_controller):
+    # Log an event anonymously; this sets the ``ipuser`` cookie.
+    course = test_user_1.course.course_name
+    kwargs = dict(event="page", act="view", div_id="alias_page", course=course)
+    ajaxCall(test_client, "hsblog", **kwargs)
+    db = runestone_controller.db
+    anon_sid = db(db.useinfo.div_id == "alias_page").select().first().sid
+
+    # After logging in, the anonymous history is recorded as an alias...
+    test_user_1.login()
+    ajaxCall(test_client, "hsblog", **kwargs)
+    ajaxCall(test_client, "hsblog", **kwargs)
+    db.commit()
+    aliases = db(db.sid_alias.alias == anon_sid).select()
+    assert len(aliases) == 1
+    assert aliases[0].sid == "test_user_1"
+    assert db(db.useinfo.sid == anon_sid).count() == 1
+
+    # ...and is rewritten by the merge.
+    assert runestone_controller.merge_sid_aliases(db) == 1
+    assert db(db.useinfo.sid == anon_sid).count() == 0
+    assert db(db.useinfo.sid == "test_user_1").count() == 3
+    assert db(db.sid_alias.merged != None).count() == 1  # noqa: E711
+
+    # Rows logged under the alias after the merge are merged the next time it's recorded.
+    sid_alias = importlib.import_module(
+        runestone_controller.merge_sid_aliases.__module__
+    )
+    db.useinfo.insert(sid=anon_sid, div_id="alias_page", event="page", course_id=course)
+    sid_alias.record_sid_alias(db, anon_sid, "test_user_1")
+    assert db(db.sid_alias.merged == None).count() == 1  # noqa: E711
+    assert runestone_controller.merge_sid_aliases(db) == 1
+    assert db(db.useinfo.sid == anon_sid).count() == 0
+
+    # The same alias may belong to another sid.
+    sid_alias.record_sid_alias(db, anon_sid, "test_user_2")
+    assert db(db.sid_alias.alias == anon_sid).count() == 2
+
+
+def test_sid_alias_poll_votes(test_client, test_user_1, runestone_controller):
+    # Vote anonymously in two polls, then vote again in one of them after logging in.
+    course = test_user_1.course.course_name
+    for div_id in ("alias_poll_1", "alias_poll_2"):
+        ajaxCall(
+            test_client, "hsblog", event="poll", act="1", div_id=div_id, course=course
+        )
+    test_user_1.login()
+    ajaxCall(
+        test_client,
+        "hsblog",
+        event="poll",
+        act="2",
+        div_id="alias_poll_1",
+        course=course,
+    )
+    db = runestone_controller.db
+    db.commit()
+
+    # After the merge, only the latest vote in each poll is kept and counted.
+    runestone_controller.merge_sid_aliases(db)
+    votes = db(db.poll_votes.course_name == course).select(orderby=db.poll_votes.div_id)
+    assert [(row.div_id, row.sid, row.vote) for row in votes] == [
+        ("alias_poll_1", "test_user_1", 2),
+        ("alias_poll_2", "test_user_1", 1),
+    ]
+    counts = db(
+        (db.poll_option_counts.course_name == course)
+        & (db.poll_option_counts.div_id == "alias_poll_1")
+    ).select()
+    assert {row.vote: row.vote_count for row in counts} == {1: 0, 2: 1}
+
+
 def ajaxCall(client, funcName, **kwargs):
     """
     Call the funcName using the client
@@ -437,6 +588,59 @@ def test_GetDragNDropResults(test_client, test_user_1):
     assert res["correct"]
 
 
+def test_GetPageAssessResults(test_client, test_user_1):
+    test_user_1.login()
+    course = test_user_1.course.course_name
+    for val in ["0", "2"]:
+        test_user_1.hsblog(
+            event="mChoice",
+            div_id="page_mchoice",
+            answer=val,
+            act=val,
+            correct="T" if val == "2" else "F",
+            course=course,
+        )
+    test_user_1.hsblog(
+        event="parsons",
+        div_id="page_parsons",
+        answer="0_0-1_0",
+        act="0_0-1_0",
+        correct="F",
+        course=course,
+        source="page_source",
+    )
+
+    components = [
+        ["page_mchoice", "mChoice"],
+        ["page_parsons", "parsons"],
+        ["page_unanswered", "clickableArea"],
+    ]
+    res = ajaxCall(
+        test_client,
+        "getPageAssessResults",
+        course=course,
+        components=json.dumps(components),
+    )
+    # Only the latest answer is restored, and unanswered questions are left out.
+    assert sorted(res) == ["page_mchoice", "page_parsons"]
+    assert res["page_mchoice"]["answer"] == "2"
+    assert res["page_mchoice"]["correct"]
+    assert res["page_parsons"]["source"] == "page_source"
+
+    res = ajaxCall(test_client, "getPageAssessResults", components="not json")
+    assert res["errors"]
+
+    # Only an instructor may load another student's answers.
+    res = ajaxCall(
+        test_client,
+        "getPageAssessResults",
+        course=course,
+        sid="test_user_2",
+        components=json.dumps(components),
+    )
+    assert res["errors"]
+
+
 def test_GetHist(test_client, test_user_1):
 
     test_user_1.login()
@@ -483,6 +687,21 @@ def test_GetHist(test_client, test_user_1):
 
     assert res["history"][-1] == prog[0]["source"]
 
+    # Fetch the index of versions, then one version and its diff.
+    kwargs["index"] = "true"
+    index = ajaxCall(test_client, "gethist", **kwargs)
+    assert "history" not in index
+    assert len(index["versions"]) == 10
+    assert index["timestamps"] == res["timestamps"]
+
+    kwargs = dict(acid="test_activecode_1", version=index["versions"][3])
+    version = ajaxCall(test_client, "gethistversion", **kwargs)
+    assert version["source"] == "test_code_3"
+    version = ajaxCall(test_client, "gethistversion", diff="true", **kwargs)
+    assert version["previous"] == index["versions"][2]
+    assert "-test_code_2" in version["diff"]
+    assert "+test_code_3" in version["diff"]
+
 
 def test_RunLog(test_client, test_user_1):
 
@@ -511,6 +730,43 @@ def test_RunLog(test_client, test_user_1):
     assert prog[0]["source"] == "this is a unittest"
 
 
+def test_code_blobs(test_client, test_user_1, runestone_db_tools):
+    test_user_1.login()
+    kwargs = dict(
+        course=test_user_1.course.course_name,
+        div_id="test_activecode_blob",
+        code="print('same')",
+        error_info="success",
+        event="acivecode",
+        to_save="true",
+    )
+    test_client.post("ajax/runlog", data=kwargs)
+    test_client.post("ajax/runlog", data=kwargs)
+
+    # Identical saves share one blob; the ``code`` rows only reference it.
+    db = runestone_db_tools.db
+    rows = db(db.code.acid == "test_activecode_blob").select()
+    assert len(rows) == 2
+    assert all(row.code is None for row in rows)
+    assert db(db.code_blobs.hash == rows[0].code_hash).count() == 1
+    # The model creates the index blobs are looked up by.
+    assert db.executesql("SELECT to_regclass('code_blobs_hash_idx');")[0][0]
+
+    # Rows saved before blobs existed are still read from ``code``.
+    db.code.insert(
+        sid="test_user_1",
+        acid="test_activecode_blob",
+        code="print('legacy')",
+        course_id=test_user_1.course.course_id,
+        timestamp=datetime.datetime.utcnow(),
+    )
+    db.commit()
+    res = ajaxCall(test_client, "gethist", acid="test_activecode_blob")
+    assert res["history"] == ["print('same')", "print('same')", "print('legacy')"]
+    prog = ajaxCall(test_client, "getprog", acid="test_activecode_blob")
+    assert prog[0]["source"] == "print('legacy')"
+
+
 def test_GetLastPage(test_client, test_user_1):
 
     test_user_1.login()
@@ -530,6 +786,12 @@ def test_GetLastPage(test_client, test_user_1):
     assert res[0]["lastPageUrl"] == "test_chapter_1/subchapter_a.html"
     assert res[0]["lastPageChapter"] == "Test chapter 1"
 
+    # Scrolling on the same page may be held in memory, but is written before it's read.
+    kwargs["lastPageScrollLocation"] = 200
+    test_client.post("ajax/updatelastpage", data=kwargs)
+    res = ajaxCall(test_client, "getlastpage", **kwargs)
+    assert res[0]["lastPageScrollLocation"] == "200"
+
 
 def test_GetNumOnline(test_client, test_user_1, test_user):
     test_GetTop10Answers(test_client, test_user_1, test_user)
@@ -538,6 +800,29 @@ def test_GetNumOnline(test_client, test_user_1, test_user):
     res = json.loads(test_client.text)
     assert res[0]["online"] == 6
 
+    res = ajaxCall(
+        test_client, "getnumonlinecourse", course=test_user_1.course.course_name
+    )
+    assert res[0]["online"] == 6
+    res = ajaxCall(test_client, "getnumonlinecourse", course="no_such_course")
+    assert res[0]["online"] == 0
+
+
+def test_GetNumUsers(test_client, test_user_1, test_user, runestone_controller):
+    test_GetTop10Answers(test_client, test_user_1, test_user)
+    db = runestone_controller.db
+    # Before the first rollup, readers are counted from ``useinfo``.
+    user_counts = importlib.import_module(
+        runestone_controller.rollup_first_seen.__module__
+    )
+    assert user_counts.count_users(db) == 6
+    assert user_counts.count_users(db, test_user_1.course.course_name) == 6
+    runestone_controller.rollup_first_seen(db)
+    res = ajaxCall(test_client, "getnumusers")
+    assert res[0]["numusers"] == 6
+    course_name = test_user_1.course.course_name
+    assert db(db.user_first_seen.course_name == course_name).count() == 6
+
 
 def test_GetTop10Answers(test_client, test_user_1, test_user):
     user_ids = []
@@ -727,6 +1012,22 @@ def test_GetAgregateResults(test_client, test_user_1, test_user):
     for student in res["reslist"]:
         assert student[1] == expect[student[0]]
 
+    # The list of students can be paged.
+    test_client.validate(
+        "ajax/getaggregateresults", data=dict(kwargs, page=1, page_size=5)
+    )
+    res = json.loads(test_client.text)[0]
+    assert res["reslist_students"] == len(expect)
+    assert [student[0] for student in res["reslist"]] == sorted(expect)[5:10]
+
+    # Bad paging parameters give an error, not a server error.
+    test_client.validate(
+        "ajax/getaggregateresults", data=dict(kwargs, page="x", page_size=5)
+    )
+    res = json.loads(test_client.text)[0]
+    assert "reslist" not in res
+    assert res["emess"]
+
 
 def test_GetCompletionStatus(test_client, test_user_1, runestone_db_tools):
     test_user_1.login()
@@ -759,6 +1060,13 @@ def test_GetCompletionStatus(test_client, test_user_1, runestone_db_tools):
     assert row.start_date.day == today.day
     assert row.start_date.year == today.year
 
+    # Pages which aren't sub-chapters, such as the index, don't start progress.
+    kwargs = dict(
+        lastPageUrl="https://runestone.academy/runestone/books/published/test_course_1/genindex.html"
+    )
+    test_client.validate("ajax/getCompletionStatus", data=kwargs)
+    assert db(db.user_sub_chapter_progress.sub_chapter_id == "genindex").isempty()
+
     # Check a viewed page w/ completion status 0
     # 'View the page'
     kwargs = dict(
@@ -913,3 +1221,22 @@ def test_get_datafile(test_client, test_user_1, runestone_db_tools):
     print(test_client.text)
     res = json.loads(test_client.text)
     assert res["data"] is None
+
+    # Revalidating the datafile returns ``304 Not Modified``.
+    kwargs = dict(course_id=test_user_1.course.course_name, acid="mystery.txt")
+    test_client.validate("ajax/get_datafile", data=kwargs)
+    headers = {k.lower(): v for k, v in test_client.headers.items()}
+    test_client.validate(
+        "ajax/get_datafile",
+        expected_status=304,
+        data=kwargs,
+        headers={"If-None-Match": headers["etag"]},
+    )
+
+    # Read several datafiles at once.
+    kwargs = dict(
+        course_id=test_user_1.course.course_name,
+        acids="mystery.txt,thisWillNotBeThere.txt",
+    )
+    res = ajaxCall(test_client, "get_datafiles", **kwargs)
+    assert res["data"] == {"mystery.txt": "hello world", "thisWillNotBeThere.txt": None}
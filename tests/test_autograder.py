@@ -1,3 +1,4 @@
+import datetime
 import json
 import time
 import pytest
@@ -210,6 +211,96 @@ def test_grade_one_student(
                 assert totres["score"] == 10
 
 
+def test_incremental_autograde(
+    test_assignment, test_user_1, test_user, runestone_db_tools, test_client
+):
+    test_user_1.make_instructor()
+    test_user_1.login()
+    my_ass = test_assignment("incremental_test", test_user_1.course)
+    my_ass.addq_to_assignment(
+        question="subc_b_1",
+        points=10,
+        which_to_grade="last_answer",
+        autograde="all_or_nothing",
+    )
+    test_user_1.logout()
+
+    student1 = test_user("student1", "password", test_user_1.course)
+    student1.login()
+    student1.hsblog(
+        event="mChoice",
+        act="answer:1:correct",
+        correct="T",
+        answer="1",
+        div_id="subc_b_1",
+    )
+    student1.logout()
+    test_user_1.login()
+
+    db = runestone_db_tools.db
+    grade = db(
+        (db.question_grades.sid == student1.username)
+        & (db.question_grades.div_id == "subc_b_1")
+    )
+    # Answers logged in the last few minutes are always rechecked, since they may not all have been committed yet.
+    db(db.mchoice_answers.sid == student1.username).update(
+        timestamp=datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    )
+    db.commit()
+    my_ass.autograde()
+    assert grade.select().first().score == 10
+
+    # Without new answers, the student isn't regraded.
+    grade.update(score=5)
+    db.commit()
+    my_ass.autograde()
+    assert grade.select().first().score == 5
+
+    # A new answer is graded.
+    test_user_1.logout()
+    student1.login()
+    student1.hsblog(
+        event="mChoice", act="answer:0:no", correct="F", answer="0", div_id="subc_b_1"
+    )
+    student1.logout()
+    test_user_1.login()
+    my_ass.autograde()
+    assert grade.select().first().score == 0
+
+    # A forced regrade grades everyone.
+    grade.update(score=5)
+    db.commit()
+    res = json.loads(
+        test_client.validate(
+            "assignments/autograde",
+            data=dict(assignment=my_ass.assignment_name, force="true"),
+        )
+    )
+    assert res["message"].startswith("autograded")
+    assert grade.select().first().score == 0
+
+    # The grading page plans which students to grade, grades them a few at a time, then finishes. The recent answer is still rechecked.
+    def autograde(**kw):
+        return json.loads(
+            test_client.validate(
+                "assignments/autograde",
+                data=dict(assignment=my_ass.assignment_name, **kw),
+            )
+        )
+
+    grade.update(score=5)
+    db.commit()
+    res = autograde(plan="true")
+    assert res["students"] == [student1.username]
+    assert autograde(sids=json.dumps(res["students"]))["message"].startswith(
+        "autograded"
+    )
+    assert grade.select().first().score == 0
+    assert autograde(finish="true")["success"]
+    assert not autograde(finish="true")["success"]
+    assert not autograde(sids="student1")["success"]
+
+
 SCA = "/srv/web2py/applications/runestone/books/test_course_1/published/test_course_1/test_chapter_1/subchapter_a.html"
 SCB = "/srv/web2py/applications/runestone/books/test_course_1/published/test_course_1/test_chapter_1/subchapter_b.html"
 
@@ -304,6 +395,63 @@ def test_reading(
     assert totres["score"] == 20
 
 
+def test_reading_from_useinfo(
+    test_assignment, test_user_1, test_user, runestone_db_tools, test_client
+):
+    test_user_1.make_instructor()
+    my_ass = test_assignment("reading_useinfo_test", test_user_1.course)
+    my_ass.addq_to_assignment(
+        question="Test chapter 1/Subchapter B",
+        points=10,
+        which_to_grade="best_answer",
+        autograde="interact",
+        reading_assignment=True,
+        activities_required=1,
+    )
+    student1 = test_user("student1", "password", test_user_1.course)
+
+    # Interactions logged before ``user_interactions`` existed are only in ``useinfo``.
+    db = runestone_db_tools.db
+    db.useinfo.insert(
+        sid="student1",
+        event="mChoice",
+        act="answer:1:correct",
+        div_id="subc_b_1",
+        course_id=test_user_1.course.course_name,
+        timestamp=datetime.datetime.utcnow(),
+    )
+    db.commit()
+    assert db(db.user_interactions.id > 0).isempty()
+
+    # New events add rows to ``user_interactions``; the older interactions still count until the course is backfilled.
+    student2 = test_user("student2", "password", test_user_1.course)
+    student2.login()
+    student2.hsblog(
+        event="mChoice",
+        act="answer:0:no",
+        correct="F",
+        answer="0",
+        div_id="subc_b_1",
+        course=test_user_1.course.course_name,
+    )
+    student2.logout()
+    assert not db(db.user_interactions.sid == "student2").isempty()
+
+    test_user_1.login()
+    my_ass.autograde()
+    my_ass.calculate_totals()
+    totres = (
+        db(
+            (db.grades.assignment == my_ass.assignment_id)
+            & (db.grades.auth_user == student1.user_id)
+        )
+        .select()
+        .first()
+    )
+    assert totres
+    assert totres["score"] == 10
+
+
 def test_record_grade(test_user_1, test_user, runestone_db_tools, test_client):
     student1 = test_user("student1", "password", test_user_1.course)
     student1.logout()
@@ -800,12 +800,49 @@ def test_deleteaccount(test_client, runestone_db_tools, test_user):
         div_id="subc_b_1",
         course="test_course_3",
     )
+    the_user.hsblog(event="poll", act="1", div_id="delete_poll", course="test_course_3")
+    runestone_db_tools.db.user_first_seen.insert(
+        sid="user_to_delete",
+        course_name="test_course_3",
+        first_seen=datetime.datetime.utcnow(),
+    )
+    # History logged anonymously, then linked to the account but not yet merged.
+    runestone_db_tools.db.useinfo.insert(
+        sid="delete_alias",
+        div_id="delete_page",
+        event="page",
+        course_id="test_course_3",
+    )
+    runestone_db_tools.db.sid_alias.insert(alias="delete_alias", sid="user_to_delete")
+    runestone_db_tools.db.commit()
+    the_user.test_client.post(
+        "ajax/runlog",
+        data=dict(
+            course="test_course_3",
+            div_id="delete_activecode",
+            code="print('only mine')",
+            errinfo="success",
+            to_save="true",
+        ),
+    )
     validate("default/delete", "About Runestone", data=dict(deleteaccount="checked"))
     db = runestone_db_tools.db
     res = db(db.auth_user.username == "user_to_delete").select().first()
     print(res)
     assert not db(db.useinfo.sid == "user_to_delete").select().first()
+    assert not db(db.user_interactions.sid == "user_to_delete").select().first()
+    assert not db(db.poll_votes.sid == "user_to_delete").select().first()
+    assert not db(db.user_answer_counters.sid == "user_to_delete").select().first()
+    assert not db(db.user_first_seen.sid == "user_to_delete").select().first()
+    assert not db(db.presence.sid == "user_to_delete").select().first()
+    assert not db(db.sid_alias.sid == "user_to_delete").select().first()
+    assert not db(db.useinfo.sid == "delete_alias").select().first()
+    counts = db(db.poll_option_counts.div_id == "delete_poll").select()
+    assert sum(row.vote_count for row in counts) == 0
     assert not db(db.code.sid == "user_to_delete").select().first()
+    assert not db(db.code_latest.sid == "user_to_delete").select().first()
+    # The blob only this account's code referenced is gone too.
+    assert db(db.code_blobs.code == "print('only mine')").isempty()
     assert not db(db.acerror_log.sid == "user_to_delete").select().first()
     for t in [
         "clickablearea",
@@ -844,6 +881,41 @@ def test_pageprogress(test_client, runestone_db_tools, test_user_1):
     assert '"LearningZone_poll": 0' in test_user_1.test_client.text
     assert '"subc_b_fitb": 0' in test_user_1.test_client.text
 
+    # The page carries the reader's progress, which was started by this first view.
+    assert "eBookConfig.progressInfo = " in test_user_1.test_client.text
+    progress = test_user_1.test_client.text.split("eBookConfig.progressInfo = ")[1]
+    progress = json.loads(progress.split(";</script>")[0])
+    assert progress["completionStatus"] == -1
+    assert {
+        "chapterName": "test_chapter_1",
+        "subChapterName": "subchapter_b",
+        "completionStatus": -1,
+        "endDate": 0,
+    } in progress["allCompletionStatus"]
+    assert progress["lastPage"] is None
+
+
+def test_pageprogress_from_useinfo(test_client, runestone_db_tools, test_user_1):
+    # An answer logged before ``user_interactions`` existed is only in ``useinfo``; it counts until the course is backfilled.
+    db = runestone_db_tools.db
+    db.useinfo.insert(
+        sid=test_user_1.username,
+        event="mChoice",
+        act="answer:1:correct",
+        div_id="subc_b_1",
+        course_id=test_user_1.course.course_name,
+        timestamp=datetime.datetime.utcnow(),
+    )
+    db.commit()
+    assert db(db.user_interactions.id > 0).isempty()
+    test_user_1.login()
+    test_user_1.test_client.validate(
+        "books/published/{}/test_chapter_1/subchapter_b.html".format(
+            test_user_1.course.base_course
+        ),
+        '"subc_b_1": 1',
+    )
+
 
 def test_lockdown(test_client, test_user_1):
     test_user_1.login()